@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Deduplicated, compressed backup store for tenant databases.
+
+create_backup_file() used to copy the whole SQLite file on every run, so
+30 nightly backups of a 500MB tenant took 15GB. Here a snapshot is a
+small JSON manifest that lists the SHA-256 of each fixed-size chunk of
+the database file (a whole number of SQLite pages). Chunks are stored
+once per tenant, compressed, under chunks/<2 hex>/<sha256>.<codec>, so
+a nightly snapshot only writes the pages that changed since any earlier
+snapshot. Every manifest is self-contained: there is no full/incremental
+chain to replay and any snapshot can be deleted independently.
+
+Layout of a tenant backup directory:
+    backup_20260101_030000.db              legacy full copy (still readable)
+    backup_20260102_030000.manifest.json   snapshot manifest
+    chunks/ab/ab12...ef.zst                compressed chunk (or .gz)
+
+Usage:
+    from database import backup_store
+    info = backup_store.create_snapshot(db_path, backup_dir)
+    backup_store.materialize(backup_dir, info['filename'], dest_path)
+    backup_store.delete_snapshot(backup_dir, filename)
+    backup_store.collect_garbage(backup_dir)
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import secrets
+import sqlite3
+import time
+from datetime import datetime
+
+try:
+    import zstandard  # optional: faster and smaller than gzip
+except ImportError:
+    zstandard = None
+
+MANIFEST_SUFFIX = '.manifest.json'
+MANIFEST_FORMAT = 1
+CHUNKS_DIRNAME = 'chunks'
+DEFAULT_CHUNK_SIZE = 32 * 1024
+# Chunks newer than this are never collected: a snapshot running in
+# another process may have just reused them before writing its manifest
+GC_GRACE_SECONDS = 3600
+
+CODECS = {
+    'gz': (lambda data: gzip.compress(data, compresslevel=6, mtime=0), gzip.decompress),
+}
+if zstandard is not None:
+    CODECS['zst'] = (
+        lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+DEFAULT_CODEC = 'zst' if 'zst' in CODECS else 'gz'
+
+
+class BackupIntegrityError(Exception):
+    """A chunk or the reassembled file does not match its manifest checksum."""
+
+
+def is_snapshot(filename):
+    return filename.endswith(MANIFEST_SUFFIX)
+
+
+def snapshot_db_name(filename):
+    """backup_X.manifest.json -> backup_X.db (name used for downloads/uploads)."""
+    return filename[:-len(MANIFEST_SUFFIX)] + '.db' if is_snapshot(filename) else filename
+
+
+def _chunk_path(backup_dir, digest, codec):
+    return os.path.join(backup_dir, CHUNKS_DIRNAME, digest[:2], f'{digest}.{codec}')
+
+
+def _find_chunk(backup_dir, digest):
+    """Existing chunk file for digest in any codec, or (None, None)."""
+    for codec in CODECS:
+        path = _chunk_path(backup_dir, digest, codec)
+        if os.path.exists(path):
+            return path, codec
+    return None, None
+
+
+def _write_atomic(path, data):
+    tmp_path = f'{path}.tmp-{secrets.token_hex(4)}'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _new_snapshot_name(backup_dir):
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    name = f'backup_{stamp}{MANIFEST_SUFFIX}'
+    n = 1
+    while os.path.exists(os.path.join(backup_dir, name)):
+        name = f'backup_{stamp}_{n}{MANIFEST_SUFFIX}'
+        n += 1
+    return name
+
+
+def create_snapshot(db_path, backup_dir, chunk_size=None, codec=None, source=None,
+                    step_pages=-1, progress=None):
+    """Snapshot db_path into backup_dir and return the manifest summary.
+
+    The live database is first copied with the SQLite backup API (so WAL
+    content and concurrent writers are handled by SQLite), then the copy
+    is chunked, hashed and only unseen chunks are compressed and stored.
+
+    step_pages > 0 copies that many pages per backup step, releasing the
+    source lock in between. progress(done_bytes, total_bytes, stage) is
+    called after every step and every chunk; total counts both the copy
+    and the store pass, so done/total is the overall fraction.
+    """
+    codec = codec or DEFAULT_CODEC
+    if codec not in CODECS:
+        raise ValueError(f'unknown backup codec: {codec}')
+    compress = CODECS[codec][0]
+    os.makedirs(backup_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    tmp_copy = os.path.join(backup_dir, f'.snapshot-{secrets.token_hex(4)}.db')
+    try:
+        src = sqlite3.connect(db_path)
+        dest = sqlite3.connect(tmp_copy)
+        try:
+            page_size = src.execute('PRAGMA page_size').fetchone()[0]
+
+            def on_step(status, remaining, total):
+                progress((total - remaining) * page_size, 2 * total * page_size, 'copy')
+
+            src.backup(dest, pages=step_pages, progress=on_step if progress else None)
+        finally:
+            dest.close()
+            src.close()
+
+        # Chunks hold whole pages so an updated page dirties exactly one chunk
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        chunk_size = max(page_size, chunk_size - chunk_size % page_size)
+
+        whole = hashlib.sha256()
+        chunks = []
+        new_chunks = 0
+        stored_bytes = 0
+        size = 0
+        total_size = os.path.getsize(tmp_copy)
+        with open(tmp_copy, 'rb') as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                size += len(data)
+                whole.update(data)
+                digest = hashlib.sha256(data).hexdigest()
+                chunks.append(digest)
+                existing, _ = _find_chunk(backup_dir, digest)
+                if existing:
+                    # Refresh mtime so a concurrent collect_garbage keeps it
+                    os.utime(existing)
+                else:
+                    path = _chunk_path(backup_dir, digest, codec)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    packed = compress(data)
+                    _write_atomic(path, packed)
+                    new_chunks += 1
+                    stored_bytes += len(packed)
+                if progress:
+                    progress(total_size + size, 2 * total_size, 'store')
+    finally:
+        if os.path.exists(tmp_copy):
+            os.remove(tmp_copy)
+
+    filename = _new_snapshot_name(backup_dir)
+    manifest = {
+        'format': MANIFEST_FORMAT,
+        'filename': filename,
+        'source': source,
+        'created_at': datetime.now().isoformat(),
+        'size': size,
+        'sha256': whole.hexdigest(),
+        'page_size': page_size,
+        'chunk_size': chunk_size,
+        'codec': codec,
+        'chunks': chunks,
+        'new_chunks': new_chunks,
+        'stored_bytes': stored_bytes,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+    _write_atomic(os.path.join(backup_dir, filename),
+                  json.dumps(manifest, separators=(',', ':')).encode('utf-8'))
+    return {k: v for k, v in manifest.items() if k != 'chunks'}
+
+
+def read_manifest(backup_dir, filename):
+    with open(os.path.join(backup_dir, filename), 'rb') as f:
+        manifest = json.loads(f.read().decode('utf-8'))
+    if manifest.get('format') != MANIFEST_FORMAT:
+        raise ValueError(f'unsupported manifest format: {manifest.get("format")}')
+    return manifest
+
+
+def list_snapshots(backup_dir):
+    return sorted(f for f in os.listdir(backup_dir) if is_snapshot(f)) if os.path.isdir(backup_dir) else []
+
+
+def _iter_verified_chunks(backup_dir, filename, manifest):
+    """Yield the decompressed chunks of a manifest, checking each SHA-256
+    and finally the whole-file checksum."""
+    whole = hashlib.sha256()
+    for index, digest in enumerate(manifest['chunks']):
+        path, codec = _find_chunk(backup_dir, digest)
+        if not path:
+            raise BackupIntegrityError(f'{filename}: chunk {index} ({digest[:12]}) is missing')
+        with open(path, 'rb') as f:
+            data = CODECS[codec][1](f.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise BackupIntegrityError(f'{filename}: chunk {index} ({digest[:12]}) is corrupt')
+        whole.update(data)
+        yield data
+    if whole.hexdigest() != manifest['sha256']:
+        raise BackupIntegrityError(f'{filename}: reassembled file checksum mismatch')
+
+
+def materialize(backup_dir, filename, dest_path):
+    """Reassemble a snapshot into dest_path, verifying every checksum.
+
+    Writes to a temporary file next to dest_path and renames it into place
+    only once the whole-file SHA-256 matches, so a corrupt store never
+    leaves a half-written database behind.
+    """
+    manifest = read_manifest(backup_dir, filename)
+    tmp_path = f'{dest_path}.tmp-{secrets.token_hex(4)}'
+    try:
+        with open(tmp_path, 'wb') as out:
+            for data in _iter_verified_chunks(backup_dir, filename, manifest):
+                out.write(data)
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return manifest
+
+
+def verify_snapshot(backup_dir, filename):
+    """Check that every chunk of a snapshot is present and intact."""
+    manifest = read_manifest(backup_dir, filename)
+    for _data in _iter_verified_chunks(backup_dir, filename, manifest):
+        pass
+    return True
+
+
+def delete_snapshot(backup_dir, filename):
+    """Remove a manifest; its chunks go on the next collect_garbage()."""
+    os.remove(os.path.join(backup_dir, filename))
+
+
+def collect_garbage(backup_dir, grace_seconds=GC_GRACE_SECONDS):
+    """Delete chunks no manifest references. Returns (files, bytes) freed.
+
+    If any manifest cannot be read (I/O error, bad JSON, unknown format)
+    nothing is collected: its chunks are unknown and may be the only copy
+    of a snapshot that a later fix or upgrade could still read.
+    """
+    chunks_dir = os.path.join(backup_dir, CHUNKS_DIRNAME)
+    if not os.path.isdir(chunks_dir):
+        return 0, 0
+    referenced = set()
+    for filename in list_snapshots(backup_dir):
+        try:
+            referenced.update(read_manifest(backup_dir, filename)['chunks'])
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[Backup] GC skipped in {backup_dir}: cannot read {filename} -> {e}")
+            return 0, 0
+
+    cutoff = time.time() - grace_seconds
+    freed_files = freed_bytes = 0
+    for prefix in os.listdir(chunks_dir):
+        prefix_dir = os.path.join(chunks_dir, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for name in os.listdir(prefix_dir):
+            path = os.path.join(prefix_dir, name)
+            digest = name.split('.', 1)[0]
+            if digest in referenced:
+                continue
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime >= cutoff:
+                    continue
+                os.remove(path)
+                freed_files += 1
+                freed_bytes += stat.st_size
+            except OSError:
+                continue
+        if not os.listdir(prefix_dir):
+            os.rmdir(prefix_dir)
+    return freed_files, freed_bytes
+
+
+def store_usage(backup_dir):
+    """Bytes on disk used by chunks (shared by all snapshots)."""
+    total = 0
+    chunks_dir = os.path.join(backup_dir, CHUNKS_DIRNAME)
+    for root, _dirs, files in os.walk(chunks_dir):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
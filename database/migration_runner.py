@@ -3,15 +3,20 @@
 Versioned database migration runner for POS Offline.
 Replaces scattered ALTER TABLE try/except blocks with ordered, tracked migrations.
 
+Migrations are either .sql files or .py files exposing upgrade(cursor, master)
+for steps that need runtime checks (e.g. optional SQLite modules).
+
 Usage:
     from database.migration_runner import run_migrations
     run_migrations(db_path)                    # Run tenant DB migrations
     run_migrations(master_db_path, master=True) # Run master DB migrations
+    get_latest_version()                       # Newest migration shipped
 """
 
 import sqlite3
 import os
 import re
+import importlib.util
 
 MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
 
@@ -38,21 +43,25 @@ def _get_current_version(cursor):
 
 
 def _parse_migration_files():
-    """Read and parse all .sql migration files from the migrations directory.
+    """Read and parse all .sql/.py migration files from the migrations directory.
     Returns list of (version, filename, sql_content) sorted by version.
+    sql_content is None for Python migrations.
     """
     migrations = []
     if not os.path.exists(MIGRATIONS_DIR):
         return migrations
 
     for filename in sorted(os.listdir(MIGRATIONS_DIR)):
-        if not filename.endswith('.sql'):
+        if not filename.endswith(('.sql', '.py')):
             continue
         match = re.match(r'^(\d+)', filename)
         if not match:
             continue
         version = int(match.group(1))
         filepath = os.path.join(MIGRATIONS_DIR, filename)
+        if filename.endswith('.py'):
+            migrations.append((version, filename, None))
+            continue
         with open(filepath, 'r', encoding='utf-8') as f:
             sql_content = f.read()
         migrations.append((version, filename, sql_content))
@@ -90,6 +99,25 @@ def _execute_sql_statements(cursor, sql_content, db_path):
             raise RuntimeError(f"Migration failed on {db_path}: {e}")
 
 
+def load_python_migration(filename):
+    """Import a .py migration module (e.g. to reuse its rebuild helpers)."""
+    filepath = os.path.join(MIGRATIONS_DIR, filename)
+    spec = importlib.util.spec_from_file_location(f'pos_migration_{filename[:-3]}', filepath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _run_python_migration(cursor, filename, db_path, master):
+    """Load a .py migration and call its upgrade(cursor, master)."""
+    module = load_python_migration(filename)
+    try:
+        module.upgrade(cursor, master=master)
+    except Exception as e:
+        print(f"[Migration] ERROR in {db_path}: {filename} -> {e}")
+        raise RuntimeError(f"Migration failed on {db_path}: {e}")
+
+
 def run_migrations(db_path, master=False):
     """Run all pending migrations on a database.
 
@@ -148,6 +176,8 @@ def run_migrations(db_path, master=False):
                     tenant_lines.append(stripped)
                 filtered_sql = '\n'.join(tenant_lines)
                 _execute_sql_statements(cursor, filtered_sql, db_path)
+            elif sql_content is None:
+                _run_python_migration(cursor, filename, db_path, master)
             else:
                 _execute_sql_statements(cursor, sql_content, db_path)
 
@@ -178,6 +208,12 @@ def run_migrations(db_path, master=False):
         conn.close()
 
 
+def get_latest_version():
+    """Highest migration version shipped in the migrations directory."""
+    migrations = _parse_migration_files()
+    return migrations[-1][0] if migrations else 0
+
+
 def get_db_version(db_path):
     """Get the current migration version of a database."""
     try:
@@ -0,0 +1,5 @@
+-- Migration 003: Index product variants by inventory item
+-- get_products() loads all variants of the listed inventory items in one
+-- set-based query; this index keeps it a range lookup instead of a scan
+
+CREATE INDEX IF NOT EXISTS idx_product_variants_inventory ON product_variants(inventory_id);
@@ -0,0 +1,6 @@
+-- Migration 004: Content hash for inventory images
+-- Product list endpoints no longer embed image_data; they return a
+-- versioned /api/inventory/<id>/image URL built from this hash instead.
+-- Existing rows are hashed lazily by backfill_inventory_image_hashes()
+
+ALTER TABLE inventory ADD COLUMN image_hash TEXT;
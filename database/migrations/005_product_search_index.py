@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Migration 005: Full-text product search index (FTS5 trigram).
+
+search_products() used LIKE '%q%' on four columns across
+branch_stock x inventory x product_variants, which no index can serve.
+This builds a per-tenant FTS5 table over product name, variant name and
+barcodes, kept in sync by triggers on inventory and product_variants.
+
+Row ids encode the source row:
+    rowid = -inventory.id       -> the base product (name, barcode)
+    rowid =  product_variants.id -> one variant (product name/barcode + variant fields)
+
+If the SQLite build lacks FTS5 or the trigram tokenizer, only the barcode
+indexes are created and search keeps using LIKE.
+"""
+
+import sqlite3
+
+INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_inventory_barcode ON inventory(barcode)',
+    'CREATE INDEX IF NOT EXISTS idx_product_variants_barcode ON product_variants(barcode)',
+    'CREATE INDEX IF NOT EXISTS idx_branch_stock_inventory ON branch_stock(inventory_id)',
+    'CREATE INDEX IF NOT EXISTS idx_branch_stock_variant ON branch_stock(variant_id)',
+)
+
+CREATE_TABLE = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(
+        name, barcode, variant_name, variant_barcode,
+        tokenize = 'trigram'
+    )
+'''
+
+TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS product_search_inventory_ai AFTER INSERT ON inventory BEGIN
+        INSERT INTO product_search (rowid, name, barcode) VALUES (-new.id, new.name, new.barcode);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS product_search_inventory_au AFTER UPDATE OF name, barcode ON inventory BEGIN
+        DELETE FROM product_search WHERE rowid = -old.id;
+        INSERT INTO product_search (rowid, name, barcode) VALUES (-new.id, new.name, new.barcode);
+        DELETE FROM product_search WHERE rowid IN (SELECT id FROM product_variants WHERE inventory_id = new.id);
+        INSERT INTO product_search (rowid, name, barcode, variant_name, variant_barcode)
+            SELECT pv.id, new.name, new.barcode, pv.variant_name, pv.barcode
+            FROM product_variants pv WHERE pv.inventory_id = new.id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS product_search_inventory_ad AFTER DELETE ON inventory BEGIN
+        DELETE FROM product_search WHERE rowid = -old.id;
+        DELETE FROM product_search WHERE rowid IN (SELECT id FROM product_variants WHERE inventory_id = old.id);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS product_search_variants_ai AFTER INSERT ON product_variants BEGIN
+        INSERT INTO product_search (rowid, name, barcode, variant_name, variant_barcode)
+            SELECT new.id, i.name, i.barcode, new.variant_name, new.barcode
+            FROM inventory i WHERE i.id = new.inventory_id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS product_search_variants_au AFTER UPDATE ON product_variants BEGIN
+        DELETE FROM product_search WHERE rowid = old.id;
+        INSERT INTO product_search (rowid, name, barcode, variant_name, variant_barcode)
+            SELECT new.id, i.name, i.barcode, new.variant_name, new.barcode
+            FROM inventory i WHERE i.id = new.inventory_id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS product_search_variants_ad AFTER DELETE ON product_variants BEGIN
+        DELETE FROM product_search WHERE rowid = old.id;
+    END''',
+)
+
+
+def supports_trigram(cursor):
+    """Check whether this SQLite build has FTS5 with the trigram tokenizer."""
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE temp._fts_trigram_probe USING fts5(x, tokenize='trigram')")
+        cursor.execute('DROP TABLE temp._fts_trigram_probe')
+        return True
+    except sqlite3.Error:
+        return False
+
+
+def rebuild(cursor):
+    """Refill product_search from inventory and product_variants."""
+    cursor.execute('DELETE FROM product_search')
+    cursor.execute('''
+        INSERT INTO product_search (rowid, name, barcode)
+        SELECT -id, name, barcode FROM inventory
+    ''')
+    cursor.execute('''
+        INSERT INTO product_search (rowid, name, barcode, variant_name, variant_barcode)
+        SELECT pv.id, i.name, i.barcode, pv.variant_name, pv.barcode
+        FROM product_variants pv JOIN inventory i ON i.id = pv.inventory_id
+    ''')
+
+
+def upgrade(cursor, master=False):
+    if master:
+        return
+    for sql in INDEXES:
+        cursor.execute(sql)
+    if not supports_trigram(cursor):
+        print('[Migration] FTS5 trigram not available - product search stays on LIKE')
+        return
+    cursor.execute(CREATE_TABLE)
+    for sql in TRIGGERS:
+        cursor.execute(sql)
+    rebuild(cursor)
@@ -0,0 +1,16 @@
+-- Migration 006: Indexes for report date ranges
+-- Report endpoints now filter with half-open ranges (created_at >= ? AND
+-- created_at < ?) via sql_date_range() instead of date(created_at), so
+-- these indexes can serve them. idx_invoices_date used to exist only in
+-- setup_database.py
+
+CREATE INDEX IF NOT EXISTS idx_invoices_date ON invoices(created_at);
+CREATE INDEX IF NOT EXISTS idx_invoices_branch_date ON invoices(branch_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_invoices_branch_name_date ON invoices(branch_name, created_at);
+CREATE INDEX IF NOT EXISTS idx_invoices_cancelled_date ON invoices(cancelled, created_at);
+CREATE INDEX IF NOT EXISTS idx_invoices_customer ON invoices(customer_id);
+CREATE INDEX IF NOT EXISTS idx_invoices_shift_date ON invoices(shift_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_invoice_items_invoice ON invoice_items(invoice_id);
+CREATE INDEX IF NOT EXISTS idx_invoice_items_product ON invoice_items(product_name);
+CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses(expense_date);
+CREATE INDEX IF NOT EXISTS idx_attendance_log_check_in ON attendance_log(check_in);
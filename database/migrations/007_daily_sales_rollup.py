@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Migration 007: Incremental daily sales rollup.
+
+Sales reports and the admin dashboard re-aggregated the whole invoices
+table on every call. daily_sales_rollup keeps one row per
+(day, branch, payment method, shift, cancelled) with running totals, so a
+report over any date range sums a handful of daily rows instead.
+
+The rollup is maintained by triggers on invoices, so every writer
+(create_invoice, sync_upload, edit_invoice, cancel_invoice, deletes)
+updates it inside its own transaction. NULL key columns are stored as
+0 / '' because UNIQUE treats NULLs as distinct and the upsert would
+never match them.
+
+server.py has rebuild_sales_rollup() / check_sales_rollup() and the
+`flask rebuild-sales-rollup` / `flask check-sales-rollup` commands.
+"""
+
+CREATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS daily_sales_rollup (
+        day TEXT NOT NULL,
+        branch_id INTEGER NOT NULL DEFAULT 0,
+        branch_name TEXT NOT NULL DEFAULT '',
+        payment_method TEXT NOT NULL DEFAULT '',
+        shift_id INTEGER NOT NULL DEFAULT 0,
+        cancelled INTEGER NOT NULL DEFAULT 0,
+        invoice_count INTEGER NOT NULL DEFAULT 0,
+        subtotal REAL NOT NULL DEFAULT 0,
+        discount REAL NOT NULL DEFAULT 0,
+        delivery_fee REAL NOT NULL DEFAULT 0,
+        total REAL NOT NULL DEFAULT 0,
+        coupon_discount REAL NOT NULL DEFAULT 0,
+        loyalty_discount REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, branch_id, branch_name, payment_method, shift_id, cancelled)
+    )
+'''
+
+KEY_COLUMNS = 'day, branch_id, branch_name, payment_method, shift_id, cancelled'
+AMOUNT_COLUMNS = ('subtotal', 'discount', 'delivery_fee', 'total', 'coupon_discount', 'loyalty_discount')
+
+# Columns whose change moves an invoice to another rollup row or amount
+WATCHED_COLUMNS = ('created_at', 'branch_id', 'branch_name', 'payment_method', 'shift_id', 'cancelled') + AMOUNT_COLUMNS
+
+
+def key_values(ref):
+    """Rollup key expressions for a row alias (new/old/i)."""
+    return (
+        f"COALESCE(substr({ref}.created_at, 1, 10), ''), COALESCE({ref}.branch_id, 0), "
+        f"COALESCE({ref}.branch_name, ''), COALESCE({ref}.payment_method, ''), "
+        f"COALESCE({ref}.shift_id, 0), CASE WHEN COALESCE({ref}.cancelled, 0) = 0 THEN 0 ELSE 1 END"
+    )
+
+
+def _apply(ref, sign):
+    amounts = ', '.join(f'{sign}COALESCE({ref}.{c}, 0)' for c in AMOUNT_COLUMNS)
+    updates = ', '.join(f'{c} = {c} + excluded.{c}' for c in ('invoice_count',) + AMOUNT_COLUMNS)
+    return (
+        f"INSERT INTO daily_sales_rollup ({KEY_COLUMNS}, invoice_count, {', '.join(AMOUNT_COLUMNS)}) "
+        f"VALUES ({key_values(ref)}, {sign}1, {amounts}) "
+        f"ON CONFLICT({KEY_COLUMNS}) DO UPDATE SET {updates};"
+    )
+
+
+def _drop_empty(ref):
+    return (
+        f"DELETE FROM daily_sales_rollup WHERE invoice_count = 0 AND "
+        f"({KEY_COLUMNS}) = ({key_values(ref)});"
+    )
+
+
+TRIGGERS = (
+    f'''CREATE TRIGGER IF NOT EXISTS daily_sales_rollup_ai AFTER INSERT ON invoices BEGIN
+        {_apply('new', '')}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS daily_sales_rollup_au AFTER UPDATE OF {', '.join(WATCHED_COLUMNS)} ON invoices BEGIN
+        {_apply('old', '-')}
+        {_apply('new', '')}
+        {_drop_empty('old')}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS daily_sales_rollup_ad AFTER DELETE ON invoices BEGIN
+        {_apply('old', '-')}
+        {_drop_empty('old')}
+    END''',
+)
+
+INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_daily_sales_rollup_branch ON daily_sales_rollup(branch_id, day)',
+)
+
+
+def rebuild(cursor):
+    """Recompute daily_sales_rollup from invoices."""
+    amounts = ', '.join(f'SUM(COALESCE(i.{c}, 0))' for c in AMOUNT_COLUMNS)
+    cursor.execute('DELETE FROM daily_sales_rollup')
+    cursor.execute(f'''
+        INSERT INTO daily_sales_rollup ({KEY_COLUMNS}, invoice_count, {', '.join(AMOUNT_COLUMNS)})
+        SELECT {key_values('i')}, COUNT(*), {amounts}
+        FROM invoices i
+        GROUP BY 1, 2, 3, 4, 5, 6
+    ''')
+
+
+def upgrade(cursor, master=False):
+    if master:
+        return
+    cursor.execute(CREATE_TABLE)
+    for sql in INDEXES:
+        cursor.execute(sql)
+    for sql in TRIGGERS:
+        cursor.execute(sql)
+    rebuild(cursor)
@@ -0,0 +1,7 @@
+-- Migration 008: Index invoices by invoice number
+-- sync_upload dedupes a whole upload with one invoice_number IN (...)
+-- query and create_invoice checks the number before inserting; without
+-- this index each check scanned the invoices table.
+-- idx_invoices_number used to exist only in setup_database.py
+
+CREATE INDEX IF NOT EXISTS idx_invoices_number ON invoices(invoice_number);
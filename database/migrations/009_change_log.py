@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Migration 009: Change log for delta sync.
+
+sync_download(since=...) compared updated_at columns that have no index,
+that many writers never bump, and that cannot express deletes. Triggers
+now record every insert/update/delete of the synced tables in
+change_log with a monotonically increasing version (AUTOINCREMENT, so a
+version is never reused even after rows are removed).
+
+Each (table_name, row_id) keeps only its latest entry (the trigger
+deletes the previous one), so the log grows with the number of distinct
+rows touched, not with the number of writes. op is 'upsert' or 'delete'
+(a tombstone).
+
+settings is keyed by text, so any settings change is logged as
+row_id 0 and clients re-read the whole (small) settings table.
+"""
+
+CREATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS change_log (
+        version INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        op TEXT NOT NULL,
+        changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+INDEXES = (
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_change_log_row ON change_log(table_name, row_id)',
+)
+
+# Tables whose rows are sent to offline clients
+TRACKED_TABLES = ('inventory', 'product_variants', 'branch_stock', 'customers', 'branches', 'coupons', 'products')
+
+
+def _log(table, row_ref, op):
+    # DELETE + INSERT rather than INSERT OR REPLACE: a trigger inherits the
+    # outer statement's conflict clause, so INSERT OR IGNORE INTO settings
+    # would silently skip the log entry
+    return (f"DELETE FROM change_log WHERE table_name = '{table}' AND row_id = {row_ref}; "
+            f"INSERT INTO change_log (table_name, row_id, op) VALUES ('{table}', {row_ref}, '{op}');")
+
+
+def triggers():
+    sqls = []
+    for table in TRACKED_TABLES:
+        sqls += [
+            f'''CREATE TRIGGER IF NOT EXISTS change_log_{table}_ai AFTER INSERT ON {table} BEGIN
+                {_log(table, 'new.id', 'upsert')}
+            END''',
+            f'''CREATE TRIGGER IF NOT EXISTS change_log_{table}_au AFTER UPDATE ON {table} BEGIN
+                {_log(table, 'new.id', 'upsert')}
+            END''',
+            f'''CREATE TRIGGER IF NOT EXISTS change_log_{table}_ad AFTER DELETE ON {table} BEGIN
+                {_log(table, 'old.id', 'delete')}
+            END''',
+        ]
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        sqls.append(
+            f'''CREATE TRIGGER IF NOT EXISTS change_log_settings_{event[0].lower()} AFTER {event} ON settings BEGIN
+                {_log('settings', '0', 'upsert')}
+            END''')
+    return sqls
+
+
+def upgrade(cursor, master=False):
+    if master:
+        return
+    cursor.execute(CREATE_TABLE)
+    for sql in INDEXES:
+        cursor.execute(sql)
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existing = {row[0] for row in cursor.fetchall()}
+    for sql in triggers():
+        table = sql.split(' ON ', 1)[1].split()[0]
+        if table in existing:
+            cursor.execute(sql)
@@ -0,0 +1,14 @@
+-- Migration 010: Customer list indexes
+-- get_customers / get_customer / search_customer now aggregate
+-- total_orders / total_spent with one LEFT JOIN ... GROUP BY over the
+-- page of customers. (customer_id, total) covers that join, so COUNT and
+-- SUM never touch the invoices table; it replaces idx_invoices_customer.
+-- Prefix search uses name LIKE 'q%' (NOCASE index, SQLite's LIKE
+-- optimization) and a phone range on the plain phone index; paging
+-- walks customers in created_at order.
+
+CREATE INDEX IF NOT EXISTS idx_invoices_customer_total ON invoices(customer_id, total);
+DROP INDEX IF EXISTS idx_invoices_customer;
+CREATE INDEX IF NOT EXISTS idx_customers_name_nocase ON customers(name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_customers_phone ON customers(phone);
+CREATE INDEX IF NOT EXISTS idx_customers_created ON customers(created_at, id);
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Migration 011: Schema that request handlers used to create on the fly.
+
+login/add_user/update_user ran ensure_user_permission_columns() (about
+twenty ALTER TABLE attempts plus a commit) on every call, cancel_invoice
+tried four ALTER TABLE invoices statements with a commit each, and the
+XBRL endpoints ran ensure_xbrl_tables() + commit. DDL takes the write
+lock and forces an fsync, so shift-start login storms serialized on it.
+
+Those columns and tables are now guaranteed here, once per database:
+this migration is recorded in db_migrations and raises SCHEMA_VERSION,
+so the per-process schema gate (ensure_db_tables in server.py) applies
+it on the first request to each tenant and the handlers run no DDL.
+Columns are checked with PRAGMA table_info instead of ALTER-and-ignore.
+"""
+
+USER_PERMISSION_COLUMNS = (
+    'can_view_returns', 'can_view_expenses', 'can_view_suppliers', 'can_view_coupons',
+    'can_view_tables', 'can_view_attendance', 'can_view_advanced_reports',
+    'can_view_system_logs', 'can_view_dcf', 'can_cancel_invoices', 'can_view_branches',
+    'can_view_cross_branch_stock', 'can_view_xbrl', 'can_edit_completed_invoices',
+    'shift_id',
+    'can_create_transfer', 'can_approve_transfer', 'can_deliver_transfer', 'can_view_transfers',
+    'can_view_subscriptions', 'can_manage_subscriptions',
+)
+
+INVOICE_CANCEL_COLUMNS = (
+    ('cancelled', 'INTEGER DEFAULT 0'),
+    ('cancel_reason', 'TEXT'),
+    ('cancelled_at', 'TIMESTAMP'),
+    ('stock_returned', 'INTEGER DEFAULT 0'),
+)
+
+XBRL_TABLES = (
+    '''CREATE TABLE IF NOT EXISTS xbrl_company_info (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        company_name_ar TEXT,
+        company_name_en TEXT,
+        commercial_registration TEXT,
+        tax_number TEXT,
+        reporting_currency TEXT DEFAULT 'SAR',
+        industry_sector TEXT,
+        country TEXT DEFAULT 'SA',
+        fiscal_year_end TEXT DEFAULT '12-31',
+        legal_form TEXT,
+        contact_email TEXT,
+        contact_phone TEXT,
+        address TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS xbrl_reports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        report_type TEXT NOT NULL,
+        period_start TEXT NOT NULL,
+        period_end TEXT NOT NULL,
+        report_data TEXT,
+        xbrl_xml TEXT,
+        created_by INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        notes TEXT
+    )''',
+)
+
+
+def _add_missing_columns(cursor, table, columns):
+    cursor.execute(f'PRAGMA table_info({table})')
+    existing = {row[1] for row in cursor.fetchall()}
+    if not existing:
+        return  # table not created in this database
+    for name, decl in columns:
+        if name not in existing:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {decl}')
+
+
+def upgrade(cursor, master=False):
+    if master:
+        return
+    _add_missing_columns(cursor, 'users', [(col, 'INTEGER DEFAULT 0') for col in USER_PERMISSION_COLUMNS])
+    _add_missing_columns(cursor, 'invoices', INVOICE_CANCEL_COLUMNS)
+    for sql in XBRL_TABLES:
+        cursor.execute(sql)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Migration 012: Append-only stock movement ledger with periodic snapshots.
+
+branch_stock.stock is changed in place by sales, sync uploads, invoice
+edits and cancels, transfers, redemptions, damage and manual edits, so
+there was no history and "stock as of a date" meant replaying invoices.
+
+Triggers on branch_stock now append one stock_movements row per change
+(delta and resulting stock) inside the writer's own transaction, the
+same way 007 and 009 keep their tables current. Writers tag the change
+by filling the single stock_movement_context row for the duration of
+the statement (server.py: stock_movement_reason()); untagged changes
+are recorded as 'other'.
+
+Every movement also checks the branch's newest snapshot: when there is
+none or it is older than SNAPSHOT_INTERVAL_DAYS, the whole branch stock
+is copied into stock_snapshot_items with last_movement_id = the movement
+that triggered it. Stock at time T is then the newest snapshot taken at
+or before T plus the movements after its last_movement_id up to T, a
+range bounded by the next snapshot.
+
+Existing stock is recorded as 'opening' movements with one initial
+snapshot per branch, before the triggers exist, so SUM(delta) per
+branch_stock row equals its stock from the start.
+"""
+
+SNAPSHOT_INTERVAL_DAYS = 7
+
+TABLES = (
+    # Rows are never deleted, so a plain rowid key is already monotonic;
+    # AUTOINCREMENT would add a sqlite_sequence write per movement
+    '''CREATE TABLE IF NOT EXISTS stock_movements (
+        id INTEGER PRIMARY KEY,
+        branch_stock_id INTEGER NOT NULL,
+        branch_id INTEGER,
+        inventory_id INTEGER,
+        variant_id INTEGER,
+        delta REAL NOT NULL,
+        stock_after REAL,
+        reason TEXT NOT NULL,
+        ref_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS stock_movement_context (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        reason TEXT NOT NULL,
+        ref_id INTEGER
+    )''',
+    '''CREATE TABLE IF NOT EXISTS stock_snapshots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        branch_id INTEGER,
+        last_movement_id INTEGER NOT NULL,
+        taken_at TIMESTAMP NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS stock_snapshot_items (
+        snapshot_id INTEGER NOT NULL,
+        branch_stock_id INTEGER NOT NULL,
+        inventory_id INTEGER,
+        variant_id INTEGER,
+        stock REAL,
+        PRIMARY KEY (snapshot_id, branch_stock_id)
+    ) WITHOUT ROWID''',
+)
+
+# Only (branch_id, id): it is appended to in order, while an index on
+# branch_stock_id takes a random b-tree insert per movement and roughly
+# doubled the trigger cost of a 100-item sale
+INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_stock_movements_branch ON stock_movements(branch_id, id)',
+    'CREATE INDEX IF NOT EXISTS idx_stock_snapshots_branch ON stock_snapshots(branch_id, taken_at)',
+)
+
+
+def _movement(row, delta, stock_after):
+    return f'''INSERT INTO stock_movements
+            (branch_stock_id, branch_id, inventory_id, variant_id, delta, stock_after, reason, ref_id)
+        VALUES ({row}.id, {row}.branch_id, {row}.inventory_id, {row}.variant_id, {delta}, {stock_after},
+            COALESCE((SELECT reason FROM stock_movement_context WHERE id = 1), 'other'),
+            (SELECT ref_id FROM stock_movement_context WHERE id = 1));'''
+
+
+TRIGGERS = (
+    f'''CREATE TRIGGER IF NOT EXISTS stock_movements_bs_au AFTER UPDATE OF stock ON branch_stock
+        WHEN NEW.stock IS NOT OLD.stock BEGIN
+        {_movement('NEW', 'IFNULL(NEW.stock, 0) - IFNULL(OLD.stock, 0)', 'NEW.stock')}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS stock_movements_bs_ai AFTER INSERT ON branch_stock
+        WHEN IFNULL(NEW.stock, 0) != 0 BEGIN
+        {_movement('NEW', 'NEW.stock', 'NEW.stock')}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS stock_movements_bs_ad AFTER DELETE ON branch_stock
+        WHEN IFNULL(OLD.stock, 0) != 0 BEGIN
+        {_movement('OLD', '-OLD.stock', '0')}
+    END''',
+    # Per-row triggers fire as each row is written, so branch_stock read
+    # here holds exactly the changes up to and including NEW.id, even in
+    # the middle of a multi-row UPDATE
+    f'''CREATE TRIGGER IF NOT EXISTS stock_snapshots_sm_ai AFTER INSERT ON stock_movements
+        WHEN NOT EXISTS (SELECT 1 FROM stock_snapshots WHERE branch_id IS NEW.branch_id
+                         AND taken_at > datetime(NEW.created_at, '-{SNAPSHOT_INTERVAL_DAYS} days')) BEGIN
+        INSERT INTO stock_snapshots (branch_id, last_movement_id, taken_at)
+        VALUES (NEW.branch_id, NEW.id, NEW.created_at);
+        INSERT INTO stock_snapshot_items (snapshot_id, branch_stock_id, inventory_id, variant_id, stock)
+        SELECT (SELECT MAX(id) FROM stock_snapshots), id, inventory_id, variant_id, stock
+        FROM branch_stock WHERE branch_id IS NEW.branch_id;
+    END''',
+)
+
+
+def take_snapshot(cursor, branch_id):
+    """Snapshot one branch at the current end of the ledger."""
+    cursor.execute('SELECT COALESCE(MAX(id), 0) FROM stock_movements')
+    last_movement_id = cursor.fetchone()[0]
+    cursor.execute('''INSERT INTO stock_snapshots (branch_id, last_movement_id, taken_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)''', (branch_id, last_movement_id))
+    cursor.execute('''INSERT INTO stock_snapshot_items (snapshot_id, branch_stock_id, inventory_id, variant_id, stock)
+        SELECT ?, id, inventory_id, variant_id, stock FROM branch_stock WHERE branch_id IS ?''',
+                   (cursor.lastrowid, branch_id))
+
+
+def upgrade(cursor, master=False):
+    if master:
+        return
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'branch_stock'")
+    if not cursor.fetchone():
+        return
+    for sql in TABLES + INDEXES:
+        cursor.execute(sql)
+
+    cursor.execute('SELECT COUNT(*) FROM stock_movements')
+    if cursor.fetchone()[0] == 0:
+        cursor.execute('''INSERT INTO stock_movements
+                (branch_stock_id, branch_id, inventory_id, variant_id, delta, stock_after, reason)
+            SELECT id, branch_id, inventory_id, variant_id, stock, stock, 'opening'
+            FROM branch_stock WHERE IFNULL(stock, 0) != 0 ORDER BY id''')
+        cursor.execute('SELECT DISTINCT branch_id FROM branch_stock')
+        for (branch_id,) in cursor.fetchall():
+            take_snapshot(cursor, branch_id)
+
+    for sql in TRIGGERS:
+        cursor.execute(sql)
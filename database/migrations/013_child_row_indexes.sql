@@ -0,0 +1,11 @@
+-- Migration 013: Parent-key indexes for batched child loading
+-- get_stock_transfers, get_expenses, get_customer_subscriptions and
+-- get_subscription_plans load child rows for the whole page with one
+-- parent_id IN (...) query (fetch_children in server.py). None of these
+-- child tables had an index on the parent key, so each batch scanned
+-- the full table; the redemption index also covers the per-product SUM.
+
+CREATE INDEX IF NOT EXISTS idx_stock_transfer_items_transfer ON stock_transfer_items(transfer_id, id);
+CREATE INDEX IF NOT EXISTS idx_salary_details_expense ON salary_details(expense_id, id);
+CREATE INDEX IF NOT EXISTS idx_subscription_plan_items_plan ON subscription_plan_items(plan_id, id);
+CREATE INDEX IF NOT EXISTS idx_subscription_redemptions_sub ON subscription_redemptions(subscription_id, product_id, variant_id, quantity);
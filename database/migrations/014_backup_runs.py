@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Migration 014: Record scheduled backup runs outside the settings table.
+
+The backup scheduler stored its last run as settings.backup_last_run.
+Migration 009's change_log_settings_* triggers record every settings
+write, so each nightly backup bumped the settings stamp: every worker
+dropped its settings snapshot, /api/sync ETags changed and every POS
+client downloaded its settings again.
+
+backup_runs has no change_log triggers. The scheduler appends one row
+per run (rows are tiny and one per day) and reads the newest. An
+existing backup_last_run is carried over and removed from settings.
+"""
+
+TABLES = (
+    '''CREATE TABLE IF NOT EXISTS backup_runs (
+        id INTEGER PRIMARY KEY,
+        ran_at TEXT NOT NULL,
+        ok INTEGER NOT NULL DEFAULT 1,
+        filename TEXT
+    )''',
+)
+
+
+def upgrade(cursor, master=False):
+    if master:
+        return
+    for sql in TABLES:
+        cursor.execute(sql)
+
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'settings'")
+    if not cursor.fetchone():
+        return
+    cursor.execute("SELECT value FROM settings WHERE key = 'backup_last_run'")
+    row = cursor.fetchone()
+    if row and row[0]:
+        cursor.execute('SELECT COUNT(*) FROM backup_runs')
+        if cursor.fetchone()[0] == 0:
+            cursor.execute('INSERT INTO backup_runs (ran_at) VALUES (?)', (row[0],))
+    cursor.execute("DELETE FROM settings WHERE key = 'backup_last_run'")
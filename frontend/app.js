@@ -54,6 +54,14 @@ function escHTML(str) {
     return String(str).replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;').replace(/"/g,'&quot;').replace(/'/g,'&#39;');
 }
 
+// === رابط صورة المنتج ===
+// قوائم المنتجات تُرجع image_url بدلاً من الصورة نفسها (data URL) - تُخزن مرة واحدة في Service Worker
+function productImageSrc(p) {
+    if (p.image_url) return API_URL + p.image_url;
+    if (p.image_data && p.image_data.startsWith('data:image')) return p.image_data;
+    return '';
+}
+
 // === HMAC anti-tamper for setup config ===
 const _POS_APP_SALT = 'pos-offline-2024-anti-tamper';
 
@@ -1605,8 +1613,9 @@ function displayProducts(products) {
     }
     grid.innerHTML = products.map(p => {
         let imgDisplay = '';
-        if (p.image_data && p.image_data.startsWith('data:image')) {
-            imgDisplay = `<div class="product-card-icon"><img src="${p.image_data}" style="width:60px; height:60px; object-fit:cover; border-radius:8px;"></div>`;
+        const imgSrc = productImageSrc(p);
+        if (imgSrc) {
+            imgDisplay = `<div class="product-card-icon"><img src="${escHTML(imgSrc)}" loading="lazy" style="width:60px; height:60px; object-fit:cover; border-radius:8px;"></div>`;
         } else {
             imgDisplay = '<div class="product-card-icon">🛍️</div>';
         }
@@ -2839,12 +2848,11 @@ async function loadProductsTable() {
                         <div style="display: grid; grid-template-columns: repeat(auto-fill, minmax(200px, 1fr)); gap: 15px;">
                             ${byCategory[category].map(p => {
                                 let imgDisplay = '🛍️';
-                                if (p.image_data) {
-                                    if (p.image_data.startsWith('data:image')) {
-                                        imgDisplay = `<img src="${p.image_data}" style="width:60px; height:60px; object-fit:cover; border-radius:8px;">`;
-                                    } else {
-                                        imgDisplay = `<div style="font-size:50px;">${p.image_data}</div>`;
-                                    }
+                                const imgSrc = productImageSrc(p);
+                                if (imgSrc) {
+                                    imgDisplay = `<img src="${escHTML(imgSrc)}" loading="lazy" style="width:60px; height:60px; object-fit:cover; border-radius:8px;">`;
+                                } else if (p.image_data) {
+                                    imgDisplay = `<div style="font-size:50px;">${p.image_data}</div>`;
                                 }
                                 return `
                                     <div style="border:2px solid var(--gold-b); padding:15px; border-radius:12px; background:var(--card); text-align:center; transition:all 0.3s; cursor:pointer;"
@@ -2936,10 +2944,11 @@ function advancedSearchProducts() {
             <div style="display: grid; grid-template-columns: repeat(auto-fill, minmax(200px, 1fr)); gap: 15px;">
                 ${byCategory[category].map(p => {
                     let imgDisplay = '🛍️';
-                    if (p.image_data) {
-                        imgDisplay = p.image_data.startsWith('data:image')
-                            ? `<img src="${p.image_data}" style="width:60px; height:60px; object-fit:cover; border-radius:8px;">`
-                            : `<div style="font-size:50px;">${p.image_data}</div>`;
+                    const imgSrc = productImageSrc(p);
+                    if (imgSrc) {
+                        imgDisplay = `<img src="${escHTML(imgSrc)}" loading="lazy" style="width:60px; height:60px; object-fit:cover; border-radius:8px;">`;
+                    } else if (p.image_data) {
+                        imgDisplay = `<div style="font-size:50px;">${p.image_data}</div>`;
                     }
                     return `<div style="border:2px solid rgba(212,168,83,0.12); padding:15px; border-radius:12px; background: var(--card); text-align:center;">
                         <div style="margin-bottom:10px;">${imgDisplay}</div>
@@ -3076,8 +3085,8 @@ async function editProduct(id) {
         document.getElementById('productBranch').value = product.branch_id || 1;
     }
     
-    if (product.image_data && product.image_data.startsWith('data:image')) {
-        document.getElementById('productImageDisplay').innerHTML = `<img src="${product.image_data}" style="max-width:80px; max-height:80px; border-radius:8px;">`;
+    if (productImageSrc(product)) {
+        document.getElementById('productImageDisplay').innerHTML = `<img src="${escHTML(productImageSrc(product))}" style="max-width:80px; max-height:80px; border-radius:8px;">`;
         document.getElementById('productImagePreview').style.display = 'block';
     } else {
         document.getElementById('productImagePreview').style.display = 'none';
@@ -10123,8 +10132,11 @@ async function superAdminBackupAll() {
 
     try {
         const response = await authFetch(`${API_URL}/api/super-admin/backup/all`, { method: 'POST' });
-        const data = await response.json();
+        let data = await response.json();
         if (data.success) {
+            data = await waitForJob(data.job_id, job => {
+                btn.textContent = `⏳ جاري النسخ... ${job.done}/${job.total || '?'}`;
+            }, authFetch);
             let msg = `تم إنشاء ${data.total} نسخة احتياطية بنجاح`;
             if (data.failed > 0) {
                 msg += `\n⚠️ فشل ${data.failed} نسخة:`;
@@ -10506,6 +10518,27 @@ function formatFileSize(bytes) {
     return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i];
 }
 
+// انتظار مهمة خلفية (نسخ احتياطي / رفع) حتى تنتهي - تعيد نتيجة المهمة أو ترمي الخطأ
+async function waitForJob(jobId, onProgress, fetchFn = fetch) {
+    while (true) {
+        const response = await fetchFn(`${API_URL}/api/jobs/${jobId}`);
+        const data = await response.json();
+        if (!data.success) throw new Error(data.error || 'المهمة غير موجودة');
+        const job = data.job;
+        if (job.status === 'done') return job.result;
+        if (job.status === 'failed') throw new Error(job.error || 'فشلت المهمة');
+        if (onProgress) onProgress(job);
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
+function formatJobProgress(job) {
+    let text = `${Math.round((job.progress || 0) * 100)}%`;
+    if (job.bytes_total) text += ` (${formatFileSize(job.bytes_done)} / ${formatFileSize(job.bytes_total)})`;
+    if (job.eta_seconds != null) text += ` - متبقي ${Math.ceil(job.eta_seconds)} ث`;
+    return text;
+}
+
 async function loadBackupsList() {
     try {
         const response = await fetch(`${API_URL}/api/backup/list`, {
@@ -10573,7 +10606,10 @@ async function createBackup() {
         });
         const data = await response.json();
         if (data.success) {
-            progressText.textContent = `تم إنشاء النسخة بنجاح: ${data.backup.filename} (${formatFileSize(data.backup.size)})`;
+            const result = await waitForJob(data.job_id, job => {
+                progressText.textContent = `جاري إنشاء النسخة الاحتياطية... ${formatJobProgress(job)}`;
+            });
+            progressText.textContent = `تم إنشاء النسخة بنجاح: ${result.backup.filename} (${formatFileSize(result.backup.size)})`;
             setTimeout(() => { progress.style.display = 'none'; }, 3000);
             await loadBackupsList();
         } else {
@@ -10581,7 +10617,7 @@ async function createBackup() {
             setTimeout(() => { progress.style.display = 'none'; }, 5000);
         }
     } catch (error) {
-        progressText.textContent = 'فشل إنشاء النسخة الاحتياطية';
+        progressText.textContent = error.message ? `خطأ: ${error.message}` : 'فشل إنشاء النسخة الاحتياطية';
         setTimeout(() => { progress.style.display = 'none'; }, 5000);
     }
 }
@@ -10851,7 +10887,10 @@ async function createAndUploadGDrive() {
         });
         const data = await response.json();
         if (data.success) {
-            progressText.textContent = `✅ ${data.message}`;
+            const result = await waitForJob(data.job_id, job => {
+                progressText.textContent = `جاري الرفع إلى Google Drive... ${formatJobProgress(job)}`;
+            });
+            progressText.textContent = `✅ ${result.message}`;
             setTimeout(() => { progress.style.display = 'none'; }, 3000);
             await loadBackupsList();
             await loadGDriveFiles();
@@ -10860,7 +10899,7 @@ async function createAndUploadGDrive() {
             setTimeout(() => { progress.style.display = 'none'; }, 5000);
         }
     } catch (error) {
-        progressText.textContent = 'فشل الرفع إلى Google Drive';
+        progressText.textContent = error.message ? `خطأ: ${error.message}` : 'فشل الرفع إلى Google Drive';
         setTimeout(() => { progress.style.display = 'none'; }, 5000);
     }
 }
@@ -10879,7 +10918,10 @@ async function uploadBackupToGDrive(filename) {
         });
         const data = await response.json();
         if (data.success) {
-            progressText.textContent = `✅ ${data.message}`;
+            const result = await waitForJob(data.job_id, job => {
+                progressText.textContent = `جاري الرفع إلى Google Drive... ${formatJobProgress(job)}`;
+            });
+            progressText.textContent = `✅ ${result.message}`;
             setTimeout(() => { progress.style.display = 'none'; }, 3000);
             await loadGDriveFiles();
         } else {
@@ -10887,7 +10929,7 @@ async function uploadBackupToGDrive(filename) {
             setTimeout(() => { progress.style.display = 'none'; }, 5000);
         }
     } catch (error) {
-        progressText.textContent = 'فشل الرفع إلى Google Drive';
+        progressText.textContent = error.message ? `خطأ: ${error.message}` : 'فشل الرفع إلى Google Drive';
         setTimeout(() => { progress.style.display = 'none'; }, 5000);
     }
 }
@@ -24,8 +24,9 @@ function displayProductsCards(products) {
                 <div style="display: grid; grid-template-columns: repeat(auto-fill, minmax(200px, 1fr)); gap: 15px;">
                     ${byCategory[category].map(p => {
                         let imgDisplay = '🛍️';
-                        if (p.image_data && p.image_data.startsWith('data:image')) {
-                            imgDisplay = `<img src="${p.image_data}" style="width:60px; height:60px; object-fit:cover; border-radius:8px;">`;
+                        const imgSrc = productImageSrc(p);
+                        if (imgSrc) {
+                            imgDisplay = `<img src="${escHTML(imgSrc)}" loading="lazy" style="width:60px; height:60px; object-fit:cover; border-radius:8px;">`;
                         }
                         
                         // أزرار الإجراءات حسب الصلاحيات
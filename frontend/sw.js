@@ -2,8 +2,10 @@
 // Service Worker - PWA + Offline Support
 // ========================================
 
-const CACHE_NAME = 'pos-cache-v54';
+const CACHE_NAME = 'pos-cache-v55';
 const STATIC_CACHE = 'pos-static-v42';
+const IMAGE_CACHE = 'pos-images-v2';
+const IMAGE_CACHE_MAX_ENTRIES = 500;
 
 // الملفات الأساسية
 const STATIC_ASSETS = [
@@ -40,7 +42,7 @@ self.addEventListener('activate', (event) => {
         caches.keys().then(keys => {
             return Promise.all(
                 keys.map(key => {
-                    if (key !== STATIC_CACHE && key !== CACHE_NAME) {
+                    if (key !== STATIC_CACHE && key !== CACHE_NAME && key !== IMAGE_CACHE) {
                         console.log('[SW] Deleting old cache:', key);
                         return caches.delete(key);
                     }
@@ -50,6 +52,39 @@ self.addEventListener('activate', (event) => {
     );
 });
 
+// مفتاح كاش الصورة: المسار + المستأجر + بصمة المحتوى (بدون sig)
+// صورة المنتج نفسه بنسخة أخرى تحل محل القديمة، والعدد الكلي محدود
+function imageCacheKey(url) {
+    const params = new URLSearchParams({
+        t: url.searchParams.get('t') || '',
+        v: url.searchParams.get('v') || ''
+    });
+    return `${url.origin}${url.pathname}?${params}`;
+}
+
+async function cachedImage(request, url) {
+    const cache = await caches.open(IMAGE_CACHE);
+    const key = imageCacheKey(url);
+    const cached = await cache.match(key);
+    if (cached) return cached;
+
+    const response = await fetch(request);
+    if (response.ok) {
+        await cache.put(key, response.clone());
+        const tenant = url.searchParams.get('t') || '';
+        const keys = await cache.keys();
+        const stale = keys.filter(k => {
+            const u = new URL(k.url);
+            return k.url !== key && u.pathname === url.pathname && (u.searchParams.get('t') || '') === tenant;
+        });
+        // keys() بترتيب الإضافة: الأقدم أولاً
+        const fresh = keys.filter(k => !stale.includes(k));
+        const overflow = fresh.slice(0, Math.max(0, fresh.length - IMAGE_CACHE_MAX_ENTRIES));
+        await Promise.all(stale.concat(overflow).map(k => cache.delete(k)));
+    }
+    return response;
+}
+
 // Fetch Strategy
 self.addEventListener('fetch', (event) => {
     const { request } = event;
@@ -72,6 +107,12 @@ self.addEventListener('fetch', (event) => {
         return;
     }
 
+    // صور المنتجات - Cache First (الرابط يتضمن بصمة المحتوى v= فلا يتغير محتواه)
+    if (request.method === 'GET' && /^\/api\/inventory\/\d+\/image$/.test(url.pathname)) {
+        event.respondWith(cachedImage(request, url));
+        return;
+    }
+
     // API Requests - Network First
     if (url.pathname.startsWith('/api/')) {
         // POST/PUT/DELETE - شبكة فقط
@@ -71,6 +71,24 @@ class SyncManager {
         return fetch(url, { ...options, headers });
     }
 
+    // Helper: read an NDJSON stream line by line (one record per page)
+    async _readNdjson(response, onRecord) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { done, value } = await reader.read();
+            buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+            let newline;
+            while ((newline = buffer.indexOf('\n')) >= 0) {
+                const line = buffer.slice(0, newline).trim();
+                buffer = buffer.slice(newline + 1);
+                if (line) await onRecord(JSON.parse(line));
+            }
+            if (done) break;
+        }
+    }
+
     // Refresh license token from server
     async refreshLicenseToken() {
         try {
@@ -278,45 +296,47 @@ class SyncManager {
                 counts.expenses = await this.downloadExpenses();
                 counts.coupons = await this.downloadCoupons();
             } else {
-                // Local mode: use /api/sync/full-download + individual endpoints for missing data
+                // Local mode: stream /api/sync/full-download (NDJSON) + individual endpoints for missing data
+                // Each saved page records a {table, after_id} cursor so an interrupted sync resumes there
                 const branchId = (typeof currentUser !== 'undefined' && currentUser?.branch_id) ? currentUser.branch_id : 1;
-                const response = await fetch(`${this.getApiUrl()}/api/sync/full-download?branch_id=${branchId}`);
+                const cursorKey = `pos_full_sync_cursor_${branchId}`;
+                const cursor = JSON.parse(localStorage.getItem(cursorKey) || 'null');
+                let url = `${this.getApiUrl()}/api/sync/full-download?branch_id=${branchId}&format=ndjson`;
+                if (cursor) url += `&table=${encodeURIComponent(cursor.table)}&after_id=${cursor.after_id}`;
+                const response = await fetch(url);
                 if (!response.ok) throw new Error(`Server error: ${response.status}`);
 
-                const result = await response.json();
-                if (!result.success) throw new Error(result.error || 'Download failed');
-
-                const data = result.data;
-
-                if (data.products) {
-                    await localDB.clear('products');
-                    await localDB.saveAll('products', data.products);
-                    counts.products = data.products.length;
-                }
-                if (data.customers) {
-                    await localDB.clear('customers');
-                    await localDB.saveAll('customers', data.customers);
-                    counts.customers = data.customers.length;
-                }
-                if (data.settings) {
-                    await localDB.clear('settings');
-                    for (const [key, value] of Object.entries(data.settings)) {
-                        await localDB.save('settings', { key, value });
+                const stores = { products: 'products', customers: 'customers', coupons: 'coupons' };
+                let finished = false;
+                await this._readNdjson(response, async (record) => {
+                    if (record.type === 'error') throw new Error(record.error || 'Download failed');
+                    if (record.type === 'end') { finished = true; return; }
+                    if (record.type !== 'page') return;
+
+                    const table = record.table;
+                    if (stores[table]) {
+                        if (record.first) await localDB.clear(stores[table]);
+                        await localDB.saveAll(stores[table], record.rows);
+                    } else if (table === 'settings') {
+                        await localDB.clear('settings');
+                        for (const row of record.rows) {
+                            await localDB.save('settings', { key: row.key, value: row.value });
+                        }
+                    } else if (table === 'categories') {
+                        await localDB.clear('categories');
+                        for (const row of record.rows) {
+                            await localDB.save('categories', { name: row.category });
+                        }
+                    } else {
+                        return;
                     }
-                    counts.settings = Object.keys(data.settings).length;
-                }
-                if (data.categories) {
-                    await localDB.clear('categories');
-                    for (const cat of data.categories) {
-                        await localDB.save('categories', { name: cat });
+                    counts[table] = (counts[table] || 0) + record.rows.length;
+                    if (record.after_id !== null) {
+                        localStorage.setItem(cursorKey, JSON.stringify({ table, after_id: record.after_id }));
                     }
-                    counts.categories = data.categories.length;
-                }
-                if (data.coupons) {
-                    await localDB.clear('coupons');
-                    await localDB.saveAll('coupons', data.coupons);
-                    counts.coupons = data.coupons.length;
-                }
+                });
+                if (!finished) throw new Error('Download interrupted');
+                localStorage.removeItem(cursorKey);
 
                 // Also download branches, invoices, returns, expenses (not in full-download)
                 counts.branches = await this.downloadBranches();
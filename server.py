@@ -7,29 +7,52 @@ Flask + SQLite
 نظام Multi-Tenancy بقواعد بيانات منفصلة
 """
 
-from flask import Flask, request, jsonify, send_from_directory, g, send_file
+from flask import Flask, request, jsonify, send_from_directory, g, send_file, has_app_context, Response, stream_with_context, make_response
 from flask_cors import CORS
 import sqlite3
 import os
+import gzip
 import shutil
 import threading
 import time
+import tempfile
+import subprocess
+import sys
 import urllib.request
 import urllib.parse
 from datetime import datetime, timedelta
 import json
 import re
 import hashlib
+import heapq
+import hmac
+import base64
 import secrets
+import random
 import html
 import jwt
+import click
 from functools import wraps
+from contextlib import contextmanager, ExitStack
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.security import generate_password_hash, check_password_hash
 try:
-    from database.migration_runner import run_migrations, get_db_version
+    from database.migration_runner import run_migrations, get_db_version, get_latest_version, load_python_migration
 except ImportError:
     def run_migrations(*args, **kwargs): pass
     def get_db_version(*args, **kwargs): return 0
+    def get_latest_version(*args, **kwargs): return 0
+    def load_python_migration(*args, **kwargs): return None
+from database import backup_store
+try:
+    import brotli  # اختياري: ضغط أفضل من gzip للردود الكبيرة
+except ImportError:
+    brotli = None
+try:
+    import fcntl  # قفل الترقية بين العمليات (غير متوفر على Windows)
+except ImportError:
+    fcntl = None
 
 app = Flask(__name__, static_folder='frontend')
 
@@ -88,6 +111,30 @@ def get_auth_secret():
         AUTH_SECRET = secrets.token_hex(32)
     return AUTH_SECRET
 
+# Permission columns packed into the token bitmap: bit i = PERMISSION_COLUMNS[i].
+# Append only - reordering would misread tokens that are still valid
+PERMISSION_COLUMNS = (
+    'can_add_products', 'can_edit_products', 'can_delete_products', 'can_view_invoices',
+    'can_delete_invoices', 'can_view_reports', 'can_view_accounting', 'can_manage_users',
+    'can_access_settings', 'can_view_inventory', 'can_add_inventory', 'can_edit_inventory',
+    'can_delete_inventory', 'can_view_products', 'can_view_customers', 'can_add_customer',
+    'can_edit_customer', 'can_delete_customer', 'can_view_returns', 'can_view_expenses',
+    'can_view_suppliers', 'can_view_coupons', 'can_view_tables', 'can_view_attendance',
+    'can_view_advanced_reports', 'can_view_system_logs', 'can_view_dcf', 'can_cancel_invoices',
+    'can_view_branches', 'can_view_cross_branch_stock', 'can_view_xbrl', 'can_edit_completed_invoices',
+    'can_create_transfer', 'can_approve_transfer', 'can_deliver_transfer', 'can_view_transfers',
+    'can_view_subscriptions', 'can_manage_subscriptions',
+)
+PERMISSION_BITS = {name: bit for bit, name in enumerate(PERMISSION_COLUMNS)}
+
+def permission_bitmap(user_data):
+    """Pack the user's can_* columns into an int (bit set = permission value 1)"""
+    bitmap = 0
+    for name, bit in PERMISSION_BITS.items():
+        if user_data.get(name) == 1:
+            bitmap |= 1 << bit
+    return bitmap
+
 def generate_auth_token(user_data, tenant_slug='', is_super_admin=False):
     """Generate JWT auth token for authenticated user"""
     payload = {
@@ -99,6 +146,13 @@ def generate_auth_token(user_data, tenant_slug='', is_super_admin=False):
         'exp': datetime.utcnow() + timedelta(hours=24),
         'iat': datetime.utcnow()
     }
+    if not is_super_admin:
+        # require_permission checks these bits in memory while pv matches the tenant's counter
+        payload['perms'] = permission_bitmap(user_data)
+        try:
+            payload['pv'] = get_permission_version(tenant_slug)
+        except Exception:
+            pass  # no pv: require_permission reads the users row instead
     return jwt.encode(payload, get_auth_secret(), algorithm='HS256')
 
 # Routes that don't require authentication
@@ -111,6 +165,12 @@ PUBLIC_ROUTES = {
     '/api/sync/status'
 }
 
+# Public routes with a path parameter (checked by regex)
+# صور المنتجات تُطلب عبر <img> بدون ترويسات - محمية بتوقيع في الرابط
+PUBLIC_ROUTE_PATTERNS = (
+    re.compile(r'^/api/inventory/\d+/image$'),
+)
+
 # Rate limiting for login endpoints
 _login_attempts = {}  # {ip: [(timestamp, ...),]}
 LOGIN_RATE_LIMIT = 5  # max attempts
@@ -149,6 +209,8 @@ def auth_middleware():
     # Skip public routes
     if request.path in PUBLIC_ROUTES:
         return None
+    if any(p.match(request.path) for p in PUBLIC_ROUTE_PATTERNS):
+        return None
     # Rate limit on login routes
     if request.path in ('/api/login', '/api/super-admin/login'):
         if not check_rate_limit(get_client_ip(), request.path):
@@ -178,25 +240,140 @@ def auth_middleware():
         return jsonify({'success': False, 'error': 'Invalid token'}), 401
     return None
 
+# ===== أساس الكاش داخل العملية =====
+# كاشات العملية (الإعدادات، المستأجرون، الميزات، أسماء الفروع، إصدار الصلاحيات) تشترك في:
+# مدخلات خلف قفل، صلاحية بالـ TTL و/أو بختم يتحقق منه المستدعي، وإحصاءات /api/.../cache-stats
+
+class ProcessCache:
+    """{key: (value, loaded_at)} خلف قفل مع إحصاءات hits/misses/invalidations.
+    ttl=None: المدخل صالح حتى invalidate() أو حتى يرفضه fresh() في lookup()"""
+
+    size_stat = 'entries'  # اسم عدد المدخلات في stats()
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def lookup(self, key, fresh=None):
+        """القيمة المخزنة إن كانت ضمن TTL وقبلها fresh(value)، وإلا None (تُحسب hit أو miss)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry and (self.ttl is None or now - entry[1] < self.ttl)
+                    and (fresh is None or fresh(entry[0]))):
+                self._stats['hits'] += 1
+                return entry[0]
+            self._stats['misses'] += 1
+        return None
+
+    def store(self, key, value, loaded_at=None):
+        """loaded_at: وقت بدء التحميل (time.monotonic()) حتى لا يمتد TTL بزمن الاستعلام"""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() if loaded_at is None else loaded_at)
+
+    def count(self, stat):
+        with self._lock:
+            self._stats[stat] = self._stats.get(stat, 0) + 1
+
+    def invalidate(self, key=None):
+        """إسقاط مدخل (أو الكل)"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+            self._stats['invalidations'] += 1
+
+    def invalidate_where(self, match):
+        """إسقاط المدخلات التي يقبلها match(key, value)"""
+        with self._lock:
+            for key, (value, _) in list(self._entries.items()):
+                if match(key, value):
+                    del self._entries[key]
+            self._stats['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats[self.size_stat] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else None
+        if self.ttl is not None:
+            stats['ttl'] = self.ttl
+        return stats
+
+# Per-tenant permission version: bumped (in the tenant's settings) whenever a user's
+# role, permissions, password or status changes or the database is restored. Tokens
+# carrying an older pv fall back to reading the users row, so revocation is immediate
+# in the writing worker and within PERMISSION_VERSION_TTL seconds in the others.
+PERMISSION_VERSION_TTL = float(os.environ.get('POS_PERMISSION_VERSION_TTL', '5'))
+_permission_versions = ProcessCache(PERMISSION_VERSION_TTL)  # {tenant_slug: version}
+
+def read_permission_version(cursor):
+    """permissions_version from the tenant's settings (uncached)"""
+    cursor.execute("SELECT value FROM settings WHERE key = 'permissions_version'")
+    row = cursor.fetchone()
+    return int(row[0]) if row and str(row[0]).isdigit() else 0
+
+def get_permission_version(tenant_slug=''):
+    """Current permission version of a tenant (cached for PERMISSION_VERSION_TTL)"""
+    tenant_slug = tenant_slug or ''
+    now = time.monotonic()
+    version = _permission_versions.lookup(tenant_slug)
+    if version is not None:
+        return version
+    db_path = get_tenant_db_path(tenant_slug) if tenant_slug else DB_PATH
+    ensure_db_tables(db_path)
+    conn = _checkout_connection(db_path)
+    try:
+        version = read_permission_version(conn.cursor())
+    finally:
+        conn.close()
+    _permission_versions.store(tenant_slug, version, now)
+    return version
+
+def bump_permission_version(cursor, tenant_slug='', at_least=0):
+    """Invalidate every token's permission bitmap for a tenant - call before commit.
+    at_least: version seen before a restore, so a restored (older) counter is not reused"""
+    cursor.execute('''
+        INSERT INTO settings (key, value) VALUES ('permissions_version', CAST(? + 1 AS TEXT))
+        ON CONFLICT(key) DO UPDATE SET value = CAST(MAX(CAST(value AS INTEGER), ?) + 1 AS TEXT)
+    ''', (at_least, at_least))
+    _permission_versions.invalidate(tenant_slug or '')
+
 def require_permission(permission):
     """Decorator to check server-side permission for the current user"""
+    bit = PERMISSION_BITS.get(permission)
     def decorator(f):
         @wraps(f)
         def decorated(*args, **kwargs):
             user = getattr(request, 'current_user', None)
             if not user:
                 return jsonify({'success': False, 'error': 'Authentication required'}), 401
-            # Super admin and admin bypass permission checks
-            if user.get('is_super_admin') or user.get('role') == 'admin':
+            if user.get('is_super_admin'):
                 return f(*args, **kwargs)
-            # Check specific permission from DB
+            # Fresh token: admin bypass and permission bits straight from the token
+            try:
+                fresh = user.get('pv') is not None and user['pv'] == get_permission_version(get_tenant_slug())
+            except Exception:
+                fresh = False
+            if fresh:
+                if user.get('role') == 'admin':
+                    return f(*args, **kwargs)
+                if bit is not None and 'perms' in user:
+                    if user['perms'] >> bit & 1:
+                        return f(*args, **kwargs)
+                    return jsonify({'success': False, 'error': 'Permission denied'}), 403
+            # Stale or legacy token: check current role/permission from DB
             try:
                 conn = get_db()
                 cursor = conn.cursor()
-                cursor.execute(f'SELECT {permission} FROM users WHERE id = ?', (user.get('user_id'),))
+                cursor.execute(f'SELECT role, is_active, {permission} FROM users WHERE id = ?', (user.get('user_id'),))
                 row = cursor.fetchone()
                 conn.close()
-                if row and row[permission] == 1:
+                if row and row['is_active'] and (row['role'] == 'admin' or row[permission] == 1):
                     return f(*args, **kwargs)
             except Exception:
                 pass
@@ -239,11 +416,98 @@ def enforce_https():
 @app.after_request
 def add_security_headers(response):
     """Add security headers to all responses"""
-    response.headers['Content-Security-Policy'] = "default-src 'self'; script-src 'self' 'unsafe-inline'; style-src 'self' 'unsafe-inline'; img-src 'self' data: blob:; connect-src 'self' *"
+    if 'Content-Security-Policy' not in response.headers:
+        response.headers['Content-Security-Policy'] = "default-src 'self'; script-src 'self' 'unsafe-inline'; style-src 'self' 'unsafe-inline'; img-src 'self' data: blob:; connect-src 'self' *"
     response.headers['X-Content-Type-Options'] = 'nosniff'
     response.headers['X-Frame-Options'] = 'SAMEORIGIN'
     return response
 
+# ===== ضغط الاستجابات و ETag =====
+# ردود JSON الكبيرة (المنتجات، العملاء، التقارير، التنزيل الكامل) تُضغط بـ brotli
+# إن توفرت المكتبة وإلا gzip، وتحمل ETag حتى يرد الخادم بـ 304 إذا لم يتغير شيء
+
+COMPRESS_MIN_SIZE = int(os.environ.get('POS_COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_LEVEL = int(os.environ.get('POS_COMPRESS_LEVEL', '6'))
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/css', 'text/plain', 'application/javascript', 'text/javascript'}
+
+def _pick_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+@app.after_request
+def compress_and_tag_response(response):
+    """ETag من بصمة المحتوى + 304 + ضغط gzip/brotli للردود الكبيرة"""
+    if (request.method != 'GET' or response.status_code != 200
+            or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    if request.path.startswith('/api/'):
+        # الردود المرتبطة بإصدار البيانات (etag_from_change_version) تحمل ETag مسبقاً
+        response.add_etag(weak=True)
+        response.headers.setdefault('Cache-Control', 'private, no-cache')
+        response.vary.update(('X-Tenant-ID', 'Authorization'))
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = _pick_encoding()
+    if encoding == 'br':
+        data = brotli.compress(data, quality=min(COMPRESS_LEVEL, 11))
+    elif encoding == 'gzip':
+        data = gzip.compress(data, compresslevel=min(COMPRESS_LEVEL, 9))
+    else:
+        return response
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def etag_from_change_version(bypass_args=()):
+    """مزخرف: ETag من إصدار change_log بدل بصمة المحتوى.
+    يرد بـ 304 قبل تنفيذ الاستعلامات إذا لم يتغير أي جدول مُتتبَّع منذ آخر طلب.
+    bypass_args: معاملات (=1) تضيف بيانات غير مُتتبَّعة (مثل include_users) فتُترك لبصمة المحتوى"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if any(request.args.get(arg) == '1' for arg in bypass_args):
+                return f(*args, **kwargs)
+            try:
+                conn = get_db()
+                cursor = conn.cursor()
+                version = get_change_version(cursor)
+                # data_epoch يتغير عند استعادة نسخة احتياطية حتى لا يتكرر رقم إصدار قديم
+                cursor.execute("SELECT value FROM settings WHERE key = 'data_epoch'")
+                row = cursor.fetchone()
+                conn.close()
+            except sqlite3.Error:
+                return f(*args, **kwargs)
+            if not version:
+                return f(*args, **kwargs)
+            etag = hashlib.sha1(
+                f"{get_tenant_slug() or ''}|{row[0] if row else ''}|{version}|{request.full_path}".encode()
+            ).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag, weak=True)
+                response.headers['Cache-Control'] = 'private, no-cache'
+                return response
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag, weak=True)
+            return response
+        return decorated
+    return decorator
+
 # إعدادات قواعد البيانات
 _base_db_dir = os.path.dirname(os.environ['DB_PATH']) if os.environ.get('DB_PATH') else 'database'
 DB_PATH = os.environ.get('DB_PATH', 'database/pos.db')
@@ -346,6 +610,29 @@ def init_master_db():
             UNIQUE(tenant_id, feature_key)
         )
     ''')
+    # مهام الخلفية (نسخ احتياطي، رفع Google Drive) - مشتركة بين عمّال gunicorn
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            tenant_slug TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            stage TEXT,
+            done INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            unit TEXT DEFAULT 'bytes',
+            params TEXT,
+            result TEXT,
+            error TEXT,
+            created_by TEXT,
+            pid INTEGER,
+            created_at TEXT,
+            started_at TEXT,
+            finished_at TEXT,
+            updated_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs(created_at)')
     # ترقية: إضافة أعمدة جديدة إن لم تكن موجودة
     try:
         cursor.execute("PRAGMA table_info(tenants)")
@@ -1465,18 +1752,50 @@ def migrate_database(db_path=None):
     finally:
         conn.close()
 
-# ترقية قاعدة البيانات الافتراضية (نظام الترقية المتسلسل)
-migrate_database()
-run_migrations(DB_PATH)
-run_migrations(MASTER_DB_PATH, master=True)
+# ===== بوابة إصدار المخطط =====
+# ترقية كل المستأجرين عند الاستيراد كانت تكلف عشرات PRAGMA/ALTER لكل قاعدة وتتكرر في كل عامل.
+# الآن تُرقّى كل قاعدة عند أول طلب لها فقط: PRAGMA user_version يحمل إصدار المخطط المطبق،
+# فإذا طابق SCHEMA_VERSION لا يُنفذ أي DDL. الترقية نفسها تحت قفل ملف حتى لا يكررها عاملان معاً.
+# `flask migrate-tenants` يرقّي الكل مسبقاً (مثلاً بعد التحديث وقبل تشغيل الخادم).
+SCHEMA_REVISION = 1  # زِده عند تعديل migrate_database() أو ensure_db_tables()
+SCHEMA_VERSION = SCHEMA_REVISION * 1000 + get_latest_version()
+_schema_lock = threading.Lock()
+
+def read_schema_version(db_path):
+    """إصدار المخطط المسجل في القاعدة (0 إذا لم تُرقَّ بعد أو لم توجد)"""
+    if not os.path.exists(db_path):
+        return 0
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+
+def write_schema_version(db_path, version=None):
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(f'PRAGMA user_version = {int(version if version is not None else SCHEMA_VERSION)}')
+    finally:
+        conn.close()
 
-# ترقية جميع قواعد بيانات المستأجرين
-if os.path.exists(TENANTS_DB_DIR):
-    for f in os.listdir(TENANTS_DB_DIR):
-        if f.endswith('.db'):
-            tenant_path = os.path.join(TENANTS_DB_DIR, f)
-            migrate_database(tenant_path)
-            run_migrations(tenant_path)
+@contextmanager
+def schema_file_lock(db_path):
+    """قفل حصري بين العمليات على <db>.migrate.lock أثناء الترقية"""
+    if fcntl is None:
+        yield
+        return
+    with open(db_path + '.migrate.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# ترقية قاعدة البيانات الرئيسية والافتراضية (نظام الترقية المتسلسل) - المستأجرون عند أول طلب
+run_migrations(MASTER_DB_PATH, master=True)
+if read_schema_version(DB_PATH) != SCHEMA_VERSION:
+    migrate_database()
+    run_migrations(DB_PATH)
 
 def get_tenant_slug():
     """استخراج معرف المستأجر من الطلب"""
@@ -1494,10 +1813,19 @@ def get_tenant_db_path(slug):
 
 _initialized_dbs = set()
 
-def ensure_db_tables(db_path):
-    """التأكد من وجود الجداول الأساسية في قاعدة البيانات - يُنفذ مرة واحدة فقط لكل مسار"""
-    if db_path in _initialized_dbs:
+def ensure_db_tables(db_path, force=False):
+    """التأكد من ترقية مخطط القاعدة - يُنفذ مرة واحدة فقط لكل مسار في كل عملية"""
+    if db_path in _initialized_dbs and not force:
         return
+    if force or read_schema_version(db_path) != SCHEMA_VERSION:
+        with _schema_lock, schema_file_lock(db_path):
+            # عامل آخر ربما أنهى الترقية أثناء انتظار القفل
+            if force or read_schema_version(db_path) != SCHEMA_VERSION:
+                upgrade_database_schema(db_path)
+    _initialized_dbs.add(db_path)
+
+def upgrade_database_schema(db_path):
+    """الجداول الأساسية + migrate_database + الترقيات المرقمة، ثم تسجيل SCHEMA_VERSION"""
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
     cursor.executescript('''
@@ -1747,27 +2075,386 @@ def ensure_db_tables(db_path):
     cursor.execute("INSERT OR IGNORE INTO branches (id, name, location, is_active) VALUES (1, 'الفرع الرئيسي', '', 1)")
     conn.commit()
     conn.close()
-    _initialized_dbs.add(db_path)
+    migrate_database(db_path)
+    run_migrations(db_path)
+    backfill_inventory_image_hashes(db_path)
+    # لا يُسجل الإصدار إذا فشلت ترقية مرقمة (run_migrations يطبع الخطأ ولا يرفعه) فتُعاد لاحقاً
+    if get_db_version(db_path) >= get_latest_version():
+        write_schema_version(db_path)
+
+@app.before_request
+def ensure_tenant_schema():
+    """ترقية قاعدة المستأجر عند أول طلب لها - قبل المعالجات التي تتصل مباشرة بـ sqlite3.connect"""
+    if not request.path.startswith('/api/'):
+        return None
+    db_path = get_tenant_db_path(get_tenant_slug())
+    # القواعد غير الموجودة تُنشأ عبر get_db() كما في السابق (لا ننشئ ملفاً لمعرّف خاطئ هنا)
+    if db_path not in _initialized_dbs and os.path.exists(db_path):
+        ensure_db_tables(db_path)
+    return None
+
+# ===== مجمع اتصالات SQLite (Connection Pool) =====
+# اتصال لكل طلب يكلف فتح الملف وقراءة المخطط في كل مرة - نعيد استخدام الاتصالات لكل قاعدة
+DB_POOL_SIZE = int(os.environ.get('POS_DB_POOL_SIZE', '4'))  # أقصى عدد اتصالات خاملة لكل قاعدة
+DB_POOL_IDLE_TIMEOUT = int(os.environ.get('POS_DB_POOL_IDLE_TIMEOUT', '300'))  # ثوانٍ قبل إغلاق الاتصال الخامل
+DB_POOL_MAX_DATABASES = int(os.environ.get('POS_DB_POOL_MAX_DBS', '64'))  # أقصى عدد قواعد محتفظ بها (LRU)
+
+# إعدادات تُطبق مرة واحدة عند فتح كل اتصال
+DB_CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA cache_size=-4000',
+    'PRAGMA mmap_size=33554432',
+)
+
+class PooledConnection:
+    """غلاف لاتصال SQLite من المجمع - close() يعيد الاتصال إلى المجمع بدلاً من إغلاقه"""
+
+    def __init__(self, pool, db_path, conn, generation):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_db_path', db_path)
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_generation', generation)
+        object.__setattr__(self, '_released', False)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def close(self):
+        if self._released:
+            return
+        object.__setattr__(self, '_released', True)
+        self._pool.release(self._db_path, self._conn, self._generation)
+
+class SQLiteConnectionPool:
+    """مجمع اتصالات محدود لكل قاعدة بيانات مع إغلاق الاتصالات الخاملة"""
+
+    def __init__(self, max_idle=DB_POOL_SIZE, idle_timeout=DB_POOL_IDLE_TIMEOUT,
+                 max_databases=DB_POOL_MAX_DATABASES):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.max_databases = max_databases
+        self._lock = threading.Lock()
+        self._idle = OrderedDict()  # {db_path: [(conn, generation, released_at), ...]}
+        self._generations = {}  # {db_path: int} - يزداد عند discard لإسقاط الاتصالات القديمة
+        self._stats = {
+            'checkouts': 0, 'hits': 0, 'misses': 0,
+            'opened': 0, 'closed': 0, 'evicted_idle': 0,
+            'checkout_time_total': 0.0, 'checkout_time_max': 0.0,
+        }
+
+    def _open(self, db_path):
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_CONNECTION_PRAGMAS:
+            try:
+                conn.execute(pragma)
+            except sqlite3.Error as e:
+                print(f"[DBPool] {pragma} failed on {db_path}: {e}")
+        return conn
+
+    def _evict_expired_locked(self, now):
+        """إزالة الاتصالات التي تجاوزت مدة الخمول - يُستدعى مع القفل"""
+        expired = []
+        for db_path in list(self._idle.keys()):
+            bucket = self._idle[db_path]
+            keep = [entry for entry in bucket if now - entry[2] < self.idle_timeout]
+            if len(keep) != len(bucket):
+                expired.extend(entry[0] for entry in bucket if now - entry[2] >= self.idle_timeout)
+                if keep:
+                    self._idle[db_path] = keep
+                else:
+                    del self._idle[db_path]
+        self._stats['evicted_idle'] += len(expired)
+        return expired
+
+    def _close_all(self, conns):
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        if conns:
+            with self._lock:
+                self._stats['closed'] += len(conns)
+
+    def acquire(self, db_path):
+        """الحصول على اتصال من المجمع (أو فتح اتصال جديد)"""
+        started = time.perf_counter()
+        now = time.monotonic()
+        conn = None
+        with self._lock:
+            to_close = self._evict_expired_locked(now)
+            generation = self._generations.get(db_path, 0)
+            bucket = self._idle.get(db_path)
+            if bucket:
+                conn, _, _ = bucket.pop()
+                if not bucket:
+                    del self._idle[db_path]
+        self._close_all(to_close)
+        hit = conn is not None
+        if conn is None:
+            conn = self._open(db_path)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            stats = self._stats
+            stats['checkouts'] += 1
+            stats['hits' if hit else 'misses'] += 1
+            if not hit:
+                stats['opened'] += 1
+            stats['checkout_time_total'] += elapsed
+            stats['checkout_time_max'] = max(stats['checkout_time_max'], elapsed)
+        return PooledConnection(self, db_path, conn, generation)
+
+    def release(self, db_path, conn, generation):
+        """إعادة اتصال إلى المجمع - تُلغى أي معاملة غير مُثبتة كما يفعل close()"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = sqlite3.Row
+        except sqlite3.Error:
+            self._close_all([conn])
+            return
+        to_close = []
+        with self._lock:
+            if generation != self._generations.get(db_path, 0):
+                to_close.append(conn)
+            else:
+                bucket = self._idle.setdefault(db_path, [])
+                if len(bucket) >= self.max_idle:
+                    to_close.append(conn)
+                else:
+                    bucket.append((conn, generation, time.monotonic()))
+                self._idle.move_to_end(db_path)
+                while len(self._idle) > self.max_databases:
+                    _, old_bucket = self._idle.popitem(last=False)
+                    to_close.extend(entry[0] for entry in old_bucket)
+        self._close_all(to_close)
+
+    def discard(self, db_path):
+        """إغلاق كل اتصالات قاعدة معينة (عند حذفها أو استعادتها)"""
+        with self._lock:
+            self._generations[db_path] = self._generations.get(db_path, 0) + 1
+            bucket = self._idle.pop(db_path, [])
+        self._close_all([entry[0] for entry in bucket])
+
+    def stats(self):
+        """إحصائيات المجمع لضبط حجمه"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle_connections'] = sum(len(b) for b in self._idle.values())
+            stats['databases'] = len(self._idle)
+        checkouts = stats['checkouts']
+        stats['hit_rate'] = round(stats['hits'] / checkouts, 4) if checkouts else 0.0
+        stats['checkout_avg_ms'] = round(stats.pop('checkout_time_total') / checkouts * 1000, 3) if checkouts else 0.0
+        stats['checkout_max_ms'] = round(stats.pop('checkout_time_max') * 1000, 3)
+        stats.update({'max_idle': self.max_idle, 'idle_timeout': self.idle_timeout,
+                      'max_databases': self.max_databases})
+        return stats
+
+db_pool = SQLiteConnectionPool()
+
+def _checkout_connection(db_path):
+    """أخذ اتصال من المجمع وتسجيله في g ليُعاد تلقائياً عند نهاية الطلب"""
+    conn = db_pool.acquire(db_path)
+    if has_app_context():
+        if 'pooled_connections' not in g:
+            g.pooled_connections = []
+        g.pooled_connections.append(conn)
+    return conn
+
+@app.teardown_appcontext
+def release_pooled_connections(exc):
+    """إعادة الاتصالات التي لم تُغلق صراحةً إلى المجمع"""
+    for conn in g.pop('pooled_connections', []):
+        conn.close()
 
 def get_db():
     """الاتصال بقاعدة البيانات - يدعم Multi-Tenancy مع تهيئة تلقائية"""
     tenant_slug = get_tenant_slug()
     db_path = get_tenant_db_path(tenant_slug)
     ensure_db_tables(db_path)
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return _checkout_connection(db_path)
 
 def get_master_db():
     """الاتصال بقاعدة البيانات الرئيسية"""
-    conn = sqlite3.connect(MASTER_DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return _checkout_connection(MASTER_DB_PATH)
+
+# ===== سجل المستأجرين (كاش داخل العملية) =====
+# تسجيل الدخول وفحص الحالة والترخيص ووضع أوفلاين كانت تفتح master.db لقراءة نفس الصف
+# في كل طلب. الصف يُحمّل عند أول طلب ويبقى TENANT_CACHE_TTL ثانية أو حتى invalidate()
+# (تعديل/حذف/تجديد/انتهاء اشتراك). العمّال الآخرون يلتقطون التعديل بعد TTL.
+
+TENANT_CACHE_TTL = float(os.environ.get('POS_TENANT_CACHE_TTL', '60'))
+TENANT_REGISTRY_COLUMNS = ('id', 'slug', 'name', 'is_active', 'expires_at', 'plan', 'mode', 'max_users', 'max_branches')
+
+class TenantRegistry(ProcessCache):
+    """بيانات المستأجرين الأساسية (الحالة والانتهاء والخطة والوضع والحدود) مع TTL"""
+
+    size_stat = 'tenants'
+
+    def __init__(self, ttl=TENANT_CACHE_TTL):
+        super().__init__(ttl)  # {slug: tenant dict}
+
+    def _load(self, slug):
+        conn = get_master_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT {", ".join(TENANT_REGISTRY_COLUMNS)} FROM tenants WHERE slug = ?', (slug,))
+            row = cursor.fetchone()
+            return dict_from_row(row) if row else None
+        finally:
+            conn.close()
+
+    def get(self, slug):
+        """نسخة من بيانات المستأجر أو None إذا لم يوجد (المستأجر غير الموجود لا يُخزَّن)"""
+        now = time.monotonic()
+        tenant = self.lookup(slug)
+        if tenant is None:
+            tenant = self._load(slug)
+            if tenant is None:
+                return None
+            self.store(slug, tenant, now)
+        return dict(tenant)
+
+    def invalidate(self, slug=None, tenant_id=None):
+        """إسقاط مستأجر بالمعرف أو الرقم (أو الكل إذا لم يُحدد أي منهما)"""
+        if slug is None and tenant_id is None:
+            super().invalidate()
+        else:
+            self.invalidate_where(lambda key, tenant: key == slug or tenant['id'] == tenant_id)
+
+tenant_registry = TenantRegistry()
+
+def tenant_is_expired(tenant):
+    """هل تجاوز تاريخ اليوم تاريخ انتهاء اشتراك المستأجر؟"""
+    if not tenant.get('expires_at'):
+        return False
+    from datetime import date
+    return date.today() > date.fromisoformat(tenant['expires_at'][:10])
+
+def deactivate_expired_tenant(slug):
+    """تعطيل مستأجر انتهى اشتراكه وإسقاطه من السجل"""
+    conn = get_master_db()
+    conn.cursor().execute('UPDATE tenants SET is_active = 0 WHERE slug = ?', (slug,))
+    conn.commit()
+    conn.close()
+    tenant_registry.invalidate(slug)
+
+def tenant_mode(slug):
+    """وضع المستأجر (online/offline) - online إذا تعذرت القراءة"""
+    try:
+        tenant = tenant_registry.get(slug)
+    except Exception:
+        return 'online'
+    return (tenant or {}).get('mode') or 'online'
 
 def dict_from_row(row):
     """تحويل صف قاعدة البيانات إلى قاموس"""
     return dict(zip(row.keys(), row))
 
+def fetch_children(cursor, table, key, parent_ids, columns='*', order_by='id', group_by=None):
+    """صفوف الجدول الابن لمجموعة آباء باستعلام IN واحد لكل دفعة بدل استعلام لكل أب
+    يُرجع {parent_id: [dict, ...]} - الآباء بلا أبناء غير موجودين في القاموس"""
+    children = {}
+    for chunk in _sql_chunks(dict.fromkeys(pid for pid in parent_ids if pid is not None)):
+        query = f'''SELECT {key} AS _parent_id, {columns} FROM {table}
+            WHERE {key} IN ({','.join('?' * len(chunk))})'''
+        if group_by:
+            query += f' GROUP BY {key}, {group_by}'
+        if order_by:
+            query += f' ORDER BY {key}, {order_by}'
+        cursor.execute(query, chunk)
+        for row in cursor.fetchall():
+            child = dict_from_row(row)
+            children.setdefault(child.pop('_parent_id'), []).append(child)
+    return children
+
+def _parse_report_date(value):
+    """قراءة تاريخ YYYY-MM-DD من معامل الطلب (None إذا كان غير صالح)"""
+    try:
+        return datetime.strptime(str(value)[:10], '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+def sql_date_range(column, start_date=None, end_date=None):
+    """شرط فترة زمنية قابل للفهرسة: column >= start AND column < (end + يوم)
+    date(column) يمنع SQLite من استخدام الفهرس، والمقارنة النصية تعمل مع
+    'YYYY-MM-DD HH:MM:SS' و ISO. يُرجع (sql, params) لإلحاقها بعد WHERE"""
+    sql = ''
+    params = []
+    if start_date:
+        start = _parse_report_date(start_date)
+        if start:
+            sql += f' AND {column} >= ?'
+            params.append(start.strftime('%Y-%m-%d'))
+        else:
+            sql += f' AND date({column}) >= ?'
+            params.append(start_date)
+    if end_date:
+        end = _parse_report_date(end_date)
+        if end:
+            sql += f' AND {column} < ?'
+            params.append((end + timedelta(days=1)).strftime('%Y-%m-%d'))
+        else:
+            sql += f' AND date({column}) <= ?'
+            params.append(end_date)
+    return sql, params
+
+# ===== صور المنتجات =====
+# image_data يحفظ الصورة كـ data URL (base64) أو رمز emoji - الصور فقط تُخدم من رابط منفصل
+
+def inventory_image_hash(image_data):
+    """بصمة محتوى الصورة (None إذا لم تكن data URL)"""
+    if not image_data or not image_data.startswith('data:'):
+        return None
+    return hashlib.sha256(image_data.encode('utf-8')).hexdigest()[:32]
+
+def _inventory_image_signature(tenant_slug, inventory_id, image_hash):
+    """توقيع رابط الصورة - يثبت أن الرابط صدر لمستخدم مصادق"""
+    msg = f'{tenant_slug}:{inventory_id}:{image_hash}'.encode('utf-8')
+    return hmac.new(get_auth_secret().encode('utf-8'), msg, hashlib.sha256).hexdigest()[:24]
+
+def inventory_image_url(tenant_slug, inventory_id, image_hash):
+    """رابط صورة المنتج الموقّع والمرتبط بنسخة المحتوى"""
+    if not image_hash or not inventory_id:
+        return None
+    query = urllib.parse.urlencode({
+        't': tenant_slug, 'v': image_hash,
+        'sig': _inventory_image_signature(tenant_slug, inventory_id, image_hash),
+    })
+    return f'/api/inventory/{inventory_id}/image?{query}'
+
+def attach_inventory_image_url(product, tenant_slug):
+    """استبدال image_hash برابط الصورة في صف قائمة المنتجات"""
+    product['image_url'] = inventory_image_url(tenant_slug, product.get('inventory_id'), product.pop('image_hash', None))
+    return product
+
+def backfill_inventory_image_hashes(db_path):
+    """حساب image_hash للصور المحفوظة قبل ترقية 004"""
+    try:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, image_data FROM inventory WHERE image_hash IS NULL AND image_data LIKE 'data:%'")
+        rows = [(inventory_image_hash(image_data), inv_id) for inv_id, image_data in cursor.fetchall()]
+        if rows:
+            cursor.executemany('UPDATE inventory SET image_hash = ? WHERE id = ?', rows)
+            conn.commit()
+            print(f"[Images] Hashed {len(rows)} inventory images in {os.path.basename(db_path)}")
+        conn.close()
+    except Exception as e:
+        print(f"[Images] backfill {db_path}: {e}")
+
 def create_tenant_database(slug):
     """إنشاء قاعدة بيانات كاملة لمستأجر جديد"""
     db_path = get_tenant_db_path(slug)
@@ -2282,34 +2969,19 @@ def login():
         if not tenant_slug:
             return jsonify({'success': False, 'error': 'معرف المتجر مطلوب'}), 400
         if tenant_slug:
-            m_conn = get_master_db()
-            m_cursor = m_conn.cursor()
-            m_cursor.execute('SELECT is_active, expires_at, name FROM tenants WHERE slug = ?', (tenant_slug,))
-            tenant = m_cursor.fetchone()
-            m_conn.close()
+            tenant = tenant_registry.get(tenant_slug)
             if not tenant:
                 return jsonify({'success': False, 'error': 'معرف المتجر غير صحيح'}), 404
             if not tenant['is_active']:
                 return jsonify({'success': False, 'error': '⛔ هذا المتجر معطل. تواصل مع إدارة النظام'}), 403
-            if tenant['expires_at']:
-                from datetime import date
-                expiry = date.fromisoformat(tenant['expires_at'][:10])
-                if date.today() > expiry:
-                    # تعطيل المتجر تلقائياً
-                    m_conn2 = get_master_db()
-                    m_cursor2 = m_conn2.cursor()
-                    m_cursor2.execute('UPDATE tenants SET is_active = 0 WHERE slug = ?', (tenant_slug,))
-                    m_conn2.commit()
-                    m_conn2.close()
-                    return jsonify({'success': False, 'error': f'⛔ انتهى اشتراك المتجر "{tenant["name"]}" بتاريخ {tenant["expires_at"][:10]}.\nتواصل مع إدارة النظام لتجديد الاشتراك.'}), 403
+            if tenant_is_expired(tenant):
+                # تعطيل المتجر تلقائياً
+                deactivate_expired_tenant(tenant_slug)
+                return jsonify({'success': False, 'error': f'⛔ انتهى اشتراك المتجر "{tenant["name"]}" بتاريخ {tenant["expires_at"][:10]}.\nتواصل مع إدارة النظام لتجديد الاشتراك.'}), 403
 
         conn = get_db()
         cursor = conn.cursor()
 
-        # إضافة أعمدة الصلاحيات الجديدة تلقائياً عند تسجيل الدخول
-        ensure_user_permission_columns(cursor)
-        conn.commit()
-
         cursor.execute('''
             SELECT u.*, b.name as branch_name
             FROM users u
@@ -2340,13 +3012,8 @@ def login():
                 license_data = None
                 if tenant_slug:
                     try:
-                        m_conn = get_master_db()
-                        m_cur = m_conn.cursor()
-                        m_cur.execute('SELECT is_active, expires_at, plan, max_users, max_branches FROM tenants WHERE slug = ?', (tenant_slug,))
-                        t_row = m_cur.fetchone()
-                        m_conn.close()
-                        if t_row:
-                            t_info = dict_from_row(t_row)
+                        t_info = tenant_registry.get(tenant_slug)
+                        if t_info:
                             now = int(time.time())
                             # Calculate exp from tenant's actual expires_at date
                             # If no expires_at, exp is None (unlimited subscription)
@@ -2393,23 +3060,6 @@ def get_users():
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
 
-def ensure_user_permission_columns(cursor):
-    """إضافة أعمدة الصلاحيات الجديدة إذا لم تكن موجودة"""
-    new_cols = [
-        'can_view_returns', 'can_view_expenses', 'can_view_suppliers', 'can_view_coupons',
-        'can_view_tables', 'can_view_attendance', 'can_view_advanced_reports',
-        'can_view_system_logs', 'can_view_dcf', 'can_cancel_invoices', 'can_view_branches',
-        'can_view_cross_branch_stock', 'can_view_xbrl', 'can_edit_completed_invoices',
-        'shift_id',
-        'can_create_transfer', 'can_approve_transfer', 'can_deliver_transfer', 'can_view_transfers',
-        'can_view_subscriptions', 'can_manage_subscriptions'
-    ]
-    for col in new_cols:
-        try:
-            cursor.execute(f'ALTER TABLE users ADD COLUMN {col} INTEGER DEFAULT 0')
-        except:
-            pass
-
 @app.route('/api/users', methods=['POST'])
 @require_admin()
 def add_user():
@@ -2419,11 +3069,7 @@ def add_user():
         tenant_slug = get_tenant_slug()
         if tenant_slug:
             try:
-                m_conn = get_master_db()
-                m_cursor = m_conn.cursor()
-                m_cursor.execute('SELECT max_users FROM tenants WHERE slug = ?', (tenant_slug,))
-                t_row = m_cursor.fetchone()
-                m_conn.close()
+                t_row = tenant_registry.get(tenant_slug)
                 if t_row:
                     max_users = t_row['max_users'] or 999
                     conn_check = get_db()
@@ -2447,10 +3093,6 @@ def add_user():
         conn = get_db()
         cursor = conn.cursor()
 
-        # إضافة الأعمدة الجديدة تلقائياً إذا لم تكن موجودة
-        ensure_user_permission_columns(cursor)
-        conn.commit()
-
         cursor.execute('''
             INSERT INTO users (username, password, full_name, role, invoice_prefix, branch_id,
                              can_view_products, can_add_products, can_edit_products, can_delete_products,
@@ -2533,10 +3175,6 @@ def update_user(user_id):
         conn = get_db()
         cursor = conn.cursor()
 
-        # إضافة الأعمدة الجديدة تلقائياً إذا لم تكن موجودة
-        ensure_user_permission_columns(cursor)
-        conn.commit()
-
         # بناء الاستعلام ديناميكياً
         updates = []
         params = []
@@ -2681,6 +3319,7 @@ def update_user(user_id):
             params.append(user_id)
             query = f"UPDATE users SET {', '.join(updates)} WHERE id = ?"
             cursor.execute(query, params)
+            bump_permission_version(cursor, get_tenant_slug())
             conn.commit()
         
         conn.close()
@@ -2705,6 +3344,7 @@ def delete_user(user_id):
             return jsonify({'success': False, 'error': 'لا يمكن حذف حساب المدير'}), 400
         
         cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        bump_permission_version(cursor, get_tenant_slug())
         conn.commit()
         conn.close()
         
@@ -2794,7 +3434,24 @@ def static_files(path):
 
 # ===== API المنتجات =====
 
+def load_branch_variants(cursor, branch_id):
+    """متغيرات كل منتجات الفرع ('all' = كل الفروع) باستعلام واحد - {inventory_id: [variant, ...]}"""
+    variants_query = '''
+        SELECT * FROM product_variants
+        WHERE inventory_id IN (SELECT inventory_id FROM branch_stock {})
+        ORDER BY inventory_id, id
+    '''
+    if branch_id == 'all':
+        cursor.execute(variants_query.format(''))
+    else:
+        cursor.execute(variants_query.format('WHERE branch_id = ?'), (branch_id or 1,))
+    variants_by_inv = {}
+    for row in cursor.fetchall():
+        variants_by_inv.setdefault(row['inventory_id'], []).append(dict_from_row(row))
+    return variants_by_inv
+
 @app.route('/api/products', methods=['GET'])
+@etag_from_change_version()
 def get_products():
     """جلب جميع المنتجات - من التوزيعات على الفروع"""
     try:
@@ -2805,7 +3462,8 @@ def get_products():
         # جلب المنتجات من branch_stock مع معلومات المنتج من inventory
         base_query = '''
             SELECT bs.id, bs.stock, bs.branch_id, bs.inventory_id, bs.variant_id,
-                   i.name, i.barcode, i.category, i.price, i.cost, i.image_data,
+                   i.name, i.barcode, i.category, i.price, i.cost, i.image_hash,
+                   CASE WHEN i.image_hash IS NULL THEN i.image_data END as image_data,
                    pv.variant_name, pv.price as variant_price, pv.cost as variant_cost, pv.barcode as variant_barcode
             FROM branch_stock bs
             JOIN inventory i ON bs.inventory_id = i.id
@@ -2818,9 +3476,10 @@ def get_products():
         else:
             cursor.execute(base_query + ' WHERE bs.branch_id = ? ORDER BY i.name', (1,))
 
+        tenant_slug = get_tenant_slug()
         products = []
         for row in cursor.fetchall():
-            p = dict_from_row(row)
+            p = attach_inventory_image_url(dict_from_row(row), tenant_slug)
             # إذا التوزيع لخاصية معينة، استخدم اسمها وسعرها
             if p.get('variant_id') and p.get('variant_name'):
                 p['display_name'] = f"{p['name']} ({p['variant_name']})"
@@ -2832,19 +3491,10 @@ def get_products():
                 p['display_name'] = p['name']
             products.append(p)
 
-        # جلب المتغيرات الكاملة لكل منتج (للـ POS)
-        seen_inv = set()
+        # جلب المتغيرات الكاملة لكل منتج (للـ POS) - استعلام واحد لكل المنتجات المعروضة
+        variants_by_inv = load_branch_variants(cursor, branch_id)
         for p in products:
-            inv_id = p.get('inventory_id')
-            if inv_id and inv_id not in seen_inv:
-                cursor.execute('SELECT * FROM product_variants WHERE inventory_id = ? ORDER BY id', (inv_id,))
-                variants = [dict_from_row(row) for row in cursor.fetchall()]
-                for pp in products:
-                    if pp.get('inventory_id') == inv_id:
-                        pp['variants'] = variants
-                seen_inv.add(inv_id)
-            elif inv_id not in seen_inv if inv_id else True:
-                p['variants'] = p.get('variants', [])
+            p['variants'] = variants_by_inv.get(p.get('inventory_id'), [])
 
         conn.close()
         return jsonify({'success': True, 'products': products})
@@ -2964,15 +3614,16 @@ def add_inventory():
         cursor = conn.cursor()
         
         cursor.execute('''
-            INSERT INTO inventory (name, barcode, category, price, cost, image_data)
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT INTO inventory (name, barcode, category, price, cost, image_data, image_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
         ''', (
             data.get('name'),
             data.get('barcode'),
             data.get('category', ''),
             data.get('price', 0),
             data.get('cost', 0),
-            data.get('image_data', '')
+            data.get('image_data', ''),
+            inventory_image_hash(data.get('image_data', ''))
         ))
         
         inventory_id = cursor.lastrowid
@@ -3002,7 +3653,7 @@ def update_inventory(inventory_id):
         
         cursor.execute('''
             UPDATE inventory 
-            SET name=?, barcode=?, category=?, price=?, cost=?, image_data=?, updated_at=CURRENT_TIMESTAMP
+            SET name=?, barcode=?, category=?, price=?, cost=?, image_data=?, image_hash=?, updated_at=CURRENT_TIMESTAMP
             WHERE id=?
         ''', (
             data.get('name'),
@@ -3011,6 +3662,7 @@ def update_inventory(inventory_id):
             data.get('price'),
             data.get('cost'),
             data.get('image_data'),
+            inventory_image_hash(data.get('image_data')),
             inventory_id
         ))
         
@@ -3030,7 +3682,8 @@ def delete_inventory(inventory_id):
         cursor = conn.cursor()
         # حذف المتغيرات والتوزيعات أولاً
         cursor.execute('DELETE FROM product_variants WHERE inventory_id=?', (inventory_id,))
-        cursor.execute('DELETE FROM branch_stock WHERE inventory_id=?', (inventory_id,))
+        with stock_movement_reason(cursor, 'delete', inventory_id):
+            cursor.execute('DELETE FROM branch_stock WHERE inventory_id=?', (inventory_id,))
         cursor.execute('DELETE FROM inventory WHERE id=?', (inventory_id,))
         conn.commit()
         conn.close()
@@ -3042,6 +3695,59 @@ def delete_inventory(inventory_id):
 
 # ===== API خصائص/متغيرات المنتجات =====
 
+@app.route('/api/inventory/<int:inventory_id>/image', methods=['GET'])
+def get_inventory_image(inventory_id):
+    """صورة المنتج كملف ثنائي مع ETag قوي - تُخزن مرة واحدة في المتصفح و Service Worker"""
+    try:
+        tenant_slug = request.args.get('t', '').strip()
+        version = request.args.get('v', '')
+        signature = request.args.get('sig', '')
+        if not hmac.compare_digest(signature, _inventory_image_signature(tenant_slug, inventory_id, version)):
+            return jsonify({'success': False, 'error': 'رابط غير صالح'}), 403
+
+        db_path = get_tenant_db_path(tenant_slug)
+        if not os.path.exists(db_path):
+            return jsonify({'success': False, 'error': 'الصورة غير موجودة'}), 404
+        ensure_db_tables(db_path)
+        conn = _checkout_connection(db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT image_hash FROM inventory WHERE id = ?', (inventory_id,))
+        row = cursor.fetchone()
+        if not row or not row['image_hash']:
+            conn.close()
+            return jsonify({'success': False, 'error': 'الصورة غير موجودة'}), 404
+        image_hash = row['image_hash']
+        # الرابط المطلوب لنسخة الصورة الحالية يُخزن نهائياً، غيره يُعاد التحقق منه
+        cache_control = 'public, max-age=31536000, immutable' if version == image_hash else 'no-cache'
+
+        if request.if_none_match.contains(image_hash):
+            conn.close()
+            response = app.response_class(status=304)
+            response.set_etag(image_hash)
+            response.headers['Cache-Control'] = cache_control
+            return response
+
+        cursor.execute('SELECT image_data FROM inventory WHERE id = ?', (inventory_id,))
+        image_data = cursor.fetchone()['image_data'] or ''
+        conn.close()
+
+        header, _, payload = image_data.partition(',')
+        mimetype = header[5:].split(';')[0] or 'application/octet-stream'
+        if ';base64' in header:
+            body = base64.b64decode(payload)
+        else:
+            body = urllib.parse.unquote_to_bytes(payload)
+
+        response = app.response_class(body, mimetype=mimetype)
+        response.set_etag(image_hash)
+        response.headers['Cache-Control'] = cache_control
+        # صور SVG قد تحتوي سكربتات - تُعرض دون تنفيذ
+        response.headers['Content-Security-Policy'] = "default-src 'none'; style-src 'unsafe-inline'; sandbox"
+        return response
+    except Exception as e:
+        print(f"API error [{request.path}]: {e}")
+        return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
+
 @app.route('/api/inventory/<int:inventory_id>/variants', methods=['GET'])
 def get_variants(inventory_id):
     """جلب متغيرات منتج"""
@@ -3106,7 +3812,8 @@ def get_branch_stock():
         cursor = conn.cursor()
         
         query = '''
-            SELECT bs.*, i.name, i.barcode, i.category, i.price, i.cost, i.image_data,
+            SELECT bs.*, i.name, i.barcode, i.category, i.price, i.cost, i.image_hash,
+                   CASE WHEN i.image_hash IS NULL THEN i.image_data END as image_data,
                    pv.variant_name, pv.price as variant_price, pv.cost as variant_cost, pv.barcode as variant_barcode,
                    b.name as branch_name
             FROM branch_stock bs
@@ -3128,7 +3835,8 @@ def get_branch_stock():
         query += ' ORDER BY i.name'
         
         cursor.execute(query, params)
-        stock = [dict_from_row(row) for row in cursor.fetchall()]
+        tenant_slug = get_tenant_slug()
+        stock = [attach_inventory_image_url(dict_from_row(row), tenant_slug) for row in cursor.fetchall()]
         conn.close()
         
         return jsonify({'success': True, 'stock': stock})
@@ -3169,31 +3877,32 @@ def add_branch_stock():
 
         existing = cursor.fetchone()
 
-        if existing:
-            new_stock = existing['stock'] + added_stock
-            # إلحاق الملاحظة الجديدة بالقديمة
-            old_notes = existing['notes'] or ''
-            if note_entry:
-                combined_notes = (old_notes + '\n' + note_entry).strip() if old_notes else note_entry
+        with stock_movement_reason(cursor, 'stock_add'):
+            if existing:
+                new_stock = existing['stock'] + added_stock
+                # إلحاق الملاحظة الجديدة بالقديمة
+                old_notes = existing['notes'] or ''
+                if note_entry:
+                    combined_notes = (old_notes + '\n' + note_entry).strip() if old_notes else note_entry
+                else:
+                    combined_notes = old_notes
+                cursor.execute('''
+                    UPDATE branch_stock SET stock = ?, notes = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (new_stock, combined_notes, existing['id']))
+                stock_id = existing['id']
             else:
-                combined_notes = old_notes
-            cursor.execute('''
-                UPDATE branch_stock SET stock = ?, notes = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (new_stock, combined_notes, existing['id']))
-            stock_id = existing['id']
-        else:
-            cursor.execute('''
-                INSERT INTO branch_stock (inventory_id, branch_id, variant_id, stock, notes)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                data.get('inventory_id'),
-                data.get('branch_id'),
-                variant_id,
-                added_stock,
-                note_entry
-            ))
-            stock_id = cursor.lastrowid
+                cursor.execute('''
+                    INSERT INTO branch_stock (inventory_id, branch_id, variant_id, stock, notes)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (
+                    data.get('inventory_id'),
+                    data.get('branch_id'),
+                    variant_id,
+                    added_stock,
+                    note_entry
+                ))
+                stock_id = cursor.lastrowid
 
         conn.commit()
         conn.close()
@@ -3220,11 +3929,12 @@ def update_branch_stock(stock_id):
         conn = get_db()
         cursor = conn.cursor()
 
-        cursor.execute('''
-            UPDATE branch_stock
-            SET stock = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (stock, stock_id))
+        with stock_movement_reason(cursor, 'adjustment'):
+            cursor.execute('''
+                UPDATE branch_stock
+                SET stock = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (stock, stock_id))
         
         conn.commit()
         conn.close()
@@ -3240,7 +3950,8 @@ def delete_branch_stock(stock_id):
     try:
         conn = get_db()
         cursor = conn.cursor()
-        cursor.execute('DELETE FROM branch_stock WHERE id = ?', (stock_id,))
+        with stock_movement_reason(cursor, 'delete'):
+            cursor.execute('DELETE FROM branch_stock WHERE id = ?', (stock_id,))
         conn.commit()
         conn.close()
         return jsonify({'success': True})
@@ -3248,6 +3959,11 @@ def delete_branch_stock(stock_id):
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
 
+def has_product_search_index(cursor):
+    """هل أُنشئ فهرس البحث product_search (ترقية 005) في هذه القاعدة؟"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_search'")
+    return cursor.fetchone() is not None
+
 @app.route('/api/products/search', methods=['GET'])
 def search_products():
     """البحث عن منتج بالاسم أو الباركود - من branch_stock مع فلترة بالفرع"""
@@ -3259,26 +3975,47 @@ def search_products():
 
         base_query = '''
             SELECT bs.id, bs.stock, bs.branch_id, bs.inventory_id, bs.variant_id,
-                   i.name, i.barcode, i.category, i.price, i.cost, i.image_data,
+                   i.name, i.barcode, i.category, i.price, i.cost, i.image_hash,
+                   CASE WHEN i.image_hash IS NULL THEN i.image_data END as image_data,
                    pv.variant_name, pv.price as variant_price, pv.cost as variant_cost, pv.barcode as variant_barcode
             FROM branch_stock bs
             JOIN inventory i ON bs.inventory_id = i.id
             LEFT JOIN product_variants pv ON bs.variant_id = pv.id
-            WHERE (i.name LIKE ? OR i.barcode LIKE ? OR pv.barcode LIKE ? OR pv.variant_name LIKE ?)
+            WHERE {}
         '''
-        params = [f'%{query}%', f'%{query}%', f'%{query}%', f'%{query}%']
-
+        branch_filter = ''
+        branch_params = []
         if branch_id and branch_id != 'all':
-            base_query += ' AND bs.branch_id = ?'
-            params.append(branch_id)
-
-        base_query += ' ORDER BY i.name LIMIT 20'
-
-        cursor.execute(base_query, params)
+            branch_filter = ' AND bs.branch_id = ?'
+            branch_params.append(branch_id)
+        order_limit = ' ORDER BY i.name LIMIT 20'
+
+        # 1. مطابقة باركود تامة (مسح الباركود) - بحث مفهرس مباشر
+        rows = []
+        if query:
+            cursor.execute(base_query.format('''(bs.inventory_id IN (SELECT id FROM inventory WHERE barcode = ?)
+                       OR bs.variant_id IN (SELECT id FROM product_variants WHERE barcode = ?))''') + branch_filter + order_limit,
+                           [query, query] + branch_params)
+            rows = cursor.fetchall()
+
+        # 2. فهرس النص الكامل (trigram يحتاج 3 أحرف على الأقل)، وإلا LIKE
+        if not rows:
+            if len(query) >= 3 and has_product_search_index(cursor):
+                # rowid سالب = المنتج الأساسي (-inventory.id)، موجب = الخاصية (product_variants.id)
+                where = '''(bs.inventory_id IN (SELECT -rowid FROM product_search WHERE product_search MATCH ? AND rowid < 0)
+                   OR bs.variant_id IN (SELECT rowid FROM product_search WHERE product_search MATCH ? AND rowid > 0))'''
+                phrase = '"' + query.replace('"', '""') + '"'
+                params = [phrase, phrase]
+            else:
+                where = '(i.name LIKE ? OR i.barcode LIKE ? OR pv.barcode LIKE ? OR pv.variant_name LIKE ?)'
+                params = [f'%{query}%', f'%{query}%', f'%{query}%', f'%{query}%']
+            cursor.execute(base_query.format(where) + branch_filter + order_limit, params + branch_params)
+            rows = cursor.fetchall()
 
+        tenant_slug = get_tenant_slug()
         products = []
-        for row in cursor.fetchall():
-            p = dict_from_row(row)
+        for row in rows:
+            p = attach_inventory_image_url(dict_from_row(row), tenant_slug)
             if p.get('variant_id') and p.get('variant_name'):
                 p['display_name'] = f"{p['name']} ({p['variant_name']})"
                 p['price'] = p.get('variant_price') or p['price']
@@ -3298,6 +4035,107 @@ def search_products():
 
 # ===== API الفواتير =====
 
+# ===== كاش أسماء الفروع والورديات =====
+# create_invoice ينسخ اسم الفرع واسم الوردية إلى كل فاتورة. الجدولان صغيران ونادراً ما يتغيران،
+# فيُحمّل كل جدول مرة لكل قاعدة ويبقى NAME_CACHE_TTL ثانية أو حتى invalidate() من نقاط تعديل
+# الفروع والورديات (العمّال الآخرون يلتقطون إعادة التسمية بعد TTL). معرف غير موجود يعيد التحميل.
+
+NAME_CACHE_TTL = float(os.environ.get('POS_NAME_CACHE_TTL', '60'))
+NAME_CACHE_TABLES = ('branches', 'shifts')
+
+class LookupNameCache(ProcessCache):
+    """{id: name} لجداول NAME_CACHE_TABLES لكل قاعدة مع TTL"""
+
+    size_stat = 'tables'
+
+    def __init__(self, ttl=NAME_CACHE_TTL):
+        super().__init__(ttl)  # {(db_path, table): {id: name}}
+
+    def get(self, conn, db_path, table, row_id):
+        """اسم الصف row_id في table أو None - conn اتصال مفتوح على db_path"""
+        if table not in NAME_CACHE_TABLES:
+            raise ValueError(f'unsupported name cache table: {table}')
+        try:
+            row_id = int(row_id)
+        except (TypeError, ValueError):
+            return None
+        now = time.monotonic()
+        # معرف غير موجود في الجدول المخزن (فرع/وردية جديدة) يعيد التحميل
+        names = self.lookup((db_path, table), lambda cached: row_id in cached)
+        if names is None:
+            names = {row[0]: row[1] for row in conn.execute(f'SELECT id, name FROM {table}').fetchall()}
+            self.store((db_path, table), names, now)
+        return names.get(row_id)
+
+    def invalidate(self, db_path=None, table=None):
+        """إسقاط جدول لقاعدة، أو كل جداول القاعدة، أو الكل"""
+        self.invalidate_where(lambda key, _names: (db_path is None or key[0] == db_path)
+                              and (table is None or key[1] == table))
+
+name_cache = LookupNameCache()
+
+# UPDATE ... FROM (3.33) و RETURNING (3.35): خصم كل عناصر السلة بجملة واحدة تعيد الرصيد الجديد
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+STOCK_DECREMENT_BATCH = 400  # صفوف لكل جملة (معاملان لكل صف، أقل من حد 999 في الإصدارات القديمة)
+
+def decrement_branch_stock(cursor, quantities):
+    """خصم [(branch_stock_id, quantity), ...] من branch_stock - يعيد {id: stock بعد الخصم}
+    (تكرار نفس المعرف في السلة يُجمع في خصم واحد، فيُسجل له صف حركة واحد)"""
+    totals = {}
+    for bs_id, quantity in quantities:
+        totals[int(bs_id)] = totals.get(int(bs_id), 0) + quantity
+    if SQLITE_HAS_RETURNING and len(totals) == 1:
+        # معرف واحد (أغلب فواتير نقطة البيع): UPDATE بالمفتاح دون بناء جدول VALUES وربطه
+        (bs_id, quantity), = totals.items()
+        cursor.execute('''
+            UPDATE branch_stock SET stock = stock - ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+            RETURNING id, stock
+        ''', (quantity, bs_id))
+        return {row[0]: row[1] for row in cursor.fetchall()}
+    totals = list(totals.items())
+    new_stock = {}
+    for start in range(0, len(totals), STOCK_DECREMENT_BATCH):
+        batch = totals[start:start + STOCK_DECREMENT_BATCH]
+        if SQLITE_HAS_RETURNING:
+            cursor.execute(f'''
+                WITH sold(id, quantity) AS (VALUES {", ".join(["(?, ?)"] * len(batch))})
+                UPDATE branch_stock
+                SET stock = stock - sold.quantity, updated_at = CURRENT_TIMESTAMP
+                FROM sold
+                WHERE branch_stock.id = sold.id
+                RETURNING branch_stock.id, branch_stock.stock
+            ''', [value for pair in batch for value in pair])
+        else:
+            cursor.executemany('''
+                UPDATE branch_stock SET stock = stock - ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+            ''', [(quantity, bs_id) for bs_id, quantity in batch])
+            cursor.execute(f'SELECT id, stock FROM branch_stock WHERE id IN ({", ".join("?" * len(batch))})',
+                           [bs_id for bs_id, _ in batch])
+        new_stock.update((row[0], row[1]) for row in cursor.fetchall())
+    return new_stock
+
+def low_stock_warnings_for(cursor, new_stock, threshold, fallback_names):
+    """تحذيرات المخزون المنخفض للأرصدة <= threshold (استعلام أسماء واحد للمنخفضة فقط)"""
+    low_ids = [bs_id for bs_id, stock in new_stock.items() if stock is not None and stock <= threshold]
+    if not low_ids:
+        return []
+    cursor.execute(f'''
+        SELECT bs.id, inv.name as product_name, pv.variant_name
+        FROM branch_stock bs
+        LEFT JOIN inventory inv ON inv.id = bs.inventory_id
+        LEFT JOIN product_variants pv ON pv.id = bs.variant_id
+        WHERE bs.id IN ({", ".join("?" * len(low_ids))})
+    ''', low_ids)
+    names = {row['id']: (row['product_name'], row['variant_name']) for row in cursor.fetchall()}
+    warnings = []
+    for bs_id in low_ids:
+        product_name, variant_name = names.get(bs_id, (None, None))
+        pname = product_name or fallback_names.get(bs_id, '')
+        if variant_name:
+            pname += f" ({variant_name})"
+        warnings.append({'product_name': pname, 'stock': new_stock[bs_id]})
+    return warnings
+
 @app.route('/api/invoices', methods=['GET'])
 def get_invoices():
     """جلب الفواتير مع إمكانية التصفية"""
@@ -3313,13 +4151,9 @@ def get_invoices():
         query = 'SELECT * FROM invoices WHERE 1=1'
         params = []
         
-        if start_date:
-            query += ' AND date(created_at) >= ?'
-            params.append(start_date)
-        
-        if end_date:
-            query += ' AND date(created_at) <= ?'
-            params.append(end_date)
+        date_sql, date_params = sql_date_range('created_at', start_date, end_date)
+        query += date_sql
+        params.extend(date_params)
         
         query += ' ORDER BY created_at DESC LIMIT ?'
         params.append(limit)
@@ -3404,15 +4238,14 @@ def create_invoice():
             if float(item.get('price', 0)) < 0 or int(item.get('quantity', 0)) <= 0:
                 return jsonify({'success': False, 'error': 'Invalid item: price must be >= 0 and quantity > 0'}), 400
 
+        db_path = get_tenant_db_path(get_tenant_slug())
         conn = get_db()
         cursor = conn.cursor()
 
         # الحصول على اسم الفرع
         branch_id = data.get('branch_id', 1)
-        cursor.execute('SELECT name FROM branches WHERE id = ?', (branch_id,))
-        branch = cursor.fetchone()
-        branch_name = branch['name'] if branch else 'الفرع الرئيسي'
-        
+        branch_name = name_cache.get(conn, db_path, 'branches', branch_id) or 'الفرع الرئيسي'
+
         # تعديل رقم الفاتورة ليشمل رقم الفرع (مثل: AHM-001-B1)
         original_invoice_number = data.get('invoice_number', '')
         invoice_number_with_branch = f"{original_invoice_number}-B{branch_id}"
@@ -3425,11 +4258,11 @@ def create_invoice():
 
         # جلب اسم الشفت إن وجد
         shift_id = data.get('shift_id')
-        shift_name = ''
-        if shift_id:
-            cursor.execute('SELECT name FROM shifts WHERE id = ?', (shift_id,))
-            shift_row = cursor.fetchone()
-            shift_name = shift_row['name'] if shift_row else ''
+        shift_name = (name_cache.get(conn, db_path, 'shifts', shift_id) or '') if shift_id else ''
+
+        # عمليات الدفع المتعددة تُحفظ كـ JSON في transaction_number ضمن نفس الإدراج
+        payments = data.get('payments', [])
+        transaction_number = json.dumps(payments, ensure_ascii=False) if payments else data.get('transaction_number', '')
 
         # إدراج الفاتورة
         cursor.execute('''
@@ -3451,7 +4284,7 @@ def create_invoice():
             data.get('payment_method', 'نقداً'),
             data.get('employee_name', ''),
             data.get('notes', ''),
-            data.get('transaction_number', ''),
+            transaction_number,
             branch_id,
             branch_name,
             data.get('delivery_fee', 0),
@@ -3474,16 +4307,14 @@ def create_invoice():
             cursor.execute('UPDATE restaurant_tables SET status = ?, current_invoice_id = ? WHERE id = ?',
                            ('occupied', invoice_id, table_id))
 
-        # إدراج عناصر الفاتورة وتحديث المخزون
-        for item in data.get('items', []):
+        # إدراج عناصر الفاتورة دفعة واحدة ثم خصم المخزون بجملة تعيد الأرصدة الجديدة
+        item_rows = []
+        sold = []
+        fallback_names = {}
+        for item in items:
             # الحصول على branch_stock_id
             branch_stock_id = item.get('branch_stock_id') or item.get('product_id')
-            
-            cursor.execute('''
-                INSERT INTO invoice_items
-                (invoice_id, product_id, product_name, quantity, price, total, branch_stock_id, variant_id, variant_name)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
+            item_rows.append((
                 invoice_id,
                 item.get('product_id'),
                 item.get('product_name'),
@@ -3494,21 +4325,19 @@ def create_invoice():
                 item.get('variant_id'),
                 item.get('variant_name')
             ))
-            
-            # تحديث المخزون في branch_stock
             if branch_stock_id:
-                cursor.execute('''
-                    UPDATE branch_stock 
-                    SET stock = stock - ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (item.get('quantity'), branch_stock_id))
-        
-        # حفظ عمليات الدفع المتعددة كـ JSON
-        payments = data.get('payments', [])
-        if payments:
-            import json as json_mod
-            payments_json = json_mod.dumps(payments, ensure_ascii=False)
-            cursor.execute('UPDATE invoices SET transaction_number = ? WHERE id = ?', (payments_json, invoice_id))
+                sold.append((branch_stock_id, int(item.get('quantity'))))
+                # المعرف قد يصل نصاً من JSON، ومفاتيح الأرصدة العائدة أعداد صحيحة
+                fallback_names.setdefault(int(branch_stock_id), item.get('product_name', ''))
+        cursor.executemany('''
+            INSERT INTO invoice_items
+            (invoice_id, product_id, product_name, quantity, price, total, branch_stock_id, variant_id, variant_name)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', item_rows)
+        new_stock = {}
+        if sold:
+            with stock_movement_reason(cursor, 'sale', invoice_id):
+                new_stock = decrement_branch_stock(cursor, sold)
 
         # تحديث نقاط الولاء للعميل
         customer_id = data.get('customer_id')
@@ -3524,32 +4353,11 @@ def create_invoice():
 
         conn.commit()
 
-        # فحص المنتجات منخفضة المخزون بعد البيع
+        # فحص المنتجات منخفضة المخزون بعد البيع (الأرصدة من RETURNING - بلا استعلام لكل عنصر)
         low_stock_warnings = []
         try:
-            cursor.execute("SELECT value FROM settings WHERE key = 'low_stock_threshold'")
-            threshold_row = cursor.fetchone()
-            threshold = int(threshold_row['value']) if threshold_row else 5
-
-            for item in data.get('items', []):
-                bs_id = item.get('branch_stock_id') or item.get('product_id')
-                if bs_id:
-                    cursor.execute('''
-                        SELECT bs.stock, inv.name as product_name, pv.variant_name
-                        FROM branch_stock bs
-                        LEFT JOIN inventory inv ON inv.id = bs.inventory_id
-                        LEFT JOIN product_variants pv ON pv.id = bs.variant_id
-                        WHERE bs.id = ?
-                    ''', (bs_id,))
-                    row = cursor.fetchone()
-                    if row and row['stock'] <= threshold:
-                        pname = row['product_name'] or item.get('product_name', '')
-                        if row['variant_name']:
-                            pname += f" ({row['variant_name']})"
-                        low_stock_warnings.append({
-                            'product_name': pname,
-                            'stock': row['stock']
-                        })
+            threshold = tenant_settings(conn).get_int('low_stock_threshold', 5)
+            low_stock_warnings = low_stock_warnings_for(cursor, new_stock, threshold, fallback_names)
         except Exception as e:
             print(f"[LowStock] Warning check error: {e}")
 
@@ -3602,19 +4410,6 @@ def cancel_invoice(invoice_id):
         conn = get_db()
         cursor = conn.cursor()
 
-        # إضافة الأعمدة إذا لم تكن موجودة
-        for col_sql in [
-            "ALTER TABLE invoices ADD COLUMN cancelled INTEGER DEFAULT 0",
-            "ALTER TABLE invoices ADD COLUMN cancel_reason TEXT",
-            "ALTER TABLE invoices ADD COLUMN cancelled_at TIMESTAMP",
-            "ALTER TABLE invoices ADD COLUMN stock_returned INTEGER DEFAULT 0"
-        ]:
-            try:
-                cursor.execute(col_sql)
-                conn.commit()
-            except:
-                pass
-
         # التحقق من الفاتورة
         cursor.execute('SELECT * FROM invoices WHERE id = ?', (invoice_id,))
         invoice = cursor.fetchone()
@@ -3632,15 +4427,16 @@ def cancel_invoice(invoice_id):
         if return_stock:
             cursor.execute('SELECT * FROM invoice_items WHERE invoice_id = ?', (invoice_id,))
             items = cursor.fetchall()
-            for item in items:
-                bsid = item['branch_stock_id']
-                qty = item['quantity']
-                if bsid and qty:
-                    cursor.execute('''
-                        UPDATE branch_stock
-                        SET stock = stock + ?, updated_at = CURRENT_TIMESTAMP
-                        WHERE id = ?
-                    ''', (qty, bsid))
+            with stock_movement_reason(cursor, 'invoice_cancel', invoice_id):
+                for item in items:
+                    bsid = item['branch_stock_id']
+                    qty = item['quantity']
+                    if bsid and qty:
+                        cursor.execute('''
+                            UPDATE branch_stock
+                            SET stock = stock + ?, updated_at = CURRENT_TIMESTAMP
+                            WHERE id = ?
+                        ''', (qty, bsid))
             stock_returned = 1
 
         # تحديث الفاتورة
@@ -3725,19 +4521,20 @@ def add_damaged_item():
             data.get('reason', ''),
             data.get('reported_by')
         ))
+        damaged_id = cursor.lastrowid
         
         # تحديث المخزون (خصم التالف)
-        cursor.execute('''
-            UPDATE branch_stock 
-            SET stock = stock - ?
-            WHERE inventory_id = ? AND branch_id = ?
-        ''', (
-            data.get('quantity'),
-            data.get('inventory_id'),
-            data.get('branch_id')
-        ))
+        with stock_movement_reason(cursor, 'damage', damaged_id):
+            cursor.execute('''
+                UPDATE branch_stock 
+                SET stock = stock - ?
+                WHERE inventory_id = ? AND branch_id = ?
+            ''', (
+                data.get('quantity'),
+                data.get('inventory_id'),
+                data.get('branch_id')
+            ))
         
-        damaged_id = cursor.lastrowid
         conn.commit()
         conn.close()
         
@@ -3836,6 +4633,457 @@ def add_system_log():
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
 
+# ===== ملخص المبيعات اليومي =====
+# daily_sales_rollup تحدّثه triggers على invoices (migration 007) داخل نفس المعاملة
+# التقارير تجمع الصفوف اليومية بدل إعادة تجميع كل الفواتير
+
+SALES_ROLLUP_MIGRATION = '007_daily_sales_rollup.py'
+SALES_ROLLUP_TOLERANCE = 0.005
+
+def rebuild_sales_rollup(db_path):
+    """إعادة بناء daily_sales_rollup من جدول الفواتير - يُرجع عدد الصفوف"""
+    rollup = load_python_migration(SALES_ROLLUP_MIGRATION)
+    conn = sqlite3.connect(db_path)
+    try:
+        rollup.rebuild(conn.cursor())
+        conn.commit()
+        return conn.execute('SELECT COUNT(*) FROM daily_sales_rollup').fetchone()[0]
+    finally:
+        conn.close()
+
+def check_sales_rollup(db_path):
+    """مقارنة daily_sales_rollup بالفواتير الفعلية - يُرجع قائمة الفروقات (فارغة = متطابق)"""
+    rollup = load_python_migration(SALES_ROLLUP_MIGRATION)
+    columns = ('invoice_count',) + rollup.AMOUNT_COLUMNS
+    key_names = [k.strip() for k in rollup.KEY_COLUMNS.split(',')]
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.cursor()
+        sums = ', '.join(f'SUM(COALESCE(i.{c}, 0))' for c in rollup.AMOUNT_COLUMNS)
+        cursor.execute(f'''SELECT {rollup.key_values('i')}, COUNT(*), {sums}
+            FROM invoices i GROUP BY 1, 2, 3, 4, 5, 6''')
+        expected = {tuple(row[:6]): row[6:] for row in cursor.fetchall()}
+        cursor.execute(f'''SELECT {rollup.KEY_COLUMNS}, {', '.join(columns)}
+            FROM daily_sales_rollup WHERE invoice_count != 0''')
+        actual = {tuple(row[:6]): row[6:] for row in cursor.fetchall()}
+    finally:
+        conn.close()
+
+    zeros = (0,) * len(columns)
+    mismatches = []
+    for key in sorted(set(expected) | set(actual), key=str):
+        for column, want, got in zip(columns, expected.get(key, zeros), actual.get(key, zeros)):
+            if abs((want or 0) - (got or 0)) > SALES_ROLLUP_TOLERANCE:
+                mismatches.append({
+                    **dict(zip(key_names, key)),
+                    'column': column, 'expected': want, 'actual': got
+                })
+    return mismatches
+
+def iter_database_paths(tenant_slug=None):
+    """قواعد البيانات المستهدفة بأوامر الصيانة: مستأجر واحد أو الافتراضية + كل المستأجرين"""
+    if tenant_slug:
+        yield tenant_slug, get_tenant_db_path(tenant_slug)
+        return
+    yield 'default', DB_PATH
+    if os.path.exists(TENANTS_DB_DIR):
+        for f in sorted(os.listdir(TENANTS_DB_DIR)):
+            if f.endswith('.db'):
+                yield f[:-3], os.path.join(TENANTS_DB_DIR, f)
+
+@app.cli.command('rebuild-sales-rollup')
+@click.option('--tenant', default=None, help='slug المستأجر (الافتراضي: الكل)')
+def rebuild_sales_rollup_command(tenant):
+    """إعادة بناء daily_sales_rollup من الفواتير"""
+    for name, db_path in iter_database_paths(tenant):
+        started = time.perf_counter()
+        rows = rebuild_sales_rollup(db_path)
+        click.echo(f'{name}: {rows} rows in {time.perf_counter() - started:.2f}s')
+
+@app.cli.command('check-sales-rollup')
+@click.option('--tenant', default=None, help='slug المستأجر (الافتراضي: الكل)')
+def check_sales_rollup_command(tenant):
+    """فحص تطابق daily_sales_rollup مع الفواتير (exit code 1 عند وجود فروقات)"""
+    failed = False
+    for name, db_path in iter_database_paths(tenant):
+        mismatches = check_sales_rollup(db_path)
+        if not mismatches:
+            click.echo(f'{name}: OK')
+            continue
+        failed = True
+        click.echo(f'{name}: {len(mismatches)} mismatches')
+        for m in mismatches[:20]:
+            click.echo(f'  {m}')
+    if failed:
+        raise SystemExit(1)
+
+def _seed_invoice_bench(db_path, products):
+    """منتجات وفرع ووردية لقاعدة القياس - تعيد معرفات branch_stock ومعرف الوردية"""
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.cursor()
+        stock_ids = []
+        for n in range(products):
+            cursor.execute('INSERT INTO inventory (name, price, cost) VALUES (?, ?, ?)', (f'Bench {n}', 2.5, 1.0))
+            cursor.execute('INSERT INTO branch_stock (inventory_id, branch_id, stock) VALUES (?, 1, ?)',
+                           (cursor.lastrowid, 10 ** 9))
+            stock_ids.append(cursor.lastrowid)
+        cursor.execute("INSERT INTO shifts (name, start_time, end_time) VALUES ('Bench', '00:00', '23:59')")
+        shift_id = cursor.lastrowid
+        conn.commit()
+        return stock_ids, shift_id
+    finally:
+        conn.close()
+
+@contextmanager
+def bench_tenant(upgrade=True):
+    """مستأجر مؤقت لأوامر القياس - يُحذف مع ملفاته وذاكرته المؤقتة عند الانتهاء
+    upgrade=False: يبقى بمخطط create_tenant_database (user_version 0) كقاعدة قديمة"""
+    slug = f'bench-{secrets.token_hex(4)}'
+    db_path = get_tenant_db_path(slug)
+    try:
+        create_tenant_database(slug)
+        if upgrade:
+            ensure_db_tables(db_path)
+        yield slug, db_path
+    finally:
+        db_pool.discard(db_path)
+        _initialized_dbs.discard(db_path)
+        settings_cache.invalidate(db_path)
+        name_cache.invalidate(db_path)
+        for suffix in ('', '-wal', '-shm', '.migrate.lock'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+def bench_call(slug, view, path, method='GET', json=None, view_args=None):
+    """استدعاء معالج داخل سياق طلب للمستأجر - يُرجع (الزمن بالثواني، JSON الاستجابة)"""
+    with app.test_request_context(path, method=method, json=json, headers={'X-Tenant-ID': slug}):
+        started = time.perf_counter()
+        response = make_response(view(**(view_args or {})))
+        elapsed = time.perf_counter() - started
+    body = response.get_json()
+    if response.status_code != 200 or not body.get('success'):
+        raise click.ClickException(f'{path} failed: {response.status_code} {body}')
+    return elapsed, body
+
+def latency_summary(latencies):
+    """p50 و p99 بالمللي ثانية"""
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    return f'p50 {p50:7.2f}ms  p99 {p99:7.2f}ms'
+
+@app.cli.command('bench-invoices')
+@click.option('--invoices', default=300, help='عدد الفواتير لكل حجم سلة')
+@click.option('--items', default='1,10,100', help='أحجام السلال مفصولة بفواصل')
+def bench_invoices_command(invoices, items):
+    """قياس create_invoice على قاعدة مؤقتة: فاتورة/ثانية و p50/p99 لكل حجم سلة"""
+    sizes = [int(n) for n in items.split(',') if n.strip()]
+    with bench_tenant() as (slug, db_path):
+        stock_ids, shift_id = _seed_invoice_bench(db_path, max(sizes))
+        for size in sizes:
+            payload = {
+                'branch_id': 1, 'shift_id': shift_id, 'employee_name': 'bench',
+                'subtotal': 2.5 * size, 'total': 2.5 * size, 'payment_method': 'نقداً',
+                'payments': [{'method': 'نقداً', 'amount': 2.5 * size}],
+                'items': [{'branch_stock_id': stock_id, 'product_name': f'Bench {n}', 'quantity': 1,
+                           'price': 2.5, 'total': 2.5} for n, stock_id in enumerate(stock_ids[:size])],
+            }
+            latencies = []
+            for n in range(invoices):
+                payload['invoice_number'] = f'BENCH-{size}-{n}'
+                latencies.append(bench_call(slug, create_invoice, '/api/invoices', 'POST', payload)[0])
+            click.echo(f'{size:>4} items: {len(latencies) / sum(latencies):8.1f} invoices/s'
+                       f'  {latency_summary(latencies)}')
+
+def _bench_variants_per_product(cursor, products):
+    """حلقة get_products القديمة (خط الأساس للقياس): استعلام لكل منتج ثم إعادة مسح القائمة كلها"""
+    seen_inv = set()
+    for p in products:
+        inv_id = p.get('inventory_id')
+        if inv_id and inv_id not in seen_inv:
+            cursor.execute('SELECT * FROM product_variants WHERE inventory_id = ? ORDER BY id', (inv_id,))
+            variants = [dict_from_row(row) for row in cursor.fetchall()]
+            for pp in products:
+                if pp.get('inventory_id') == inv_id:
+                    pp['variants'] = variants
+            seen_inv.add(inv_id)
+
+@app.cli.command('bench-products')
+@click.option('--rows', default='1000,10000,50000', help='أعداد صفوف branch_stock مفصولة بفواصل')
+@click.option('--variants', default=2, help='عدد المتغيرات لكل منتج')
+@click.option('--runs', default=5, help='عدد مرات الاستدعاء لكل حجم')
+def bench_products_command(rows, variants, runs):
+    """قياس GET /api/products (مع تحميل المتغيرات) على قاعدة مؤقتة لكل عدد صفوف"""
+    for size in [int(n) for n in rows.split(',') if n.strip()]:
+        with bench_tenant() as (slug, db_path):
+            conn = sqlite3.connect(db_path)
+            cursor = conn.cursor()
+            for n in range(size):
+                cursor.execute('INSERT INTO inventory (name, price, cost) VALUES (?, 2.5, 1.0)', (f'Bench {n}',))
+                inventory_id = cursor.lastrowid
+                cursor.executemany('INSERT INTO product_variants (inventory_id, variant_name, price) VALUES (?, ?, 2.5)',
+                                   [(inventory_id, f'V{v}') for v in range(variants)])
+                cursor.execute('INSERT INTO branch_stock (inventory_id, branch_id, stock) VALUES (?, 1, 10)',
+                               (inventory_id,))
+            conn.commit()
+            conn.close()
+            latencies = []
+            for _ in range(runs):
+                elapsed, body = bench_call(slug, get_products, '/api/products?branch_id=1')
+                latencies.append(elapsed)
+            # خطوة تحميل المتغيرات وحدها (كانت استعلاماً لكل منتج)
+            conn = sqlite3.connect(db_path)
+            conn.row_factory = sqlite3.Row
+            variant_latencies = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                load_branch_variants(conn.cursor(), 1)
+                variant_latencies.append(time.perf_counter() - started)
+            # خط الأساس مرة واحدة: الحلقة القديمة تربيعية (دقيقتان تقريباً عند 50 ألف صف)
+            started = time.perf_counter()
+            _bench_variants_per_product(conn.cursor(), [dict(p) for p in body['products']])
+            baseline = time.perf_counter() - started
+            conn.close()
+            click.echo(f'{size:>7} rows: {len(body["products"])} products  request {latency_summary(latencies)}'
+                       f'  variants step {latency_summary(variant_latencies)}'
+                       f'  per-product loop (before) {baseline * 1000:9.2f}ms')
+
+@app.cli.command('bench-sync-upload')
+@click.option('--invoices', default=10000, help='عدد الفواتير في طلب الرفع')
+@click.option('--items', default=3, help='عدد البنود لكل فاتورة')
+@click.option('--existing', default=0, help='عدد الفواتير الموجودة مسبقاً في القاعدة')
+@click.option('--stock-rows', default=300, help='عدد صفوف branch_stock')
+def bench_sync_upload_command(invoices, items, existing, stock_rows):
+    """قياس POST /api/sync/upload لدفعة واحدة من الفواتير على قاعدة مؤقتة"""
+    with bench_tenant() as (slug, db_path):
+        stock_ids, shift_id = _seed_invoice_bench(db_path, stock_rows)
+        if existing:
+            conn = sqlite3.connect(db_path)
+            conn.executemany('''INSERT INTO invoices (invoice_number, total, branch_id, created_at)
+                VALUES (?, 7.5, 1, '2026-01-01 10:00:00')''', ((f'OLD-{n}',) for n in range(existing)))
+            conn.commit()
+            conn.close()
+        payload = {'customers': [], 'invoices': [{
+            'invoice_number': f'SYNC-{n}', 'branch_id': 1, 'shift_id': shift_id, 'employee_name': 'bench',
+            'subtotal': 2.5 * items, 'total': 2.5 * items, 'payment_method': 'نقداً',
+            'created_at': f'2026-02-01 10:{n // 60 % 60:02d}:{n % 60:02d}',
+            'items': [{'branch_stock_id': stock_ids[(n + i) % len(stock_ids)], 'product_name': f'Bench {i}',
+                       'quantity': 1, 'price': 2.5, 'total': 2.5} for i in range(items)],
+        } for n in range(invoices)]}
+        elapsed, body = bench_call(slug, sync_upload, '/api/sync/upload', 'POST', payload)
+        results = body['results']
+        click.echo(f'{invoices} invoices x {items} items, {existing} existing: {elapsed:.2f}s'
+                   f'  ({results["invoices_synced"]} synced, {len(results["errors"])} errors)')
+
+@app.cli.command('bench-permissions')
+@click.option('--calls', default=20000, help='عدد الاستدعاءات لكل مسار')
+def bench_permissions_command(calls):
+    """قياس كلفة require_permission لكل استدعاء: بدون المزخرف، قراءة صف users، bitmap التوكن"""
+    with bench_tenant() as (slug, db_path):
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO users (username, password, full_name, role, is_active, branch_id, can_view_reports)
+            VALUES ('bench-cashier', '', 'Bench', 'cashier', 1, 1, 1)''')
+        user = {'id': cursor.lastrowid, 'username': 'bench-cashier', 'role': 'cashier', 'can_view_reports': 1}
+        conn.commit()
+        conn.close()
+
+        def view():
+            return None
+
+        guarded = require_permission('can_view_reports')(view)
+        token_user = jwt.decode(generate_auth_token(user, slug), get_auth_secret(), algorithms=['HS256'])
+        legacy_user = {k: v for k, v in token_user.items() if k not in ('perms', 'pv')}
+        with app.test_request_context('/api/bench', headers={'X-Tenant-ID': slug}):
+            for label, func, current_user in (('bare view', view, token_user),
+                                              ('users-row lookup', guarded, legacy_user),
+                                              ('token bitmap', guarded, token_user)):
+                request.current_user = current_user
+                func()  # تسخين: فتح الاتصال وتحميل pv
+                started = time.perf_counter()
+                for _ in range(calls):
+                    if func() is not None:
+                        raise click.ClickException(f'{label}: permission denied')
+                click.echo(f'{label:<18} {(time.perf_counter() - started) / calls * 1e6:8.2f} us/call')
+
+@app.cli.command('bench-schema-gate')
+@click.option('--tenants', default=100, help='عدد قواعد المستأجرين المؤقتة')
+def bench_schema_gate_command(tenants):
+    """قياس بوابة المخطط: الترقية الكسولة لقاعدة قديمة، فحص قاعدة محدثة، وزمن import server"""
+    with ExitStack() as stack:
+        paths = [stack.enter_context(bench_tenant(upgrade=False))[1] for _ in range(tenants)]
+        # ترقية كل القواعد القديمة (ما يفعله migrate-tenants بعامل واحد)
+        latencies = []
+        for db_path in paths:
+            started = time.perf_counter()
+            ensure_db_tables(db_path)
+            latencies.append(time.perf_counter() - started)
+        click.echo(f'lazy upgrade, stale tenant  {latency_summary(latencies)}  all {tenants}: {sum(latencies):.2f}s')
+        # أول طلب في عامل جديد لقاعدة محدثة: قراءة user_version فقط
+        latencies = []
+        for db_path in paths:
+            _initialized_dbs.discard(db_path)
+            started = time.perf_counter()
+            ensure_db_tables(db_path)
+            latencies.append(time.perf_counter() - started)
+        click.echo(f'gate, tenant up to date     {latency_summary(latencies)}  all {tenants}: {sum(latencies):.2f}s')
+        # import في عملية جديدة مع وجود القواعد على القرص (لا تُفتح عند الاستيراد)
+        started = time.perf_counter()
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        subprocess.run([sys.executable, '-c', 'import server'], check=True, env=env, capture_output=True)
+        click.echo(f'import server               {time.perf_counter() - started:.2f}s')
+
+@app.cli.command('bench-backups')
+@click.option('--size-mb', default=100, help='حجم قاعدة القياس التقريبي بالميجابايت')
+@click.option('--nights', default=7, help='عدد النسخ الليلية')
+@click.option('--new-invoices', default=3000, help='فواتير جديدة كل ليلة')
+@click.option('--updates', default=500, help='فواتير قديمة عشوائية تُعدل كل ليلة')
+def bench_backups_command(size_mb, nights, new_invoices, updates):
+    """مقارنة النسخ الكاملة باللقطات المجزأة: المساحة على القرص والزمن، ثم زمن الاستعادة"""
+    rng = random.Random(1)
+    with bench_tenant() as (slug, db_path), tempfile.TemporaryDirectory() as work:
+        conn = sqlite3.connect(db_path)
+
+        def add_invoices(count):
+            conn.executemany('''INSERT INTO invoices (invoice_number, total, branch_id, notes, created_at)
+                VALUES (?, 10, 1, ?, CURRENT_TIMESTAMP)''',
+                             ((f'BK-{secrets.token_hex(6)}', secrets.token_hex(rng.randint(50, 400)))
+                              for _ in range(count)))
+            conn.commit()
+
+        while os.path.getsize(db_path) < size_mb * 1024 * 1024:
+            add_invoices(5000)
+        click.echo(f'database: {os.path.getsize(db_path) / 1e6:.1f}MB')
+
+        full_dir = os.path.join(work, 'full')
+        snap_dir = os.path.join(work, 'snapshots')
+        os.makedirs(full_dir)
+        full_time = snap_time = 0
+        snapshot = None
+        for night in range(nights):
+            if night:
+                add_invoices(new_invoices)
+                max_id = conn.execute('SELECT MAX(id) FROM invoices').fetchone()[0]
+                conn.executemany('UPDATE invoices SET notes = ? WHERE id = ?',
+                                 ((secrets.token_hex(100), rng.randint(1, max_id)) for _ in range(updates)))
+                conn.commit()
+            # النسخة الكاملة القديمة: نسخ الملف كله بـ backup API
+            started = time.perf_counter()
+            dest = sqlite3.connect(os.path.join(full_dir, f'night{night}.db'))
+            conn.backup(dest)
+            dest.close()
+            full_time += time.perf_counter() - started
+
+            started = time.perf_counter()
+            snapshot = backup_store.create_snapshot(db_path, snap_dir, chunk_size=BACKUP_CHUNK_SIZE,
+                                                    codec=BACKUP_CODEC, source=slug)
+            snap_time += time.perf_counter() - started
+        conn.close()
+
+        full_disk = sum(os.path.getsize(os.path.join(full_dir, f)) for f in os.listdir(full_dir))
+        snap_disk = backup_store.store_usage(snap_dir) + sum(
+            os.path.getsize(os.path.join(snap_dir, f)) for f in backup_store.list_snapshots(snap_dir))
+        click.echo(f'full copies  {full_disk / 1e6:8.1f}MB on disk  {full_time:6.2f}s total')
+        click.echo(f'snapshots    {snap_disk / 1e6:8.1f}MB on disk  {snap_time:6.2f}s total')
+        started = time.perf_counter()
+        backup_store.materialize(snap_dir, snapshot['filename'], os.path.join(work, 'restored.db'))
+        click.echo(f'restore of the last snapshot: {time.perf_counter() - started:.2f}s')
+
+# ===== سجل حركات المخزون =====
+# stock_movements تكتبه triggers على branch_stock (migration 012) داخل نفس المعاملة
+# لقطة لكل فرع كل أسبوع، فالمخزون في أي لحظة = آخر لقطة قبلها + الحركات بعدها
+
+@contextmanager
+def stock_movement_reason(cursor, reason, ref_id=None):
+    """وسم تغييرات branch_stock داخل الكتلة بسبب ومرجع (فاتورة، تحويل...) في stock_movements"""
+    cursor.execute('INSERT OR REPLACE INTO stock_movement_context (id, reason, ref_id) VALUES (1, ?, ?)',
+                   (reason, ref_id))
+    try:
+        yield
+    finally:
+        cursor.execute('DELETE FROM stock_movement_context WHERE id = 1')
+
+def parse_stock_as_of(value):
+    """as_of من الطلب بصيغة created_at: تاريخ فقط = نهاية اليوم (None إذا كان غير صالح)"""
+    value = str(value or '').strip()
+    try:
+        if len(value) <= 10:
+            return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d 23:59:59')
+        return datetime.fromisoformat(value.replace('Z', '')).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+
+def stock_as_of(cursor, branch_id, as_of):
+    """مخزون فرع في لحظة as_of: {branch_stock_id: {inventory_id, variant_id, stock}}
+    None إذا لم تكن للفرع لقطة قبل as_of (لا سجل قبل بدء الدفتر)"""
+    cursor.execute('''SELECT id, last_movement_id FROM stock_snapshots
+        WHERE branch_id IS ? AND taken_at <= ? ORDER BY taken_at DESC, id DESC LIMIT 1''', (branch_id, as_of))
+    snapshot = cursor.fetchone()
+    if not snapshot:
+        return None
+    cursor.execute('''SELECT branch_stock_id, inventory_id, variant_id, stock
+        FROM stock_snapshot_items WHERE snapshot_id = ?''', (snapshot['id'],))
+    stock = {row['branch_stock_id']: {'inventory_id': row['inventory_id'], 'variant_id': row['variant_id'],
+                                      'stock': row['stock'] or 0}
+             for row in cursor.fetchall()}
+
+    # الحركات بعد اللقطة - اللقطة التالية تحدّ المسح من الأعلى
+    query = '''SELECT branch_stock_id, inventory_id, variant_id, SUM(delta) AS delta
+        FROM stock_movements WHERE branch_id IS ? AND id > ? AND created_at <= ?'''
+    params = [branch_id, snapshot['last_movement_id'], as_of]
+    cursor.execute('''SELECT MIN(last_movement_id) FROM stock_snapshots
+        WHERE branch_id IS ? AND taken_at > ?''', (branch_id, as_of))
+    upper = cursor.fetchone()[0]
+    if upper is not None:
+        query += ' AND id <= ?'
+        params.append(upper)
+    cursor.execute(query + ' GROUP BY branch_stock_id', params)
+    for row in cursor.fetchall():
+        entry = stock.setdefault(row['branch_stock_id'], {
+            'inventory_id': row['inventory_id'], 'variant_id': row['variant_id'], 'stock': 0})
+        entry['stock'] += row['delta']
+    for entry in stock.values():
+        if float(entry['stock']).is_integer():
+            entry['stock'] = int(entry['stock'])
+    return stock
+
+def check_stock_ledger(db_path):
+    """مقارنة SUM(delta) لكل صف branch_stock بمخزونه الحالي - يُرجع قائمة الفروقات (فارغة = متطابق)"""
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT branch_stock_id, SUM(delta) FROM stock_movements GROUP BY 1')
+        ledger = dict(cursor.fetchall())
+        cursor.execute('SELECT id, IFNULL(stock, 0) FROM branch_stock')
+        live = dict(cursor.fetchall())
+    finally:
+        conn.close()
+
+    mismatches = []
+    for branch_stock_id in sorted(set(ledger) | set(live)):
+        want, got = live.get(branch_stock_id, 0), ledger.get(branch_stock_id, 0)
+        if abs(want - got) > SALES_ROLLUP_TOLERANCE:
+            mismatches.append({'branch_stock_id': branch_stock_id, 'stock': want, 'ledger': got})
+    return mismatches
+
+@app.cli.command('check-stock-ledger')
+@click.option('--tenant', default=None, help='slug المستأجر (الافتراضي: الكل)')
+def check_stock_ledger_command(tenant):
+    """فحص تطابق stock_movements مع branch_stock (exit code 1 عند وجود فروقات)"""
+    failed = False
+    for name, db_path in iter_database_paths(tenant):
+        mismatches = check_stock_ledger(db_path)
+        if not mismatches:
+            click.echo(f'{name}: OK')
+            continue
+        failed = True
+        click.echo(f'{name}: {len(mismatches)} mismatches')
+        for m in mismatches[:20]:
+            click.echo(f'  {m}')
+    if failed:
+        raise SystemExit(1)
+
 # ===== API التقارير =====
 
 @app.route('/api/reports/sales', methods=['GET'])
@@ -3849,27 +5097,23 @@ def sales_report():
         conn = get_db()
         cursor = conn.cursor()
         
-        # الإحصائيات العامة
+        # الإحصائيات العامة (من الملخص اليومي)
         query = '''
             SELECT 
-                COUNT(*) as total_invoices,
+                COALESCE(SUM(invoice_count), 0) as total_invoices,
                 SUM(subtotal) as total_subtotal,
                 SUM(discount) as total_discount,
                 SUM(delivery_fee) as total_delivery,
                 SUM(total) as total_sales,
-                AVG(total) as average_sale
-            FROM invoices
+                SUM(total) / NULLIF(SUM(invoice_count), 0) as average_sale
+            FROM daily_sales_rollup
             WHERE 1=1
         '''
         params = []
         
-        if start_date:
-            query += ' AND date(created_at) >= ?'
-            params.append(start_date)
-        
-        if end_date:
-            query += ' AND date(created_at) <= ?'
-            params.append(end_date)
+        rollup_sql, date_params = sql_date_range('day', start_date, end_date)
+        query += rollup_sql
+        params.extend(date_params)
         
         if branch_id:
             # البحث بـ branch_id أو branch_name
@@ -3894,15 +5138,12 @@ def sales_report():
         
         # تقرير حسب طريقة الدفع
         query_payment = '''
-            SELECT payment_method, COUNT(*) as count, SUM(total) as total
-            FROM invoices
+            SELECT NULLIF(payment_method, '') as payment_method, SUM(invoice_count) as count, SUM(total) as total
+            FROM daily_sales_rollup
             WHERE 1=1
         '''
         
-        if start_date:
-            query_payment += ' AND date(created_at) >= ?'
-        if end_date:
-            query_payment += ' AND date(created_at) <= ?'
+        query_payment += rollup_sql
         if branch_id:
             query_payment += ' AND branch_name LIKE ?'
         
@@ -3913,15 +5154,12 @@ def sales_report():
         
         # تقرير حسب الفرع
         query_branch = '''
-            SELECT branch_name, COUNT(*) as count, SUM(total) as total
-            FROM invoices
-            WHERE branch_name IS NOT NULL
+            SELECT branch_name, SUM(invoice_count) as count, SUM(total) as total
+            FROM daily_sales_rollup
+            WHERE branch_name != ''
         '''
         
-        if start_date:
-            query_branch += ' AND date(created_at) >= ?'
-        if end_date:
-            query_branch += ' AND date(created_at) <= ?'
+        query_branch += rollup_sql
         if branch_id:
             query_branch += ' AND branch_name LIKE ?'
         
@@ -3936,10 +5174,7 @@ def sales_report():
             WHERE 1=1
         '''
         
-        if start_date:
-            query_invoices += ' AND date(created_at) >= ?'
-        if end_date:
-            query_invoices += ' AND date(created_at) <= ?'
+        query_invoices += sql_date_range('created_at', start_date, end_date)[0]
         if branch_id:
             query_invoices += ' AND branch_name LIKE ?'
         
@@ -3959,15 +5194,76 @@ def sales_report():
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
 
+def inventory_items_as_of(cursor, as_of, branch_id=None):
+    """صفوف تقرير المخزون في لحظة as_of من اللقطات (التكلفة الحالية) - None إذا سبقت بدء الدفتر"""
+    cursor.execute('SELECT MIN(taken_at) FROM stock_snapshots')
+    started = cursor.fetchone()[0]
+    if not started or as_of < started:
+        return None
+    if branch_id:
+        cursor.execute('SELECT DISTINCT branch_id FROM stock_snapshots WHERE branch_id = ?', (branch_id,))
+    else:
+        cursor.execute('SELECT DISTINCT branch_id FROM stock_snapshots')
+    branch_ids = [row[0] for row in cursor.fetchall()]
+
+    stock = []
+    for bid in branch_ids:
+        for entry in (stock_as_of(cursor, bid, as_of) or {}).values():
+            stock.append((bid, entry))
+
+    products = {}
+    for chunk in _sql_chunks({entry['inventory_id'] for _, entry in stock}):
+        cursor.execute(f'''SELECT id, name, barcode, category, price, cost FROM inventory
+            WHERE id IN ({','.join('?' * len(chunk))})''', chunk)
+        products.update((row['id'], dict_from_row(row)) for row in cursor.fetchall())
+    cursor.execute('SELECT id, name FROM branches')
+    branch_names = {row['id']: row['name'] for row in cursor.fetchall()}
+
+    items = []
+    for bid, entry in stock:
+        product = products.get(entry['inventory_id'])
+        if not product:
+            continue  # منتج محذوف
+        items.append({
+            **product,
+            'branch_id': bid,
+            'branch_name': branch_names.get(bid),
+            'stock': entry['stock'],
+            'stock_value': entry['stock'] * (product['cost'] or 0),
+        })
+    items.sort(key=lambda item: item['name'] or '')
+    return items
+
 @app.route('/api/reports/inventory', methods=['GET'])
 def inventory_report():
-    """تقرير المخزون"""
+    """تقرير المخزون - as_of=YYYY-MM-DD[ HH:MM:SS] يحسبه من لقطات سجل الحركات بدل المخزون الحالي"""
     try:
         branch_id = request.args.get('branch_id')
+        as_of = request.args.get('as_of')
         
         conn = get_db()
         cursor = conn.cursor()
         
+        if as_of:
+            as_of_ts = parse_stock_as_of(as_of)
+            if not as_of_ts:
+                conn.close()
+                return jsonify({'success': False, 'error': 'صيغة التاريخ غير صالحة'}), 400
+            items = inventory_items_as_of(cursor, as_of_ts, branch_id)
+            conn.close()
+            if items is None:
+                return jsonify({'success': False, 'error': 'لا يوجد سجل مخزون قبل هذا التاريخ'}), 400
+            return jsonify({
+                'success': True,
+                'report': {
+                    'as_of': as_of_ts,
+                    'total_items': len(items),
+                    'total_stock': sum(item['stock'] for item in items),
+                    'total_value': sum(item['stock_value'] or 0 for item in items),
+                    'items': items
+                }
+            })
+        
         # جلب المخزون مع الحسابات
         query = '''
             SELECT 
@@ -4042,13 +5338,9 @@ def damaged_report():
         '''
         params = []
         
-        if start_date:
-            query += ' AND date(d.created_at) >= ?'
-            params.append(start_date)
-        
-        if end_date:
-            query += ' AND date(d.created_at) <= ?'
-            params.append(end_date)
+        date_sql, date_params = sql_date_range('d.created_at', start_date, end_date)
+        query += date_sql
+        params.extend(date_params)
         
         if branch_id:
             query += ' AND d.branch_id = ?'
@@ -4163,18 +5455,101 @@ def negative_stock_report():
 
 # ===== API الإعدادات =====
 
+# مفاتيح لا تُرسل للعملاء (get_settings والمزامنة)
+SENSITIVE_SETTING_PREFIXES = ('gdrive_access_token', 'gdrive_refresh_token', 'gdrive_client_secret', 'auth_secret', 'license_token', 'license_secret')
+
+# ===== كاش الإعدادات لكل قاعدة =====
+# الإعدادات تُقرأ في مسارات ساخنة: حد المخزون بعد كل بيع، كل الجدول عند إقلاع كل نقطة بيع،
+# مفاتيح النسخ الاحتياطي و Google Drive. اللقطة تُحمّل مرة لكل قاعدة وتبقى صالحة ما دام ختمها
+# لم يتغير: محفزات change_log (migration 009) تجدد صف settings (row_id 0) مع أي كتابة على
+# settings من أي مسار أو عامل gunicorn، فالتحقق بحث واحد في فهرس فريد بدل قراءة الجدول.
+# (PRAGMA data_version يتغير مع كل فاتورة فلا يصلح ختماً للإعدادات.)
+# الكتّاب المعروفون يستدعون invalidate() أيضاً ليرى العامل الحالي التعديل دون انتظار الختم.
+
+SETTINGS_STAMP_SQL = "SELECT version, changed_at FROM change_log WHERE table_name = 'settings' AND row_id = 0"
+SETTINGS_TRUE_VALUES = ('true', '1', 'yes', 'on')
+
+class SettingsSnapshot(dict):
+    """إعدادات قاعدة واحدة {key: value} مع قراءات مُنمّطة - للقراءة فقط"""
+
+    def __init__(self, rows, stamp):
+        super().__init__(rows)
+        self.stamp = stamp
+
+    def get_str(self, key, default=''):
+        value = self.get(key)
+        return default if value is None else str(value)
+
+    def get_int(self, key, default=0):
+        try:
+            return int(self[key])
+        except (KeyError, TypeError, ValueError):
+            return default
+
+    def get_float(self, key, default=0.0):
+        try:
+            return float(self[key])
+        except (KeyError, TypeError, ValueError):
+            return default
+
+    def get_bool(self, key, default=False):
+        value = self.get(key)
+        if value is None:
+            return default
+        return str(value).strip().lower() in SETTINGS_TRUE_VALUES
+
+    def public(self):
+        """بدون المفاتيح الحساسة (لما يُرسل للعملاء)"""
+        return {k: v for k, v in self.items() if not k.startswith(SENSITIVE_SETTING_PREFIXES)}
+
+class SettingsCache(ProcessCache):
+    """لقطات الإعدادات داخل العملية لكل مسار قاعدة، تُتحقق بختم change_log عند كل قراءة"""
+
+    size_stat = 'databases'  # {db_path: SettingsSnapshot}، بدون TTL
+
+    @staticmethod
+    def _read_stamp(conn):
+        """(version, changed_at) لآخر كتابة على settings، () إن لم تُكتب بعد، None بدون change_log"""
+        try:
+            row = conn.execute(SETTINGS_STAMP_SQL).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return tuple(row) if row else ()
+
+    def get(self, db_path, conn=None):
+        """لقطة إعدادات القاعدة - conn اتصال مفتوح عليها إن وُجد (وإلا يُؤخذ من المجمع)"""
+        own_conn = conn is None
+        if own_conn:
+            conn = _checkout_connection(db_path)
+        try:
+            # الختم قبل الصفوف: كتابة بينهما تعني فقط إعادة تحميل في القراءة التالية
+            stamp = self._read_stamp(conn)
+            snapshot = self.lookup(db_path, lambda cached: stamp is not None and cached.stamp == stamp)
+            if snapshot is not None:
+                return snapshot
+            snapshot = SettingsSnapshot(
+                ((row[0], row[1]) for row in conn.execute('SELECT key, value FROM settings').fetchall()), stamp)
+        finally:
+            if own_conn:
+                conn.close()
+        if stamp is not None:
+            self.store(db_path, snapshot)
+        return snapshot
+
+settings_cache = SettingsCache()
+
+def tenant_settings(conn=None):
+    """لقطة إعدادات قاعدة الطلب الحالي (conn من get_db() إن كان مفتوحاً)"""
+    return settings_cache.get(get_tenant_db_path(get_tenant_slug()), conn)
+
 @app.route('/api/settings', methods=['GET'])
 def get_settings():
     """جلب جميع الإعدادات"""
     try:
         conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM settings')
-        settings = {row['key']: row['value'] for row in cursor.fetchall()}
-        conn.close()
         # Filter sensitive keys from response
-        sensitive_prefixes = ('gdrive_access_token', 'gdrive_refresh_token', 'gdrive_client_secret', 'auth_secret', 'license_token', 'license_secret')
-        filtered = {k: v for k, v in settings.items() if not k.startswith(sensitive_prefixes)}
+        filtered = tenant_settings(conn).public()
+        conn.close()
         return jsonify({'success': True, 'settings': filtered})
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
@@ -4197,7 +5572,8 @@ def update_settings():
         
         conn.commit()
         conn.close()
-        
+        settings_cache.invalidate(get_tenant_db_path(get_tenant_slug()))
+
         return jsonify({'success': True})
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
@@ -4227,11 +5603,7 @@ def add_branch():
         tenant_slug = get_tenant_slug()
         if tenant_slug:
             try:
-                m_conn = get_master_db()
-                m_cursor = m_conn.cursor()
-                m_cursor.execute('SELECT max_branches, mode FROM tenants WHERE slug = ?', (tenant_slug,))
-                t_row = m_cursor.fetchone()
-                m_conn.close()
+                t_row = tenant_registry.get(tenant_slug)
                 if t_row:
                     conn_check = get_db()
                     cur_check = conn_check.cursor()
@@ -4294,6 +5666,7 @@ def update_branch(branch_id):
             query = f"UPDATE branches SET {', '.join(updates)} WHERE id = ?"
             cursor.execute(query, params)
             conn.commit()
+            name_cache.invalidate(get_tenant_db_path(get_tenant_slug()), 'branches')
         
         conn.close()
         return jsonify({'success': True})
@@ -4333,29 +5706,58 @@ AVAILABLE_FEATURES = {
 }
 
 
+FEATURE_CACHE_TTL = float(os.environ.get('POS_FEATURE_CACHE_TTL', '60'))
+
+class TenantFeatureCache(ProcessCache):
+    """كاش ميزات المتاجر داخل العملية: استعلام واحد لكل متجر ثم قراءة من الذاكرة حتى انتهاء TTL
+    أو حتى invalidate() عند تعديل الميزات (العمّال الآخرون يلتقطون التعديل بعد TTL)"""
+
+    size_stat = 'tenants'
+
+    def __init__(self, ttl=FEATURE_CACHE_TTL):
+        super().__init__(ttl)  # {tenant_slug: {feature_key: bool}}
+        self._stats['errors'] = 0
+
+    def _load(self, tenant_slug):
+        conn = get_master_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT tf.feature_key, tf.enabled FROM tenant_features tf
+                JOIN tenants t ON t.id = tf.tenant_id
+                WHERE t.slug = ?
+            ''', (tenant_slug,))
+            return {row[0]: bool(row[1]) for row in cursor.fetchall()}
+        finally:
+            conn.close()
+
+    def get(self, tenant_slug):
+        """الإعدادات الخاصة بالمتجر {feature_key: enabled} - None عند فشل القراءة"""
+        now = time.monotonic()
+        flags = self.lookup(tenant_slug)
+        if flags is not None:
+            return flags
+        try:
+            flags = self._load(tenant_slug)
+        except Exception:
+            self.count('errors')
+            return None
+        self.store(tenant_slug, flags, now)
+        return flags
+
+feature_cache = TenantFeatureCache()
+
 def is_feature_enabled(tenant_slug, feature_key):
     """التحقق من تفعيل ميزة معينة لمتجر"""
     if not tenant_slug:
         return True  # القاعدة الافتراضية: كل الميزات مفعّلة
     if feature_key not in AVAILABLE_FEATURES:
         return True  # ميزات غير معرّفة تعتبر مفعّلة دائماً (core features)
-    try:
-        conn = get_master_db()
-        cursor = conn.cursor()
-        # أولاً: البحث عن إعداد خاص بالمتجر
-        cursor.execute('''
-            SELECT tf.enabled FROM tenant_features tf
-            JOIN tenants t ON t.id = tf.tenant_id
-            WHERE t.slug = ? AND tf.feature_key = ?
-        ''', (tenant_slug, feature_key))
-        row = cursor.fetchone()
-        conn.close()
-        if row:
-            return bool(row[0])
-        # إذا لم يوجد إعداد خاص: استخدم القيمة الافتراضية
-        return AVAILABLE_FEATURES[feature_key].get('default', True)
-    except Exception:
-        return AVAILABLE_FEATURES[feature_key].get('default', True)
+    # أولاً: الإعداد الخاص بالمتجر (من الكاش)، وإلا القيمة الافتراضية
+    flags = feature_cache.get(tenant_slug)
+    if flags and feature_key in flags:
+        return flags[feature_key]
+    return AVAILABLE_FEATURES[feature_key].get('default', True)
 
 
 def require_feature(feature_key):
@@ -4447,8 +5849,9 @@ def get_attendance():
             params.append(user_id)
         
         if date:
-            query += ' AND DATE(check_in) = ?'
-            params.append(date)
+            date_sql, date_params = sql_date_range('check_in', date, date)
+            query += date_sql
+            params.extend(date_params)
         
         if branch_id:
             query += ' AND branch_id = ?'
@@ -4466,36 +5869,75 @@ def get_attendance():
 
 # ===== API العملاء (CRM) =====
 
+# إحصائيات العملاء (عدد الطلبات والمبلغ) بـ LEFT JOIN واحد على صفحة العملاء فقط بدل
+# استعلامين فرعيين لكل صف. فهرس invoices(customer_id, total) يغطي COUNT و SUM (migration 010).
+CUSTOMERS_MAX_PAGE_SIZE = 500
+
+def _customer_prefix_bounds(prefix):
+    """[prefix, prefix+1) لاستخدام فهرس الهاتف في بحث البادئة"""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def fetch_customers_with_stats(cursor, where='', params=(), limit=None, offset=0, extra_columns=''):
+    """العملاء (بترتيب الأحدث) مع total_orders و total_spent في استعلام واحد"""
+    page_sql = ''
+    page_params = ()
+    if limit is not None:
+        page_sql = 'LIMIT ? OFFSET ?'
+        page_params = (limit, offset)
+    if where:
+        # التصفية والتصفح أولاً (تستخدم فهارس الاسم/الهاتف) ثم الربط مع صفحة النتائج فقط
+        source = f'(SELECT * FROM customers {where} ORDER BY created_at DESC, id DESC {page_sql})'
+        outer_page_sql = ''
+    else:
+        # بدون تصفية: GROUP BY بترتيب idx_customers_created يمر على الفهرس دون جداول مؤقتة
+        source = 'customers'
+        outer_page_sql = page_sql
+    cursor.execute(f'''
+        SELECT c.*{extra_columns},
+               COUNT(i.customer_id) as total_orders,
+               SUM(i.total) as total_spent
+        FROM {source} c
+        LEFT JOIN invoices i ON i.customer_id = c.id
+        GROUP BY c.created_at, c.id
+        ORDER BY c.created_at DESC, c.id DESC {outer_page_sql}
+    ''', (*params, *page_params))
+    return [dict_from_row(row) for row in cursor.fetchall()]
+
 @app.route('/api/customers', methods=['GET'])
 def get_customers():
-    """جلب جميع العملاء"""
+    """جلب العملاء - search يبحث داخل الاسم/الهاتف/العنوان، q بحث بالبادئة (اسم أو هاتف) يستخدم الفهارس،
+    limit/offset للتصفح (بدون limit تُعاد كل النتائج)"""
     try:
         search = request.args.get('search', '')
+        prefix = request.args.get('q', '').strip()
+        limit = request.args.get('limit', type=int)
+        offset = max(request.args.get('offset', 0, type=int), 0)
         conn = get_db()
         cursor = conn.cursor()
-        
-        if search:
-            cursor.execute('''
-                SELECT *, 
-                       (SELECT COUNT(*) FROM invoices WHERE customer_id = customers.id) as total_orders,
-                       (SELECT SUM(total) FROM invoices WHERE customer_id = customers.id) as total_spent
-                FROM customers 
-                WHERE name LIKE ? OR phone LIKE ? OR address LIKE ?
-                ORDER BY created_at DESC
-            ''', (f'%{search}%', f'%{search}%', f'%{search}%'))
-        else:
-            cursor.execute('''
-                SELECT *, 
-                       (SELECT COUNT(*) FROM invoices WHERE customer_id = customers.id) as total_orders,
-                       (SELECT SUM(total) FROM invoices WHERE customer_id = customers.id) as total_spent
-                FROM customers 
-                ORDER BY created_at DESC
-            ''')
-        
-        customers = [dict_from_row(row) for row in cursor.fetchall()]
+
+        where = ''
+        params = ()
+        if prefix:
+            escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            where = "WHERE name LIKE ? ESCAPE '\\' OR (phone >= ? AND phone < ?)"
+            params = (f'{escaped}%', *_customer_prefix_bounds(prefix))
+        elif search:
+            where = 'WHERE name LIKE ? OR phone LIKE ? OR address LIKE ?'
+            params = (f'%{search}%', f'%{search}%', f'%{search}%')
+
+        page_limit = None
+        if limit is not None:
+            # صف إضافي لمعرفة وجود صفحة تالية
+            page_limit = min(max(limit, 1), CUSTOMERS_MAX_PAGE_SIZE) + 1
+        customers = fetch_customers_with_stats(cursor, where, params, page_limit, offset)
         conn.close()
-        
-        return jsonify({'success': True, 'customers': customers})
+
+        if page_limit is None:
+            return jsonify({'success': True, 'customers': customers})
+        has_more = len(customers) == page_limit
+        customers = customers[:page_limit - 1]
+        return jsonify({'success': True, 'customers': customers, 'offset': offset,
+                        'next_offset': offset + len(customers) if has_more else None, 'has_more': has_more})
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
@@ -4506,17 +5948,11 @@ def get_customer(customer_id):
     try:
         conn = get_db()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT *,
-                   (SELECT COUNT(*) FROM invoices WHERE customer_id = customers.id) as total_orders,
-                   (SELECT SUM(total) FROM invoices WHERE customer_id = customers.id) as total_spent
-            FROM customers WHERE id = ?
-        ''', (customer_id,))
-        row = cursor.fetchone()
+        rows = fetch_customers_with_stats(cursor, 'WHERE id = ?', (customer_id,))
         conn.close()
 
-        if row:
-            return jsonify({'success': True, 'customer': dict_from_row(row)})
+        if rows:
+            return jsonify({'success': True, 'customer': rows[0]})
         else:
             return jsonify({'success': False, 'error': 'العميل غير موجود'}), 404
     except Exception as e:
@@ -4532,17 +5968,11 @@ def search_customer():
             return jsonify({'success': False, 'error': 'رقم الهاتف مطلوب'}), 400
         conn = get_db()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT *,
-                   COALESCE(loyalty_points, 0) as points,
-                   (SELECT COUNT(*) FROM invoices WHERE customer_id = customers.id) as total_orders,
-                   (SELECT SUM(total) FROM invoices WHERE customer_id = customers.id) as total_spent
-            FROM customers WHERE phone = ?
-        ''', (phone,))
-        row = cursor.fetchone()
+        rows = fetch_customers_with_stats(cursor, 'WHERE phone = ?', (phone,), limit=1,
+                                          extra_columns=', COALESCE(c.loyalty_points, 0) as points')
         conn.close()
-        if row:
-            return jsonify({'success': True, 'customer': dict_from_row(row)})
+        if rows:
+            return jsonify({'success': True, 'customer': rows[0]})
         else:
             return jsonify({'success': False, 'error': 'العميل غير موجود'})
     except Exception as e:
@@ -4717,12 +6147,9 @@ def get_expenses():
         query = 'SELECT * FROM expenses WHERE 1=1'
         params = []
 
-        if start_date:
-            query += ' AND date(expense_date) >= ?'
-            params.append(start_date)
-        if end_date:
-            query += ' AND date(expense_date) <= ?'
-            params.append(end_date)
+        date_sql, date_params = sql_date_range('expense_date', start_date, end_date)
+        query += date_sql
+        params.extend(date_params)
         if branch_id:
             query += ' AND branch_id = ?'
             params.append(branch_id)
@@ -4732,13 +6159,11 @@ def get_expenses():
         cursor.execute(query, params)
         expenses = [dict_from_row(row) for row in cursor.fetchall()]
 
-        # جلب تفاصيل الرواتب لكل تكلفة نوعها رواتب
+        # تفاصيل الرواتب لكل تكاليف الرواتب باستعلام واحد
+        salary_details = fetch_children(cursor, 'salary_details', 'expense_id',
+                                        [exp['id'] for exp in expenses if exp['expense_type'] == 'رواتب'])
         for exp in expenses:
-            if exp['expense_type'] == 'رواتب':
-                cursor.execute('SELECT * FROM salary_details WHERE expense_id = ? ORDER BY id', (exp['id'],))
-                exp['salary_details'] = [dict_from_row(row) for row in cursor.fetchall()]
-            else:
-                exp['salary_details'] = []
+            exp['salary_details'] = salary_details.get(exp['id'], [])
 
         conn.close()
 
@@ -4847,12 +6272,9 @@ def sales_by_product():
         '''
         params = []
         
-        if start_date:
-            query += ' AND date(i.created_at) >= ?'
-            params.append(start_date)
-        if end_date:
-            query += ' AND date(i.created_at) <= ?'
-            params.append(end_date)
+        date_sql, date_params = sql_date_range('i.created_at', start_date, end_date)
+        query += date_sql
+        params.extend(date_params)
         if branch_id:
             cursor.execute('SELECT name FROM branches WHERE id = ?', (branch_id,))
             branch = cursor.fetchone()
@@ -4896,24 +6318,21 @@ def sales_by_branch():
         
         query = '''
             SELECT 
-                branch_name,
-                COUNT(*) as invoice_count,
+                NULLIF(branch_name, '') as branch_name,
+                SUM(invoice_count) as invoice_count,
                 SUM(subtotal) as total_subtotal,
                 SUM(discount) as total_discount,
                 SUM(delivery_fee) as total_delivery,
                 SUM(total) as total_sales,
-                AVG(total) as avg_sale
-            FROM invoices
+                SUM(total) / SUM(invoice_count) as avg_sale
+            FROM daily_sales_rollup
             WHERE 1=1
         '''
         params = []
         
-        if start_date:
-            query += ' AND date(created_at) >= ?'
-            params.append(start_date)
-        if end_date:
-            query += ' AND date(created_at) <= ?'
-            params.append(end_date)
+        date_sql, date_params = sql_date_range('day', start_date, end_date)
+        query += date_sql
+        params.extend(date_params)
         
         query += ' GROUP BY branch_name ORDER BY total_sales DESC'
         
@@ -4951,15 +6370,12 @@ def profit_loss():
         cursor = conn.cursor()
         
         # حساب المبيعات
-        sales_query = 'SELECT SUM(total) as total_sales, SUM(subtotal) as subtotal FROM invoices WHERE 1=1'
+        sales_query = 'SELECT SUM(total) as total_sales, SUM(subtotal) as subtotal FROM daily_sales_rollup WHERE 1=1'
         sales_params = []
         
-        if start_date:
-            sales_query += ' AND date(created_at) >= ?'
-            sales_params.append(start_date)
-        if end_date:
-            sales_query += ' AND date(created_at) <= ?'
-            sales_params.append(end_date)
+        date_sql, date_params = sql_date_range('day', start_date, end_date)
+        sales_query += date_sql
+        sales_params.extend(date_params)
         if branch_id:
             cursor.execute('SELECT name FROM branches WHERE id = ?', (branch_id,))
             branch = cursor.fetchone()
@@ -4981,12 +6397,9 @@ def profit_loss():
         '''
         cogs_params = []
         
-        if start_date:
-            cogs_query += ' AND date(i.created_at) >= ?'
-            cogs_params.append(start_date)
-        if end_date:
-            cogs_query += ' AND date(i.created_at) <= ?'
-            cogs_params.append(end_date)
+        date_sql, date_params = sql_date_range('i.created_at', start_date, end_date)
+        cogs_query += date_sql
+        cogs_params.extend(date_params)
         if branch_id:
             cursor.execute('SELECT name FROM branches WHERE id = ?', (branch_id,))
             branch = cursor.fetchone()
@@ -5002,12 +6415,9 @@ def profit_loss():
         expenses_query = 'SELECT SUM(amount) as total_expenses FROM expenses WHERE 1=1'
         expenses_params = []
         
-        if start_date:
-            expenses_query += ' AND date(expense_date) >= ?'
-            expenses_params.append(start_date)
-        if end_date:
-            expenses_query += ' AND date(expense_date) <= ?'
-            expenses_params.append(end_date)
+        date_sql, date_params = sql_date_range('expense_date', start_date, end_date)
+        expenses_query += date_sql
+        expenses_params.extend(date_params)
         if branch_id:
             expenses_query += ' AND branch_id = ?'
             expenses_params.append(branch_id)
@@ -5587,6 +6997,184 @@ def get_supplier_invoice_file(invoice_id):
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
 
+# ===== طابور المهام الخلفية =====
+# النسخ الاحتياطي ورفع Google Drive كانا يعملان داخل الطلب فيحجزان عامل gunicorn وقد
+# يتجاوزان مهلة 120 ثانية. الطلب الآن يسجل المهمة في جدول jobs (master.db) ويعيد رقمها
+# فوراً، والتنفيذ في خيوط JOB_WORKERS لهذه العملية مع تسلسل مهام المستأجر الواحد.
+# التقدم يُكتب في الجدول فيقرأه /api/jobs/<id> من أي عامل.
+
+JOB_WORKERS = max(1, int(os.environ.get('POS_JOB_WORKERS', '2')))
+JOB_PROGRESS_INTERVAL = 0.5  # ثوانٍ بين كتابات التقدم
+JOB_RETENTION_DAYS = 7
+JOB_COLUMNS = ('id', 'kind', 'tenant_slug', 'status', 'stage', 'done', 'total', 'unit', 'result', 'error',
+               'created_by', 'pid', 'created_at', 'started_at', 'finished_at', 'updated_at')
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except PermissionError:
+        return True
+    except (OSError, TypeError):
+        return False
+
+class JobQueue:
+    """مهام خلفية محفوظة في جدول jobs مع تقدم و ETA - مهمة واحدة لكل مستأجر في نفس الوقت"""
+
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._handlers = {}
+        self._pending = {}  # {serial_key: [job_id, ...]} بانتظار انتهاء مهمة المستأجر الحالية
+        self._stats = {'submitted': 0, 'done': 0, 'failed': 0}
+
+    def handler(self, kind):
+        """تسجيل منفّذ نوع مهمة: func(tenant_slug, params, report) -> result dict"""
+        def decorator(func):
+            self._handlers[kind] = func
+            return func
+        return decorator
+
+    def _update(self, job_id, **fields):
+        fields['updated_at'] = datetime.now().isoformat()
+        conn = get_master_db()
+        try:
+            conn.execute(f'UPDATE jobs SET {", ".join(f"{k} = ?" for k in fields)} WHERE id = ?',
+                         (*fields.values(), job_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def submit(self, kind, tenant_slug=None, params=None, created_by=None):
+        """تسجيل مهمة وجدولتها - تعيد رقم المهمة فوراً"""
+        if kind not in self._handlers:
+            raise ValueError(f'unknown job kind: {kind}')
+        job_id = secrets.token_hex(8)
+        now = datetime.now().isoformat()
+        conn = get_master_db()
+        try:
+            conn.execute('DELETE FROM jobs WHERE created_at < ? AND status IN (\'done\', \'failed\')',
+                         ((datetime.now() - timedelta(days=JOB_RETENTION_DAYS)).isoformat(),))
+            conn.execute('''INSERT INTO jobs (id, kind, tenant_slug, status, params, created_by, pid, created_at, updated_at)
+                            VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?)''',
+                         (job_id, kind, tenant_slug, json.dumps(params or {}, ensure_ascii=False),
+                          created_by, os.getpid(), now, now))
+            conn.commit()
+        finally:
+            conn.close()
+
+        # مفتاح التسلسل: المستأجر ('' للافتراضي)، والمهام العامة (كل المتاجر) مفتاحها '*'
+        key = '*' if tenant_slug is None else tenant_slug
+        with self._lock:
+            self._stats['submitted'] += 1
+            if key in self._pending:
+                self._pending[key].append((job_id, kind, tenant_slug, params or {}))
+            else:
+                self._pending[key] = []
+                self._start(key, job_id, kind, tenant_slug, params or {})
+        return job_id
+
+    def _start(self, key, job_id, kind, tenant_slug, params):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pos-job')
+        self._executor.submit(self._run, key, job_id, kind, tenant_slug, params)
+
+    def _run(self, key, job_id, kind, tenant_slug, params):
+        last_write = [0.0]
+        outcome = 'failed'
+
+        def report(done, total, stage=None, unit='bytes'):
+            now = time.monotonic()
+            if done < total and now - last_write[0] < JOB_PROGRESS_INTERVAL:
+                return
+            last_write[0] = now
+            self._update(job_id, done=int(done), total=int(total), unit=unit, stage=stage)
+
+        try:
+            self._update(job_id, status='running', started_at=datetime.now().isoformat())
+            result = self._handlers[kind](tenant_slug, params, report)
+            self._update(job_id, status='done', result=json.dumps(result, ensure_ascii=False, default=str),
+                         finished_at=datetime.now().isoformat())
+            outcome = 'done'
+        except Exception as e:
+            print(f"[Jobs] {kind} {job_id} ({key or 'default'}): {e}")
+            try:
+                self._update(job_id, status='failed', error=str(e), finished_at=datetime.now().isoformat())
+            except Exception as ue:
+                print(f"[Jobs] تعذر تسجيل فشل المهمة {job_id}: {ue}")
+        finally:
+            with self._lock:
+                self._stats[outcome] += 1
+                queued = self._pending.get(key)
+                if queued:
+                    self._start(key, *queued.pop(0))
+                else:
+                    self._pending.pop(key, None)
+
+    def get(self, job_id):
+        """حالة المهمة مع النسبة والوقت المتبقي المقدر - None إن لم توجد"""
+        conn = get_master_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE id = ?', (job_id,))
+            row = cursor.fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        job = dict(zip(JOB_COLUMNS, row))
+        # العملية التي تملك المهمة توقفت (إعادة تشغيل/انهيار عامل) - لن تكتمل أبداً
+        if job['status'] in ('queued', 'running') and job['pid'] != os.getpid() and not _pid_alive(job['pid']):
+            job.update(status='failed', error='توقفت العملية المنفذة قبل اكتمال المهمة')
+            self._update(job_id, status='failed', error=job['error'], finished_at=datetime.now().isoformat())
+
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        job['progress'] = 1.0 if job['status'] == 'done' else (
+            round(job['done'] / job['total'], 4) if job['total'] else 0.0)
+        job['eta_seconds'] = None
+        if job['status'] == 'running' and job['started_at'] and 0 < job['progress'] < 1:
+            elapsed = (datetime.now() - datetime.fromisoformat(job['started_at'])).total_seconds()
+            job['eta_seconds'] = round(elapsed * (1 - job['progress']) / job['progress'], 1)
+        if job['unit'] == 'bytes':
+            job['bytes_done'], job['bytes_total'] = job['done'], job['total']
+        del job['pid']
+        return job
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, workers=self.workers,
+                        active=len(self._pending), queued=sum(len(q) for q in self._pending.values()))
+
+job_queue = JobQueue()
+
+def job_owner():
+    """اسم مستخدم الطلب الحالي لحقل created_by"""
+    user = getattr(request, 'current_user', None) or {}
+    return user.get('username') or str(user.get('user_id') or '')
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """حالة مهمة خلفية: التقدم والبايتات المنسوخة والوقت المتبقي والنتيجة"""
+    try:
+        job = job_queue.get(job_id)
+        user = getattr(request, 'current_user', None) or {}
+        # المستأجر يرى مهامه فقط، ومهام كل المتاجر للسوبر أدمن
+        if job and not user.get('is_super_admin') and job['tenant_slug'] != (get_tenant_slug() or ''):
+            job = None
+        if not job:
+            return jsonify({'success': False, 'error': 'المهمة غير موجودة'}), 404
+        return jsonify({'success': True, 'job': job})
+    except Exception as e:
+        print(f"API error [{request.path}]: {e}")
+        return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
+
+@app.route('/api/super-admin/jobs/stats', methods=['GET'])
+def super_admin_job_stats():
+    """إحصائيات طابور المهام لهذه العملية"""
+    return jsonify({'success': True, 'pid': os.getpid(), 'stats': job_queue.stats()})
+
+
 # ===== نظام Multi-Tenancy API =====
 
 @app.route('/api/super-admin/login', methods=['POST'])
@@ -5636,24 +7224,13 @@ def check_tenant_status():
         slug = request.args.get('slug', '').strip()
         if not slug:
             return jsonify({'success': False, 'error': 'slug مطلوب'}), 400
-        conn = get_master_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT is_active, expires_at, name, plan, mode FROM tenants WHERE slug = ?', (slug,))
-        tenant = cursor.fetchone()
-        conn.close()
-        if not tenant:
+        t = tenant_registry.get(slug)
+        if not t:
             return jsonify({'success': False, 'error': 'معرف المتجر غير صحيح'}), 404
-        t = dict_from_row(tenant)
         # Auto-deactivate expired tenants
-        if t['is_active'] and t['expires_at']:
-            from datetime import date
-            expiry = date.fromisoformat(t['expires_at'][:10])
-            if date.today() > expiry:
-                conn2 = get_master_db()
-                conn2.cursor().execute('UPDATE tenants SET is_active = 0 WHERE slug = ?', (slug,))
-                conn2.commit()
-                conn2.close()
-                t['is_active'] = 0
+        if t['is_active'] and tenant_is_expired(t):
+            deactivate_expired_tenant(slug)
+            t['is_active'] = 0
         return jsonify({'success': True, 'is_active': t['is_active'], 'expires_at': t['expires_at'], 'name': t['name'], 'plan': t.get('plan', 'basic'), 'mode': t.get('mode', 'online')})
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
@@ -5666,14 +7243,9 @@ def generate_license_token():
         slug = request.args.get('slug', '').strip()
         if not slug:
             return jsonify({'success': False, 'error': 'slug مطلوب'}), 400
-        conn = get_master_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM tenants WHERE slug = ?', (slug,))
-        tenant = cursor.fetchone()
-        conn.close()
-        if not tenant:
+        t = tenant_registry.get(slug)
+        if not t:
             return jsonify({'success': False, 'error': 'المستأجر غير موجود'}), 404
-        t = dict_from_row(tenant)
         now = int(time.time())
         # Calculate exp from tenant's actual expires_at date
         # If no expires_at, exp is None (unlimited subscription)
@@ -5709,14 +7281,9 @@ def refresh_license_token():
         slug = get_tenant_slug()
         if not slug:
             return jsonify({'success': False, 'error': 'لا يوجد معرف مستأجر'}), 400
-        conn = get_master_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM tenants WHERE slug = ?', (slug,))
-        tenant = cursor.fetchone()
-        conn.close()
-        if not tenant:
+        t = tenant_registry.get(slug)
+        if not t:
             return jsonify({'success': False, 'error': 'المستأجر غير موجود'}), 404
-        t = dict_from_row(tenant)
         now = int(time.time())
         # Calculate exp from tenant's actual expires_at date
         # If no expires_at, exp is None (unlimited subscription)
@@ -5871,6 +7438,7 @@ def update_tenant(tenant_id):
             values.append(tenant_id)
             cursor.execute(f'UPDATE tenants SET {", ".join(fields)} WHERE id = ?', values)
             conn.commit()
+            tenant_registry.invalidate(tenant_id=tenant_id)
 
         # تحديث اسم المستخدم أو كلمة المرور للأدمن في قاعدة بيانات المستأجر
         new_admin_user = data.get('admin_username', '').strip()
@@ -5892,6 +7460,7 @@ def update_tenant(tenant_id):
                         t_cur.execute('UPDATE users SET username = ? WHERE id = ?', (new_admin_user, admin_id))
                     if new_admin_pass:
                         t_cur.execute('UPDATE users SET password = ? WHERE id = ?', (hash_password(new_admin_pass), admin_id))
+                    bump_permission_version(t_cur, tenant_slug)
                     t_conn.commit()
                 t_conn.close()
 
@@ -5913,14 +7482,21 @@ def delete_tenant(tenant_id):
             conn.close()
             return jsonify({'success': False, 'error': 'المستأجر غير موجود'}), 404
 
-        # حذف قاعدة بيانات المستأجر
+        # حذف قاعدة بيانات المستأجر (مع ملفات WAL المرافقة)
         db_path = tenant['db_path']
-        if os.path.exists(db_path):
-            os.remove(db_path)
+        db_pool.discard(db_path)
+        db_pool.discard(get_tenant_db_path(tenant['slug']))
+        _initialized_dbs.discard(db_path)
+        _initialized_dbs.discard(get_tenant_db_path(tenant['slug']))
+        for path in (db_path, db_path + '-wal', db_path + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
 
         cursor.execute('DELETE FROM tenants WHERE id = ?', (tenant_id,))
         conn.commit()
         conn.close()
+        feature_cache.invalidate(tenant['slug'])
+        tenant_registry.invalidate(tenant['slug'])
         return jsonify({'success': True})
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
@@ -6030,6 +7606,7 @@ def create_subscription_invoice():
                        (end_date.isoformat(), tenant_id))
 
         conn.commit()
+        tenant_registry.invalidate(tenant_id=tenant_id)
         invoice_id = cursor.lastrowid
 
         # تحديث رمز الترخيص JWT في قاعدة بيانات المستأجر
@@ -6163,43 +7740,47 @@ def super_admin_backup_tenant(tenant_id):
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
 
-@app.route('/api/super-admin/backup/all', methods=['POST'])
-def super_admin_backup_all():
-    """إنشاء نسخ احتياطية لجميع المتاجر"""
-    try:
-        conn = get_master_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM tenants WHERE is_active = 1 ORDER BY id')
-        tenants = [dict_from_row(row) for row in cursor.fetchall()]
-        conn.close()
-
-        results = []
-        errors = []
+@job_queue.handler('backup_all')
+def _backup_all_job(tenant_slug, params, report):
+    conn = get_master_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM tenants WHERE is_active = 1 ORDER BY id')
+    tenants = [dict_from_row(row) for row in cursor.fetchall()]
+    conn.close()
 
-        # نسخة احتياطية للقاعدة الرئيسية (default)
-        backup_info, error = create_backup_file(None)
-        if error:
-            errors.append({'tenant': 'default', 'error': error})
+    # القاعدة الرئيسية (default) + كل متجر نشط، موزعة على BULK_WORKERS عمليات
+    names = {'default': 'القاعدة الرئيسية'}
+    names.update({t['slug']: t['name'] for t in tenants})
+    targets = [('default', DB_PATH)] + [(t['slug'], get_tenant_db_path(t['slug'])) for t in tenants]
+    summary = run_tenant_jobs('backup', targets,
+                              progress=lambda done, total, result: report(done, total, result['tenant'], unit='tenants'))
+
+    results = []
+    errors = []
+    for r in summary['results']:
+        if r['ok']:
+            r['backup']['tenant_name'] = names.get(r['tenant'], r['tenant'])
+            r['backup']['seconds'] = r['seconds']
+            results.append(r['backup'])
         else:
-            backup_info['tenant_name'] = 'القاعدة الرئيسية'
-            results.append(backup_info)
-
-        # نسخ احتياطية لكل متجر
-        for tenant in tenants:
-            backup_info, error = create_backup_file(tenant['slug'])
-            if error:
-                errors.append({'tenant': tenant['name'], 'error': error})
-            else:
-                backup_info['tenant_name'] = tenant['name']
-                results.append(backup_info)
+            errors.append({'tenant': names.get(r['tenant'], r['tenant']), 'error': r['error']})
+
+    return {
+        'backups': results,
+        'errors': errors,
+        'total': len(results),
+        'failed': len(errors),
+        'seconds': summary['seconds'],
+        'workers': summary['workers'],
+        'slowest': summary['slowest']
+    }
 
-        return jsonify({
-            'success': True,
-            'backups': results,
-            'errors': errors,
-            'total': len(results),
-            'failed': len(errors)
-        })
+@app.route('/api/super-admin/backup/all', methods=['POST'])
+def super_admin_backup_all():
+    """إنشاء نسخ احتياطية لجميع المتاجر (مهمة خلفية - تتابع عبر /api/jobs/<id>)"""
+    try:
+        job_id = job_queue.submit('backup_all', None, created_by=job_owner())
+        return jsonify({'success': True, 'job_id': job_id}), 202
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
@@ -6217,33 +7798,11 @@ def super_admin_list_all_backups():
         all_backups = {}
 
         # نسخ القاعدة الرئيسية
-        default_dir = get_backup_dir(None)
-        default_backups = []
-        if os.path.exists(default_dir):
-            for f in sorted(os.listdir(default_dir), reverse=True):
-                if f.endswith('.db'):
-                    fp = os.path.join(default_dir, f)
-                    default_backups.append({
-                        'filename': f,
-                        'size': os.path.getsize(fp),
-                        'created_at': datetime.fromtimestamp(os.path.getmtime(fp)).isoformat()
-                    })
-        all_backups['default'] = {'name': 'القاعدة الرئيسية', 'backups': default_backups}
+        all_backups['default'] = {'name': 'القاعدة الرئيسية', 'backups': list_backup_entries(get_backup_dir(None))}
 
         # نسخ كل متجر
         for tenant in tenants:
-            tenant_dir = get_backup_dir(tenant['slug'])
-            tenant_backups = []
-            if os.path.exists(tenant_dir):
-                for f in sorted(os.listdir(tenant_dir), reverse=True):
-                    if f.endswith('.db'):
-                        fp = os.path.join(tenant_dir, f)
-                        tenant_backups.append({
-                            'filename': f,
-                            'size': os.path.getsize(fp),
-                            'created_at': datetime.fromtimestamp(os.path.getmtime(fp)).isoformat()
-                        })
-            all_backups[tenant['slug']] = {'name': tenant['name'], 'backups': tenant_backups}
+            all_backups[tenant['slug']] = {'name': tenant['name'], 'backups': list_backup_entries(get_backup_dir(tenant['slug']))}
 
         return jsonify({'success': True, 'all_backups': all_backups})
     except Exception as e:
@@ -6326,8 +7885,9 @@ def super_admin_update_features(tenant_id):
 
         conn = get_master_db()
         cursor = conn.cursor()
-        cursor.execute('SELECT id FROM tenants WHERE id = ?', (tenant_id,))
-        if not cursor.fetchone():
+        cursor.execute('SELECT slug FROM tenants WHERE id = ?', (tenant_id,))
+        tenant = cursor.fetchone()
+        if not tenant:
             conn.close()
             return jsonify({'success': False, 'error': 'المتجر غير موجود'}), 404
 
@@ -6347,12 +7907,38 @@ def super_admin_update_features(tenant_id):
 
         conn.commit()
         conn.close()
+        feature_cache.invalidate(tenant[0])
         return jsonify({'success': True, 'message': 'تم تحديث الميزات بنجاح'})
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
 
 
+@app.route('/api/super-admin/db-pool/stats', methods=['GET'])
+def super_admin_db_pool_stats():
+    """إحصائيات مجمع اتصالات قواعد البيانات (نسبة الإصابة وزمن الحصول على اتصال)"""
+    return jsonify({'success': True, 'pid': os.getpid(), 'stats': db_pool.stats()})
+
+@app.route('/api/super-admin/feature-cache/stats', methods=['GET'])
+def super_admin_feature_cache_stats():
+    """إحصائيات كاش الميزات (إصابة/إخفاق) لهذه العملية"""
+    return jsonify({'success': True, 'pid': os.getpid(), 'stats': feature_cache.stats()})
+
+@app.route('/api/super-admin/settings-cache/stats', methods=['GET'])
+def super_admin_settings_cache_stats():
+    """إحصائيات كاش الإعدادات (إصابة/إخفاق) لهذه العملية"""
+    return jsonify({'success': True, 'pid': os.getpid(), 'stats': settings_cache.stats()})
+
+@app.route('/api/super-admin/name-cache/stats', methods=['GET'])
+def super_admin_name_cache_stats():
+    """إحصائيات كاش أسماء الفروع والورديات (إصابة/إخفاق) لهذه العملية"""
+    return jsonify({'success': True, 'pid': os.getpid(), 'stats': name_cache.stats()})
+
+@app.route('/api/super-admin/tenant-cache/stats', methods=['GET'])
+def super_admin_tenant_cache_stats():
+    """إحصائيات سجل المستأجرين المخزّن (إصابة/إخفاق) لهذه العملية"""
+    return jsonify({'success': True, 'pid': os.getpid(), 'stats': tenant_registry.stats()})
+
 @app.route('/api/super-admin/features/available', methods=['GET'])
 def super_admin_available_features():
     """قائمة جميع الميزات المتاحة (Super Admin)"""
@@ -6371,45 +7957,119 @@ def get_backup_dir(tenant_slug=None):
     os.makedirs(backup_dir, exist_ok=True)
     return backup_dir
 
-def create_backup_file(tenant_slug=None):
-    """إنشاء نسخة احتياطية من قاعدة البيانات"""
+# النسخ الاحتياطية لقطات مجزأة (database/backup_store.py): كل لقطة manifest بقائمة
+# بصمات SHA-256 لأجزاء الملف، والأجزاء مضغوطة ومشتركة بين اللقطات، فالنسخة الليلية
+# تكتب الصفحات المتغيرة فقط. ملفات .db القديمة تبقى قابلة للعرض والتحميل والاستعادة.
+BACKUP_CHUNK_SIZE = max(4, int(os.environ.get('POS_BACKUP_CHUNK_KB', '32'))) * 1024
+BACKUP_CODEC = os.environ.get('POS_BACKUP_CODEC') or backup_store.DEFAULT_CODEC
+# نسخ القاعدة على خطوات (صفحات) حتى يُقاس التقدم ولا يُحجز القفل طوال النسخ
+BACKUP_STEP_PAGES = int(os.environ.get('POS_BACKUP_STEP_PAGES', '1024'))
+BACKUP_SUFFIXES = ('.db', backup_store.MANIFEST_SUFFIX)
+
+def create_backup_file(tenant_slug=None, progress=None):
+    """إنشاء نسخة احتياطية (لقطة مضغوطة بدون تكرار) من قاعدة البيانات
+    progress(done_bytes, total_bytes, stage) اختياري لتقارير المهام"""
     db_path = get_tenant_db_path(tenant_slug) if tenant_slug else DB_PATH
     if not os.path.exists(db_path):
         return None, 'قاعدة البيانات غير موجودة'
 
     backup_dir = get_backup_dir(tenant_slug)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    backup_filename = f'backup_{timestamp}.db'
-    backup_path = os.path.join(backup_dir, backup_filename)
-
     try:
-        # استخدام SQLite backup API للتأكد من سلامة النسخة
-        source = sqlite3.connect(db_path)
-        dest = sqlite3.connect(backup_path)
-        source.backup(dest)
-        dest.close()
-        source.close()
-
-        file_size = os.path.getsize(backup_path)
+        snapshot = backup_store.create_snapshot(db_path, backup_dir, chunk_size=BACKUP_CHUNK_SIZE,
+                                                codec=BACKUP_CODEC, source=tenant_slug or 'default',
+                                                step_pages=BACKUP_STEP_PAGES, progress=progress)
         return {
-            'filename': backup_filename,
-            'path': backup_path,
-            'size': file_size,
-            'created_at': datetime.now().isoformat(),
+            'filename': snapshot['filename'],
+            'path': os.path.join(backup_dir, snapshot['filename']),
+            'size': snapshot['size'],
+            'stored_size': snapshot['stored_bytes'],
+            'new_chunks': snapshot['new_chunks'],
+            'created_at': snapshot['created_at'],
             'tenant': tenant_slug or 'default'
         }, None
     except Exception as e:
         return None, str(e)
 
+def list_backup_entries(backup_dir):
+    """النسخ الاحتياطية في مجلد (لقطات + ملفات .db القديمة) - الأحدث أولاً"""
+    backups = []
+    if not os.path.exists(backup_dir):
+        return backups
+    for f in os.listdir(backup_dir):
+        if not f.endswith(BACKUP_SUFFIXES) or f.startswith('.'):
+            continue
+        fpath = os.path.join(backup_dir, f)
+        if backup_store.is_snapshot(f):
+            try:
+                manifest = backup_store.read_manifest(backup_dir, f)
+            except (OSError, ValueError) as e:
+                print(f"[Backup] manifest غير صالح {f}: {e}")
+                continue
+            backups.append({
+                'filename': f,
+                'size': manifest['size'],
+                'stored_size': manifest['stored_bytes'],
+                'created_at': manifest['created_at']
+            })
+        else:
+            stat = os.stat(fpath)
+            backups.append({
+                'filename': f,
+                'size': stat.st_size,
+                'stored_size': stat.st_size,
+                'created_at': datetime.fromtimestamp(stat.st_mtime).isoformat()
+            })
+    backups.sort(key=lambda b: b['created_at'], reverse=True)
+    return backups
+
+def safe_backup_filename(filename):
+    """اسم ملف نسخة آمن (منع path traversal) أو None"""
+    safe_filename = re.sub(r'[^a-zA-Z0-9_.\-]', '', filename or '')
+    if not safe_filename or safe_filename != filename or '..' in filename or not filename.endswith(BACKUP_SUFFIXES):
+        return None
+    return safe_filename
+
+@contextmanager
+def backup_db_file(backup_dir, filename):
+    """مسار ملف SQLite قابل للقراءة لنسخة احتياطية - اللقطة تُجمّع وتُتحقق بصماتها في ملف مؤقت"""
+    if not backup_store.is_snapshot(filename):
+        yield os.path.join(backup_dir, filename)
+        return
+    fd, tmp_path = tempfile.mkstemp(prefix='.materialize-', suffix='.tmp', dir=backup_dir)
+    os.close(fd)
+    try:
+        backup_store.materialize(backup_dir, filename, tmp_path)
+        yield tmp_path
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def remove_backup(backup_dir, filename):
+    """حذف نسخة احتياطية مع تحرير الأجزاء التي لم تعد أي لقطة تستخدمها"""
+    os.remove(os.path.join(backup_dir, filename))
+    session_path = _gdrive_session_path(backup_dir, filename)
+    if os.path.exists(session_path):
+        os.remove(session_path)
+    if backup_store.is_snapshot(filename):
+        backup_store.collect_garbage(backup_dir)
+
+@job_queue.handler('backup')
+def _backup_job(tenant_slug, params, report):
+    backup_info, error = create_backup_file(tenant_slug or None, progress=report)
+    if error:
+        raise RuntimeError(error)
+    return {'backup': backup_info}
+
 @app.route('/api/backup/create', methods=['POST'])
 def create_backup():
-    """إنشاء نسخة احتياطية جديدة"""
+    """إنشاء نسخة احتياطية جديدة (مهمة خلفية - تتابع عبر /api/jobs/<id>)"""
     try:
         tenant_slug = get_tenant_slug()
-        backup_info, error = create_backup_file(tenant_slug)
-        if error:
-            return jsonify({'success': False, 'error': error}), 500
-        return jsonify({'success': True, 'backup': backup_info})
+        db_path = get_tenant_db_path(tenant_slug) if tenant_slug else DB_PATH
+        if not os.path.exists(db_path):
+            return jsonify({'success': False, 'error': 'قاعدة البيانات غير موجودة'}), 404
+        job_id = job_queue.submit('backup', tenant_slug or '', created_by=job_owner())
+        return jsonify({'success': True, 'job_id': job_id}), 202
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
@@ -6420,42 +8080,25 @@ def list_backups():
     try:
         tenant_slug = get_tenant_slug()
         backup_dir = get_backup_dir(tenant_slug)
-        backups = []
-
-        if os.path.exists(backup_dir):
-            for f in sorted(os.listdir(backup_dir), reverse=True):
-                if f.endswith('.db'):
-                    fpath = os.path.join(backup_dir, f)
-                    stat = os.stat(fpath)
-                    backups.append({
-                        'filename': f,
-                        'size': stat.st_size,
-                        'created_at': datetime.fromtimestamp(stat.st_mtime).isoformat()
-                    })
+        backups = list_backup_entries(backup_dir)
 
         # جلب إعدادات الجدولة
         db_path = get_tenant_db_path(tenant_slug) if tenant_slug else DB_PATH
         schedule = {'enabled': False, 'time': '03:00', 'keep_days': 30, 'gdrive_auto': False}
         try:
-            conn = sqlite3.connect(db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT key, value FROM settings WHERE key LIKE 'backup_%'")
-            for row in cursor.fetchall():
-                k = row['key'].replace('backup_', '')
-                if k == 'schedule_enabled':
-                    schedule['enabled'] = row['value'] == 'true'
-                elif k == 'schedule_time':
-                    schedule['time'] = row['value']
-                elif k == 'keep_days':
-                    schedule['keep_days'] = int(row['value'])
-                elif k == 'gdrive_auto':
-                    schedule['gdrive_auto'] = row['value'] == 'true'
-            conn.close()
-        except:
+            settings = settings_cache.get(db_path)
+            schedule = {
+                'enabled': settings.get_bool('backup_schedule_enabled'),
+                'time': settings.get_str('backup_schedule_time', '03:00'),
+                'keep_days': settings.get_int('backup_keep_days', 30),
+                'gdrive_auto': settings.get_bool('backup_gdrive_auto'),
+            }
+        except Exception:
             pass
 
-        return jsonify({'success': True, 'backups': backups, 'schedule': schedule})
+        return jsonify({'success': True, 'backups': backups, 'schedule': schedule,
+                        'storage_size': backup_store.store_usage(backup_dir) + sum(
+                            b['size'] for b in backups if not backup_store.is_snapshot(b['filename']))})
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
@@ -6465,8 +8108,8 @@ def download_backup(filename):
     """تحميل نسخة احتياطية"""
     try:
         # التحقق من اسم الملف (منع path traversal)
-        safe_filename = re.sub(r'[^a-zA-Z0-9_.\-]', '', filename)
-        if safe_filename != filename or '..' in filename:
+        safe_filename = safe_backup_filename(filename)
+        if not safe_filename:
             return jsonify({'success': False, 'error': 'اسم ملف غير صالح'}), 400
 
         tenant_slug = get_tenant_slug()
@@ -6476,7 +8119,37 @@ def download_backup(filename):
         if not os.path.exists(filepath):
             return jsonify({'success': False, 'error': 'الملف غير موجود'}), 404
 
-        return send_file(filepath, as_attachment=True, download_name=safe_filename)
+        download_name = backup_store.snapshot_db_name(safe_filename)
+        if not backup_store.is_snapshot(safe_filename):
+            return send_file(filepath, as_attachment=True, download_name=download_name)
+
+        # اللقطة تُجمّع في ملف مؤقت يُحذف بعد انتهاء الإرسال
+        fd, tmp_path = tempfile.mkstemp(prefix='.materialize-', suffix='.tmp', dir=backup_dir)
+        os.close(fd)
+        try:
+            backup_store.materialize(backup_dir, safe_filename, tmp_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        def stream_and_remove():
+            try:
+                with open(tmp_path, 'rb') as f:
+                    while True:
+                        data = f.read(256 * 1024)
+                        if not data:
+                            break
+                        yield data
+            finally:
+                os.remove(tmp_path)
+
+        return Response(stream_and_remove(), mimetype='application/x-sqlite3', headers={
+            'Content-Disposition': f'attachment; filename={download_name}',
+            'Content-Length': str(os.path.getsize(tmp_path)),
+        })
+    except backup_store.BackupIntegrityError as e:
+        print(f"[Backup] {e}")
+        return jsonify({'success': False, 'error': 'النسخة الاحتياطية تالفة'}), 409
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
@@ -6486,8 +8159,8 @@ def download_backup(filename):
 def delete_backup(filename):
     """حذف نسخة احتياطية"""
     try:
-        safe_filename = re.sub(r'[^a-zA-Z0-9_.\-]', '', filename)
-        if safe_filename != filename or '..' in filename:
+        safe_filename = safe_backup_filename(filename)
+        if not safe_filename:
             return jsonify({'success': False, 'error': 'اسم ملف غير صالح'}), 400
 
         tenant_slug = get_tenant_slug()
@@ -6497,7 +8170,7 @@ def delete_backup(filename):
         if not os.path.exists(filepath):
             return jsonify({'success': False, 'error': 'الملف غير موجود'}), 404
 
-        os.remove(filepath)
+        remove_backup(backup_dir, safe_filename)
         return jsonify({'success': True})
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
@@ -6510,6 +8183,9 @@ def restore_backup():
     try:
         tenant_slug = get_tenant_slug()
         db_path = get_tenant_db_path(tenant_slug) if tenant_slug else DB_PATH
+        conn = get_db()
+        permission_version = read_permission_version(conn.cursor())
+        conn.close()
 
         # التحقق من وجود ملف مرفوع أو اسم ملف
         if 'file' in request.files:
@@ -6521,7 +8197,6 @@ def restore_backup():
             pre_restore_info, _ = create_backup_file(tenant_slug)
 
             # حفظ الملف المرفوع كنسخة مؤقتة والتحقق منه
-            import tempfile
             with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as tmp:
                 file.save(tmp.name)
                 tmp_path = tmp.name
@@ -6544,26 +8219,44 @@ def restore_backup():
             os.unlink(tmp_path)
 
         elif request.json and request.json.get('filename'):
-            filename = request.json['filename']
-            safe_filename = re.sub(r'[^a-zA-Z0-9_.\-]', '', filename)
+            safe_filename = safe_backup_filename(request.json['filename'])
             backup_dir = get_backup_dir(tenant_slug)
-            filepath = os.path.join(backup_dir, safe_filename)
-
-            if not os.path.exists(filepath):
+            if not safe_filename or not os.path.exists(os.path.join(backup_dir, safe_filename)):
                 return jsonify({'success': False, 'error': 'النسخة الاحتياطية غير موجودة'}), 404
 
-            # إنشاء نسخة احتياطية قبل الاستعادة
-            pre_restore_info, _ = create_backup_file(tenant_slug)
+            # التجميع والتحقق من البصمات قبل لمس القاعدة الحالية
+            with backup_db_file(backup_dir, safe_filename) as filepath:
+                # إنشاء نسخة احتياطية قبل الاستعادة
+                pre_restore_info, _ = create_backup_file(tenant_slug)
 
-            source = sqlite3.connect(filepath)
-            dest = sqlite3.connect(db_path)
-            source.backup(dest)
-            dest.close()
-            source.close()
+                source = sqlite3.connect(filepath)
+                dest = sqlite3.connect(db_path)
+                source.backup(dest)
+                dest.close()
+                source.close()
         else:
             return jsonify({'success': False, 'error': 'لم يتم تحديد ملف'}), 400
 
+        # إسقاط الاتصالات المفتوحة على القاعدة القديمة
+        db_pool.discard(db_path)
+        # النسخة قد تسبق المخطط الحالي: ترقيتها وتسجيل الإصدار على القرص الآن، لأن العمال
+        # الآخرين سجّلوا المسار في _initialized_dbs ولن يعيدوا فحص user_version
+        ensure_db_tables(db_path, force=True)
+        settings_cache.invalidate(db_path)
+        name_cache.invalidate(db_path)
+        # حقبة بيانات جديدة: أرقام change_log في النسخة المستعادة قد تتكرر فتُبطل ETag القديمة
+        conn = sqlite3.connect(db_path)
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('data_epoch', ?)", (secrets.token_hex(8),))
+        # نسخة ما قبل الاستعادة أُخذت للتو: لا يُعدّ موعد المجدول في القاعدة المستعادة فائتاً
+        record_backup_run(conn, filename=pre_restore_info['filename'] if pre_restore_info else None)
+        bump_permission_version(conn.cursor(), tenant_slug, at_least=permission_version)
+        conn.commit()
+        conn.close()
+        backup_scheduler.reload(tenant_slug)
         return jsonify({'success': True, 'message': 'تمت الاستعادة بنجاح. تم إنشاء نسخة احتياطية تلقائية قبل الاستعادة.'})
+    except backup_store.BackupIntegrityError as e:
+        print(f"[Backup] {e}")
+        return jsonify({'success': False, 'error': 'النسخة الاحتياطية تالفة ولم تتم الاستعادة'}), 409
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
@@ -6589,10 +8282,15 @@ def update_backup_schedule():
         for key, value in settings.items():
             cursor.execute('INSERT OR REPLACE INTO settings (key, value, updated_at) VALUES (?, ?, ?)',
                            (key, value, datetime.now().isoformat()))
+        if data.get('enabled') and read_last_backup_run(conn) is None:
+            # التفعيل لا يعني موعداً فائتاً: الحساب يبدأ من الآن (نقطة بداية بدون ملف)
+            record_backup_run(conn)
 
         conn.commit()
         conn.close()
+        settings_cache.invalidate(db_path)
 
+        backup_scheduler.reload(tenant_slug)
         return jsonify({'success': True})
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
@@ -6634,6 +8332,7 @@ def gdrive_save_credentials():
                        ('gdrive_redirect_uri', redirect_uri, datetime.now().isoformat()))
         conn.commit()
         conn.close()
+        settings_cache.invalidate(db_path)
 
         # إنشاء رابط التفويض مع تمرير tenant_slug في state
         params = urllib.parse.urlencode({
@@ -6656,19 +8355,10 @@ def _gdrive_exchange_code(auth_code, tenant_slug=None):
     """تبادل كود التفويض بالتوكن - دالة مشتركة"""
     db_path = get_tenant_db_path(tenant_slug) if tenant_slug else DB_PATH
 
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM settings WHERE key = 'gdrive_client_id'")
-    row = cursor.fetchone()
-    client_id = row['value'] if row else None
-    cursor.execute("SELECT value FROM settings WHERE key = 'gdrive_client_secret'")
-    row = cursor.fetchone()
-    client_secret = row['value'] if row else None
-    cursor.execute("SELECT value FROM settings WHERE key = 'gdrive_redirect_uri'")
-    row = cursor.fetchone()
-    redirect_uri = row['value'] if row else None
-    conn.close()
+    settings = settings_cache.get(db_path)
+    client_id = settings.get('gdrive_client_id')
+    client_secret = settings.get('gdrive_client_secret')
+    redirect_uri = settings.get('gdrive_redirect_uri')
 
     if not client_id or not client_secret:
         raise ValueError('لم يتم العثور على بيانات الاعتماد')
@@ -6704,6 +8394,7 @@ def _gdrive_exchange_code(auth_code, tenant_slug=None):
                    ('gdrive_token_expiry', str(time.time() + tokens.get('expires_in', 3600)), datetime.now().isoformat()))
     conn.commit()
     conn.close()
+    settings_cache.invalidate(db_path)
 
     return tokens
 
@@ -6787,22 +8478,10 @@ def gdrive_connect():
 
 def refresh_gdrive_token(db_path):
     """تجديد توكن Google Drive"""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT value FROM settings WHERE key = 'gdrive_client_id'")
-    row = cursor.fetchone()
-    client_id = row['value'] if row else None
-
-    cursor.execute("SELECT value FROM settings WHERE key = 'gdrive_client_secret'")
-    row = cursor.fetchone()
-    client_secret = row['value'] if row else None
-
-    cursor.execute("SELECT value FROM settings WHERE key = 'gdrive_refresh_token'")
-    row = cursor.fetchone()
-    refresh_token = row['value'] if row else None
-    conn.close()
+    settings = settings_cache.get(db_path)
+    client_id = settings.get('gdrive_client_id')
+    client_secret = settings.get('gdrive_client_secret')
+    refresh_token = settings.get('gdrive_refresh_token')
 
     if not all([client_id, client_secret, refresh_token]):
         return None
@@ -6830,6 +8509,7 @@ def refresh_gdrive_token(db_path):
                            ('gdrive_token_expiry', str(time.time() + tokens.get('expires_in', 3600)), datetime.now().isoformat()))
             conn.commit()
             conn.close()
+            settings_cache.invalidate(db_path)
             return new_token
     except:
         pass
@@ -6837,18 +8517,9 @@ def refresh_gdrive_token(db_path):
 
 def get_gdrive_token(db_path):
     """الحصول على توكن Google Drive صالح"""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT value FROM settings WHERE key = 'gdrive_access_token'")
-    row = cursor.fetchone()
-    access_token = row['value'] if row else None
-
-    cursor.execute("SELECT value FROM settings WHERE key = 'gdrive_token_expiry'")
-    row = cursor.fetchone()
-    expiry = float(row['value']) if row else 0
-    conn.close()
+    settings = settings_cache.get(db_path)
+    access_token = settings.get('gdrive_access_token')
+    expiry = settings.get_float('gdrive_token_expiry', 0)
 
     if not access_token:
         return None
@@ -6866,18 +8537,9 @@ def gdrive_status():
         tenant_slug = get_tenant_slug()
         db_path = get_tenant_db_path(tenant_slug) if tenant_slug else DB_PATH
 
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT value FROM settings WHERE key = 'gdrive_refresh_token'")
-        row = cursor.fetchone()
-        has_token = bool(row and row['value'])
-
-        cursor.execute("SELECT value FROM settings WHERE key = 'gdrive_client_id'")
-        row = cursor.fetchone()
-        has_credentials = bool(row and row['value'])
-        conn.close()
+        settings = settings_cache.get(db_path)
+        has_token = bool(settings.get('gdrive_refresh_token'))
+        has_credentials = bool(settings.get('gdrive_client_id'))
 
         return jsonify({
             'success': True,
@@ -6901,6 +8563,7 @@ def gdrive_disconnect():
             cursor.execute("DELETE FROM settings WHERE key = ?", (key,))
         conn.commit()
         conn.close()
+        settings_cache.invalidate(db_path)
 
         return jsonify({'success': True})
     except Exception as e:
@@ -6909,7 +8572,7 @@ def gdrive_disconnect():
 
 @app.route('/api/backup/gdrive/upload', methods=['POST'])
 def gdrive_upload():
-    """رفع نسخة احتياطية إلى Google Drive"""
+    """رفع نسخة احتياطية إلى Google Drive (مهمة خلفية - تتابع عبر /api/jobs/<id>)"""
     try:
         tenant_slug = get_tenant_slug()
         db_path = get_tenant_db_path(tenant_slug) if tenant_slug else DB_PATH
@@ -6922,68 +8585,211 @@ def gdrive_upload():
         filename = data.get('filename')
 
         if filename:
-            safe_filename = re.sub(r'[^a-zA-Z0-9_.\-]', '', filename)
-            backup_dir = get_backup_dir(tenant_slug)
-            filepath = os.path.join(backup_dir, safe_filename)
-            if not os.path.exists(filepath):
+            safe_filename = safe_backup_filename(filename)
+            if not safe_filename or not os.path.exists(os.path.join(get_backup_dir(tenant_slug), safe_filename)):
                 return jsonify({'success': False, 'error': 'الملف غير موجود'}), 404
         else:
-            # إنشاء نسخة احتياطية جديدة ورفعها
-            backup_info, error = create_backup_file(tenant_slug)
-            if error:
-                return jsonify({'success': False, 'error': error}), 500
-            filepath = backup_info['path']
-            safe_filename = backup_info['filename']
+            # إنشاء نسخة احتياطية جديدة ورفعها (داخل المهمة)
+            safe_filename = None
 
-        # إنشاء/البحث عن مجلد POS-Backups في Google Drive
-        folder_id = _gdrive_find_or_create_folder(token, tenant_slug)
+        job_id = job_queue.submit('gdrive_upload', tenant_slug or '', params={'filename': safe_filename},
+                                  created_by=job_owner())
+        return jsonify({'success': True, 'job_id': job_id}), 202
+    except Exception as e:
+        print(f"API error [{request.path}]: {e}")
+        return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
 
-        # رفع الملف
-        store_name = tenant_slug or 'default'
-        upload_name = f'POS_{store_name}_{safe_filename}'
+@job_queue.handler('gdrive_upload')
+def _gdrive_upload_job(tenant_slug, params, report):
+    tenant_slug = tenant_slug or None
+    db_path = get_tenant_db_path(tenant_slug) if tenant_slug else DB_PATH
+    token = get_gdrive_token(db_path)
+    if not token:
+        raise RuntimeError('Google Drive غير متصل. يرجى الربط أولاً.')
 
-        boundary = '----BackupBoundary'
-        metadata = json.dumps({
-            'name': upload_name,
-            'parents': [folder_id] if folder_id else []
-        })
+    filename = params.get('filename')
+    if not filename:
+        backup_info, error = create_backup_file(tenant_slug, progress=report)
+        if error:
+            raise RuntimeError(error)
+        filename = backup_info['filename']
 
-        with open(filepath, 'rb') as f:
-            file_data = f.read()
+    try:
+        file_id, upload_name = upload_backup_to_gdrive(tenant_slug, token, filename, progress=report)
+    except urllib.error.HTTPError as e:
+        error_body = e.read().decode()
+        if e.code == 401:
+            raise RuntimeError('انتهت صلاحية التوكن. يرجى إعادة ربط Google Drive.')
+        raise RuntimeError(f'خطأ في Google Drive: {error_body}')
+    return {
+        'message': f'تم رفع النسخة إلى Google Drive بنجاح',
+        'file_id': file_id,
+        'file_name': upload_name
+    }
 
-        body = (
-            f'--{boundary}\r\n'
-            f'Content-Type: application/json; charset=UTF-8\r\n\r\n'
-            f'{metadata}\r\n'
-            f'--{boundary}\r\n'
-            f'Content-Type: application/x-sqlite3\r\n\r\n'
-        ).encode() + file_data + f'\r\n--{boundary}--'.encode()
+# الرفع بطريقة Drive القابلة للاستئناف (uploadType=resumable): جلسة رفع ثم أجزاء ثابتة
+# الحجم تُقرأ من القرص، فالذاكرة لا تتجاوز GDRIVE_CHUNK_SIZE مهما كبرت النسخة. كل جزء يُعاد
+# بتأخير متزايد عند أخطاء الشبكة/5xx/429، ورابط الجلسة يُحفظ بجانب النسخة فإعادة رفع نفس
+# النسخة بعد انقطاع أو انهيار تكمل من آخر بايت استلمه Drive.
+GDRIVE_CHUNK_SIZE = max(1, int(os.environ.get('POS_GDRIVE_CHUNK_MB', '8'))) * 1024 * 1024  # مضاعف 256KB
+GDRIVE_MAX_RETRIES = int(os.environ.get('POS_GDRIVE_MAX_RETRIES', '6'))
+GDRIVE_RETRY_BASE = 1.0  # ثوانٍ - يتضاعف مع كل محاولة
+GDRIVE_SESSION_MAX_AGE = 6 * 86400  # جلسات Drive تنتهي بعد أسبوع
+
+class GDriveUploadError(Exception):
+    """فشل نهائي في الرفع (بعد استنفاد المحاولات أو رفض من Drive)"""
+
+def _gdrive_request(url, token, method='PUT', data=None, headers=None):
+    """طلب إلى Drive - يعيد (status, headers, body) ويعامل 308 كرد عادي لا كتحويل"""
+    req = urllib.request.Request(url, data=data, method=method)
+    req.add_header('Authorization', f'Bearer {token}')
+    for k, v in (headers or {}).items():
+        req.add_header(k, v)
+    try:
+        with urllib.request.urlopen(req, timeout=120) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        if e.code == 308:  # Resume Incomplete
+            return 308, e.headers, b''
+        raise
+
+def _gdrive_received_bytes(headers):
+    """عدد البايتات التي استلمها Drive من ترويسة Range (bytes=0-N)"""
+    value = headers.get('Range') if headers else None
+    if not value:
+        return 0
+    return int(value.rsplit('-', 1)[1]) + 1
+
+def _gdrive_retryable(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, (urllib.error.URLError, TimeoutError, ConnectionError, OSError))
+
+def _gdrive_session_path(backup_dir, filename):
+    return os.path.join(backup_dir, f'.gdrive-{filename}.session.json')
+
+def _gdrive_start_session(token, upload_name, folder_id, total):
+    metadata = json.dumps({'name': upload_name, 'parents': [folder_id] if folder_id else []}).encode()
+    status, headers, _ = _gdrive_request(f'{GOOGLE_DRIVE_UPLOAD_URL}?uploadType=resumable', token, method='POST',
+                                         data=metadata, headers={
+                                             'Content-Type': 'application/json; charset=UTF-8',
+                                             'X-Upload-Content-Type': 'application/x-sqlite3',
+                                             'X-Upload-Content-Length': str(total),
+                                         })
+    session_url = headers.get('Location')
+    if not session_url:
+        raise GDriveUploadError(f'Drive لم يُعد رابط جلسة الرفع (HTTP {status})')
+    return session_url
+
+def gdrive_resumable_upload(token, filepath, upload_name, folder_id=None, session_path=None,
+                            fingerprint=None, progress=None):
+    """رفع ملف بأجزاء قابلة للاستئناف - يعيد بيانات الملف من Drive (id, name ...)"""
+    total = os.path.getsize(filepath)
+    session = None
+    if session_path and os.path.exists(session_path):
+        try:
+            with open(session_path, 'r', encoding='utf-8') as f:
+                session = json.load(f)
+            if (session.get('fingerprint') != fingerprint or session.get('total') != total
+                    or time.time() - session.get('started', 0) > GDRIVE_SESSION_MAX_AGE):
+                session = None
+        except (OSError, ValueError):
+            session = None
+
+    def save_session(url):
+        if session_path:
+            with open(session_path, 'w', encoding='utf-8') as f:
+                json.dump({'url': url, 'fingerprint': fingerprint, 'total': total,
+                           'name': upload_name, 'started': time.time()}, f)
+
+    def query_offset(url):
+        """استعلام Drive عن البايتات المستلمة - يعيد (offset, result) و result عند اكتمال الرفع"""
+        status, headers, body = _gdrive_request(url, token, data=b'', headers={
+            'Content-Range': f'bytes */{total}', 'Content-Length': '0'})
+        if status in (200, 201):
+            return total, json.loads(body.decode())
+        return _gdrive_received_bytes(headers), None
+
+    session_url = None
+    offset = 0
+    if session:
+        try:
+            offset, result = query_offset(session['url'])
+            if result is not None:
+                return result
+            session_url = session['url']
+            print(f"[GDrive] استئناف رفع {upload_name} من {offset} / {total}")
+        except urllib.error.HTTPError as e:
+            if e.code not in (404, 410):  # الجلسة انتهت: نبدأ من جديد
+                raise
+    if not session_url:
+        session_url = _gdrive_start_session(token, upload_name, folder_id, total)
+        save_session(session_url)
+        offset = 0
+
+    attempt = 0
+    with open(filepath, 'rb') as f:
+        while True:
+            if progress:
+                progress(offset, total, 'upload')
+            f.seek(offset)
+            data = f.read(GDRIVE_CHUNK_SIZE)
+            end = offset + len(data) - 1
+            content_range = f'bytes {offset}-{end}/{total}' if data else f'bytes */{total}'
+            try:
+                status, headers, body = _gdrive_request(session_url, token, data=data, headers={
+                    'Content-Range': content_range, 'Content-Length': str(len(data))})
+            except Exception as e:
+                if not _gdrive_retryable(e) or attempt >= GDRIVE_MAX_RETRIES:
+                    if isinstance(e, urllib.error.HTTPError) and e.code in (404, 410) \
+                            and session_path and os.path.exists(session_path):
+                        os.remove(session_path)  # الجلسة انتهت: المحاولة التالية تبدأ جلسة جديدة
+                    raise
+                delay = GDRIVE_RETRY_BASE * (2 ** attempt) * (1 + secrets.randbelow(250) / 1000)
+                attempt += 1
+                print(f"[GDrive] خطأ في جزء {offset}-{end} ({e}) - إعادة المحاولة {attempt} بعد {delay:.1f}s")
+                time.sleep(delay)
+                # الجزء ربما وصل جزئياً: نسأل Drive من أين نكمل
+                try:
+                    offset, result = query_offset(session_url)
+                    if result is not None:
+                        status, body = 200, json.dumps(result).encode()
+                    else:
+                        continue
+                except Exception as qe:
+                    if not _gdrive_retryable(qe):
+                        raise
+                    continue
+            attempt = 0
+            if status in (200, 201):
+                if session_path and os.path.exists(session_path):
+                    os.remove(session_path)
+                if progress:
+                    progress(total, total, 'upload')
+                return json.loads(body.decode())
+            offset = _gdrive_received_bytes(headers)
+
+def upload_backup_to_gdrive(tenant_slug, token, filename, progress=None):
+    """رفع نسخة احتياطية (لقطة أو .db) إلى مجلد المستأجر في Google Drive - تعيد (file_id, upload_name)"""
+    backup_dir = get_backup_dir(tenant_slug)
+    # إنشاء/البحث عن مجلد POS-Backups في Google Drive
+    folder_id = _gdrive_find_or_create_folder(token, tenant_slug)
 
-        req = urllib.request.Request(
-            f'{GOOGLE_DRIVE_UPLOAD_URL}?uploadType=multipart',
-            data=body,
-            method='POST'
-        )
-        req.add_header('Authorization', f'Bearer {token}')
-        req.add_header('Content-Type', f'multipart/related; boundary={boundary}')
+    store_name = tenant_slug or 'default'
+    upload_name = f'POS_{store_name}_{backup_store.snapshot_db_name(filename)}'
 
-        response = urllib.request.urlopen(req)
-        result = json.loads(response.read().decode())
+    # بصمة المحتوى: الجلسة المحفوظة تُستأنف فقط لنفس البايتات
+    if backup_store.is_snapshot(filename):
+        fingerprint = backup_store.read_manifest(backup_dir, filename)['sha256']
+    else:
+        stat = os.stat(os.path.join(backup_dir, filename))
+        fingerprint = f'{stat.st_size}:{stat.st_mtime_ns}'
 
-        return jsonify({
-            'success': True,
-            'message': f'تم رفع النسخة إلى Google Drive بنجاح',
-            'file_id': result.get('id'),
-            'file_name': upload_name
-        })
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode()
-        if e.code == 401:
-            return jsonify({'success': False, 'error': 'انتهت صلاحية التوكن. يرجى إعادة ربط Google Drive.'}), 401
-        return jsonify({'success': False, 'error': f'خطأ في Google Drive: {error_body}'}), 500
-    except Exception as e:
-        print(f"API error [{request.path}]: {e}")
-        return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
+    with backup_db_file(backup_dir, filename) as filepath:
+        result = gdrive_resumable_upload(token, filepath, upload_name, folder_id,
+                                         session_path=_gdrive_session_path(backup_dir, filename),
+                                         fingerprint=fingerprint, progress=progress)
+    return result.get('id'), upload_name
 
 def _gdrive_find_or_create_folder(token, tenant_slug=None):
     """البحث عن مجلد POS-Backups أو إنشاؤه"""
@@ -7047,128 +8853,386 @@ def gdrive_list_files():
         print(f"API error [{request.path}]: {e}")
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
 
-# ===== مجدول النسخ الاحتياطي التلقائي =====
+# ===== تشغيل مهام على كل المستأجرين (Process Pool) =====
+# الترقية والنسخ الاحتياطي الجماعي كانت تمر على المستأجرين واحداً تلو الآخر في خيط واحد.
+# run_tenant_jobs يوزعها على عدد محدود من العمليات (BULK_WORKERS) حتى لا يُشبع قرص الـ NAS،
+# ويُرجع ملخصاً بزمن ونتيجة/خطأ كل مستأجر. العمليات تُنشأ بـ spawn (لا fork) لأن الخادم
+# متعدد الخيوط وقد يرث fork أقفالاً محجوزة.
 
-_backup_scheduler_running = False
-
-def backup_scheduler_loop():
-    """حلقة المجدول - تعمل في خيط منفصل"""
-    global _backup_scheduler_running
-    _backup_scheduler_running = True
-    print("[Backup Scheduler] تم بدء مجدول النسخ الاحتياطي التلقائي")
+BULK_WORKERS = max(1, int(os.environ.get('POS_BULK_WORKERS', '2')))
+TENANT_JOB_KINDS = ('migrate', 'backup')
 
-    while _backup_scheduler_running:
-        try:
-            now = datetime.now()
-            current_time = now.strftime('%H:%M')
-
-            # فحص كل قواعد البيانات (الافتراضية + المستأجرين)
-            db_paths = [('', DB_PATH)]
-            if os.path.exists(TENANTS_DB_DIR):
-                for f in os.listdir(TENANTS_DB_DIR):
-                    if f.endswith('.db'):
-                        slug = f[:-3]
-                        db_paths.append((slug, os.path.join(TENANTS_DB_DIR, f)))
-
-            for tenant_slug, db_path in db_paths:
+def _run_tenant_job(kind, name, db_path, options=None):
+    """تنفيذ مهمة واحدة لمستأجر (داخل عملية من المجمع) - لا ترفع استثناء"""
+    options = options or {}
+    started = time.perf_counter()
+    result = {'tenant': name, 'ok': True}
+    try:
+        if kind == 'migrate':
+            before = read_schema_version(db_path)
+            ensure_db_tables(db_path, force=options.get('force', False))
+            result['from_version'] = before
+            result['version'] = read_schema_version(db_path)
+            if result['version'] != SCHEMA_VERSION:
+                result.update(ok=False, error=f'schema still at v{result["version"]}')
+        elif kind == 'backup':
+            backup_info, error = create_backup_file(None if name == 'default' else name)
+            if error:
+                result.update(ok=False, error=error)
+            else:
+                result['backup'] = backup_info
+        else:
+            result.update(ok=False, error=f'unknown job {kind}')
+    except Exception as e:
+        result.update(ok=False, error=str(e))
+    result['seconds'] = round(time.perf_counter() - started, 3)
+    return result
+
+def _run_tenant_job_batch(kind, batch, options=None):
+    """عدة مستأجرين في مهمة واحدة للمجمع - تقلل كلفة التواصل بين العمليات للقواعد الصغيرة"""
+    return [_run_tenant_job(kind, name, db_path, options) for name, db_path in batch]
+
+def run_tenant_jobs(kind, targets, workers=None, options=None, progress=None):
+    """تشغيل kind على [(name, db_path), ...] بعدد عمليات محدود.
+    progress(done, total, result) يُستدعى في العملية الأم بعد كل مستأجر."""
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import multiprocessing
+    targets = list(targets)
+    workers = max(1, min(workers or BULK_WORKERS, len(targets) or 1))
+    started = time.perf_counter()
+    results = []
+
+    def record(result):
+        results.append(result)
+        if progress:
+            progress(len(results), len(targets), result)
+
+    if workers == 1:
+        # بدون مجمع: أرخص لمستأجر واحد أو عند POS_BULK_WORKERS=1
+        for name, db_path in targets:
+            record(_run_tenant_job(kind, name, db_path, options))
+    else:
+        # دفعات صغيرة: ~4 دفعات لكل عملية تحافظ على توازن الحمل وتقلل الرسائل بين العمليات
+        size = max(1, len(targets) // (workers * 4))
+        batches = [targets[i:i + size] for i in range(0, len(targets), size)]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = {pool.submit(_run_tenant_job_batch, kind, batch, options): batch for batch in batches}
+            for future in as_completed(futures):
                 try:
-                    conn = sqlite3.connect(db_path)
-                    conn.row_factory = sqlite3.Row
-                    cursor = conn.cursor()
+                    batch_results = future.result()
+                except Exception as e:  # عملية انهارت (BrokenProcessPool وغيرها)
+                    batch_results = [{'tenant': name, 'ok': False, 'error': str(e), 'seconds': None}
+                                     for name, _ in futures[future]]
+                for result in batch_results:
+                    record(result)
+
+    failed = [r for r in results if not r['ok']]
+    timed = sorted((r for r in results if r.get('seconds') is not None), key=lambda r: r['seconds'], reverse=True)
+    return {
+        'kind': kind,
+        'workers': workers,
+        'total': len(results),
+        'succeeded': len(results) - len(failed),
+        'failed': len(failed),
+        'seconds': round(time.perf_counter() - started, 3),
+        'slowest': [{'tenant': r['tenant'], 'seconds': r['seconds']} for r in timed[:5]],
+        'errors': [{'tenant': r['tenant'], 'error': r['error']} for r in failed],
+        'results': sorted(results, key=lambda r: r['tenant']),
+    }
 
-                    cursor.execute("SELECT value FROM settings WHERE key = 'backup_schedule_enabled'")
-                    row = cursor.fetchone()
-                    enabled = row and row['value'] == 'true'
+def _echo_tenant_job_summary(summary, json_path=None):
+    click.echo(f"{summary['kind']}: {summary['succeeded']}/{summary['total']} ok, "
+               f"{summary['failed']} failed, {summary['seconds']:.2f}s with {summary['workers']} workers")
+    for slow in summary['slowest']:
+        click.echo(f"  slowest {slow['tenant']}: {slow['seconds']:.2f}s")
+    for err in summary['errors']:
+        click.echo(f"  ERROR {err['tenant']}: {err['error']}")
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+def _echo_tenant_job_progress(done, total, result):
+    status = 'ok' if result['ok'] else f"ERROR {result['error']}"
+    click.echo(f"[{done}/{total}] {result['tenant']}: {status} ({result.get('seconds') or 0:.2f}s)")
+
+@app.cli.command('migrate-tenants')
+@click.option('--tenant', default=None, help='slug المستأجر (الافتراضي: الكل)')
+@click.option('--force', is_flag=True, help='إعادة الترقية حتى لو كان الإصدار مطابقاً')
+@click.option('--workers', default=None, type=int, help='عدد العمليات المتوازية (الافتراضي POS_BULK_WORKERS)')
+@click.option('--json', 'json_path', default=None, help='حفظ الملخص بصيغة JSON')
+def migrate_tenants_command(tenant, force, workers, json_path):
+    """ترقية مخطط القاعدة الافتراضية وكل المستأجرين مسبقاً"""
+    summary = run_tenant_jobs('migrate', iter_database_paths(tenant), workers=workers,
+                              options={'force': force}, progress=_echo_tenant_job_progress)
+    _echo_tenant_job_summary(summary, json_path)
+    if summary['failed']:
+        raise SystemExit(1)
+
+@app.cli.command('backup-tenants')
+@click.option('--tenant', default=None, help='slug المستأجر (الافتراضي: الكل)')
+@click.option('--workers', default=None, type=int, help='عدد العمليات المتوازية (الافتراضي POS_BULK_WORKERS)')
+@click.option('--json', 'json_path', default=None, help='حفظ الملخص بصيغة JSON')
+def backup_tenants_command(tenant, workers, json_path):
+    """نسخ احتياطي للقاعدة الافتراضية وكل المستأجرين"""
+    summary = run_tenant_jobs('backup', iter_database_paths(tenant), workers=workers,
+                              progress=_echo_tenant_job_progress)
+    _echo_tenant_job_summary(summary, json_path)
+    if summary['failed']:
+        raise SystemExit(1)
 
-                    if not enabled:
-                        conn.close()
-                        continue
+# ===== مجدول النسخ الاحتياطي التلقائي =====
 
-                    cursor.execute("SELECT value FROM settings WHERE key = 'backup_schedule_time'")
-                    row = cursor.fetchone()
-                    schedule_time = row['value'] if row else '03:00'
+# المجدول يحفظ لكل مستأجر موعد تشغيله التالي في heap وينام حتى أقرب موعد، بدل فتح كل
+# القواعد كل 60 ثانية. الجدولة تُقرأ عند البدء وعند تعديلها (reload من /api/backup/schedule
+# والاستعادة) ومرة كل BACKUP_SCHEDULER_RESYNC ثانية للتقاط أي تعديل من خارج هذه العملية.
+# backup_runs يسجل آخر تشغيل، فالموعد الذي فات (الخادم متوقف أو مشغول) يُنفذ فور البدء.
+# لا يُكتب في settings: triggers الـ change_log عليها تغير ختم الإعدادات وETag المزامنة كل ليلة.
 
-                    cursor.execute("SELECT value FROM settings WHERE key = 'backup_keep_days'")
-                    row = cursor.fetchone()
-                    keep_days = int(row['value']) if row else 30
+BACKUP_SCHEDULER_RESYNC = float(os.environ.get('POS_BACKUP_SCHEDULER_RESYNC', '3600'))
 
-                    cursor.execute("SELECT value FROM settings WHERE key = 'backup_gdrive_auto'")
-                    row = cursor.fetchone()
-                    gdrive_auto = row and row['value'] == 'true'
-                    conn.close()
+def _scheduled_gdrive_upload(tenant_slug, db_path, backup_info):
+    """رفع نسخة المجدول إلى Google Drive"""
+    token = get_gdrive_token(db_path)
+    if not token:
+        return
+    upload_backup_to_gdrive(tenant_slug or None, token, backup_info['filename'])
+    print(f"[Backup Scheduler] تم رفع النسخة إلى Google Drive")
 
-                    # التحقق من الوقت (مع هامش دقيقة واحدة)
-                    if current_time == schedule_time:
-                        slug_label = tenant_slug or 'default'
-                        print(f"[Backup Scheduler] بدء نسخ احتياطي تلقائي لـ {slug_label}")
+def _schedule_clock(schedule_time):
+    """'HH:MM' -> (ساعة, دقيقة) مع 03:00 للقيم غير الصالحة"""
+    try:
+        hour, minute = (int(x) for x in str(schedule_time).split(':')[:2])
+        if 0 <= hour < 24 and 0 <= minute < 60:
+            return hour, minute
+    except ValueError:
+        pass
+    return 3, 0
 
-                        backup_info, error = create_backup_file(tenant_slug if tenant_slug else None)
-                        if error:
-                            print(f"[Backup Scheduler] خطأ: {error}")
-                        else:
-                            print(f"[Backup Scheduler] تم إنشاء نسخة: {backup_info['filename']}")
+def next_backup_run(schedule_time, after):
+    """أول موعد HH:MM بعد after"""
+    hour, minute = _schedule_clock(schedule_time)
+    run = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return run if run > after else run + timedelta(days=1)
 
-                            # رفع تلقائي إلى Google Drive
-                            if gdrive_auto:
-                                try:
-                                    token = get_gdrive_token(db_path)
-                                    if token:
-                                        folder_id = _gdrive_find_or_create_folder(token, tenant_slug if tenant_slug else None)
-                                        store_name = tenant_slug or 'default'
-                                        upload_name = f'POS_{store_name}_{backup_info["filename"]}'
-
-                                        boundary = '----BackupBoundary'
-                                        metadata = json.dumps({
-                                            'name': upload_name,
-                                            'parents': [folder_id] if folder_id else []
-                                        })
-
-                                        with open(backup_info['path'], 'rb') as bf:
-                                            file_data = bf.read()
-
-                                        body = (
-                                            f'--{boundary}\r\n'
-                                            f'Content-Type: application/json; charset=UTF-8\r\n\r\n'
-                                            f'{metadata}\r\n'
-                                            f'--{boundary}\r\n'
-                                            f'Content-Type: application/x-sqlite3\r\n\r\n'
-                                        ).encode() + file_data + f'\r\n--{boundary}--'.encode()
-
-                                        req = urllib.request.Request(
-                                            f'{GOOGLE_DRIVE_UPLOAD_URL}?uploadType=multipart',
-                                            data=body, method='POST'
-                                        )
-                                        req.add_header('Authorization', f'Bearer {token}')
-                                        req.add_header('Content-Type', f'multipart/related; boundary={boundary}')
-                                        urllib.request.urlopen(req)
-                                        print(f"[Backup Scheduler] تم رفع النسخة إلى Google Drive")
-                                except Exception as ge:
-                                    print(f"[Backup Scheduler] خطأ في رفع Google Drive: {ge}")
-
-                        # حذف النسخ القديمة
-                        _cleanup_old_backups(tenant_slug if tenant_slug else None, keep_days)
-
-                except Exception as te:
-                    print(f"[Backup Scheduler] خطأ للمستأجر: {te}")
+def last_backup_occurrence(schedule_time, now):
+    """آخر موعد HH:MM حلّ حتى now"""
+    return next_backup_run(schedule_time, now) - timedelta(days=1)
+
+def read_last_backup_run(conn):
+    """وقت آخر تشغيل في backup_runs - None إن لم يُسجل (أو لم تُرقَّ القاعدة بعد إلى migration 014)"""
+    try:
+        row = conn.execute('SELECT ran_at FROM backup_runs ORDER BY id DESC LIMIT 1').fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return datetime.fromisoformat(row[0]) if row else None
+
+def record_backup_run(conn, ok=True, filename=None):
+    """تسجيل تشغيل في backup_runs (خارج settings فلا يتغير ختم الإعدادات) - الالتزام على المستدعي"""
+    conn.execute('INSERT INTO backup_runs (ran_at, ok, filename) VALUES (?, ?, ?)',
+                 (datetime.now().isoformat(), 1 if ok else 0, filename))
+
+def read_backup_schedule(db_path):
+    """إعدادات جدولة النسخ لقاعدة"""
+    # اتصال مباشر لا من المجمع: المزامنة تمر على كل القواعد فتطرد اتصالات الطلبات من LRU
+    conn = sqlite3.connect(db_path)
+    try:
+        settings = settings_cache.get(db_path, conn)
+        last_run = read_last_backup_run(conn)
+    finally:
+        conn.close()
+    return {
+        'enabled': settings.get_bool('backup_schedule_enabled'),
+        'time': settings.get('backup_schedule_time') or '03:00',
+        'keep_days': settings.get_int('backup_keep_days', 30),
+        'gdrive_auto': settings.get_bool('backup_gdrive_auto'),
+        'last_run': last_run,
+    }
 
+class BackupScheduler:
+    """مواعيد النسخ التالية لكل مستأجر في heap - التشغيل عند حلول أقربها"""
+
+    def __init__(self, resync_interval=BACKUP_SCHEDULER_RESYNC):
+        self.resync_interval = resync_interval
+        self._cond = threading.Condition()
+        self._heap = []      # [(due timestamp, name)] - قد يحوي مواعيد قديمة تُتجاهل
+        self._entries = {}   # {name: (due timestamp, tenant_slug, db_path, schedule)}
+        self._running = False
+        self._stats = {'loads': 0, 'runs': 0, 'catch_up': 0, 'errors': 0}
+
+    def _load(self, name, db_path, now):
+        """قراءة جدولة مستأجر وحساب موعده - يُستدعى و _cond محجوز"""
+        tenant_slug = '' if name == 'default' else name
+        self._stats['loads'] += 1
+        try:
+            schedule = read_backup_schedule(db_path) if os.path.exists(db_path) else None
         except Exception as e:
-            print(f"[Backup Scheduler] خطأ عام: {e}")
+            print(f"[Backup Scheduler] خطأ في قراءة جدولة {name}: {e}")
+            self._stats['errors'] += 1
+            schedule = None
+        if not schedule or not schedule['enabled']:
+            self._entries.pop(name, None)
+            return
+
+        # موعد فات منذ آخر تشغيل (أو منذ آخر نسخة إن لم يُسجل تشغيل) يُنفذ الآن
+        reference = schedule['last_run']
+        if reference is None:
+            backups = list_backup_entries(get_backup_dir(tenant_slug or None))
+            reference = datetime.fromisoformat(backups[0]['created_at']) if backups else None
+        if reference is None or reference < last_backup_occurrence(schedule['time'], now):
+            due = now
+            self._stats['catch_up'] += 1
+        else:
+            due = next_backup_run(schedule['time'], now)
+
+        current = self._entries.get(name)
+        if current and current[0] == due.timestamp():
+            self._entries[name] = (current[0], tenant_slug, db_path, schedule)
+            return
+        self._entries[name] = (due.timestamp(), tenant_slug, db_path, schedule)
+        heapq.heappush(self._heap, (due.timestamp(), name))
+
+    def reload(self, tenant_slug=None):
+        """إعادة قراءة جدولة مستأجر بعد تعديلها ('' للافتراضية)"""
+        name = tenant_slug or 'default'
+        with self._cond:
+            self._load(name, get_tenant_db_path(tenant_slug) if tenant_slug else DB_PATH, datetime.now())
+            self._cond.notify()
+
+    def resync(self):
+        """قراءة جدولة كل القواعد (عند البدء وكل resync_interval)"""
+        now = datetime.now()
+        targets = dict(iter_database_paths())
+        with self._cond:
+            for name in list(self._entries):
+                if name not in targets:
+                    self._entries.pop(name)
+            for name, db_path in targets.items():
+                self._load(name, db_path, now)
+            self._cond.notify()
+
+    def _pop_due(self, now_ts):
+        """المستأجرون الذين حان موعدهم - يُستدعى و _cond محجوز"""
+        due = {}
+        while self._heap and self._heap[0][0] <= now_ts:
+            due_ts, name = heapq.heappop(self._heap)
+            entry = self._entries.get(name)
+            if entry and entry[0] == due_ts:
+                _, tenant_slug, db_path, schedule = entry
+                due[name] = (tenant_slug, db_path, schedule['keep_days'], schedule['gdrive_auto'])
+        return due
+
+    def next_due(self):
+        with self._cond:
+            live = [ts for ts, name in self._heap if self._entries.get(name, (None,))[0] == ts]
+        return datetime.fromtimestamp(min(live)) if live else None
+
+    def run(self):
+        """حلقة المجدول - تعمل في خيط منفصل"""
+        self._running = True
+        print("[Backup Scheduler] تم بدء مجدول النسخ الاحتياطي التلقائي")
+        next_resync = 0
+        while self._running:
+            try:
+                if time.time() >= next_resync:
+                    self.resync()
+                    next_resync = time.time() + self.resync_interval
+                with self._cond:
+                    wake_at = min(self._heap[0][0] if self._heap else next_resync, next_resync)
+                    if wake_at > time.time():
+                        self._cond.wait(timeout=wake_at - time.time())
+                    due = self._pop_due(time.time())
+                if due:
+                    _run_scheduled_backups(due)
+                    self._stats['runs'] += len(due)
+                    # الموعد التالي يُحسب بعد تسجيل التشغيل في backup_runs
+                    with self._cond:
+                        now = datetime.now()
+                        for name, (tenant_slug, db_path, _, _) in due.items():
+                            self._entries.pop(name, None)
+                            self._load(name, db_path, now)
+            except Exception as e:
+                self._stats['errors'] += 1
+                print(f"[Backup Scheduler] خطأ عام: {e}")
+                time.sleep(60)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def stats(self):
+        next_run = self.next_due()
+        with self._cond:
+            return dict(self._stats, scheduled=len(self._entries),
+                        next_run=next_run.isoformat() if next_run else None)
+
+backup_scheduler = BackupScheduler()
+
+def _run_scheduled_backups(due):
+    """تنفيذ نسخ المستأجرين المستحقين: {name: (tenant_slug, db_path, keep_days, gdrive_auto)}"""
+    print(f"[Backup Scheduler] بدء نسخ احتياطي تلقائي لـ {', '.join(due)}")
+    summary = run_tenant_jobs('backup', [(name, item[1]) for name, item in due.items()])
+    for result in summary['results']:
+        tenant_slug, db_path, keep_days, gdrive_auto = due[result['tenant']]
+        try:
+            if not result['ok']:
+                print(f"[Backup Scheduler] خطأ ({result['tenant']}): {result['error']}")
+            else:
+                backup_info = result['backup']
+                print(f"[Backup Scheduler] تم إنشاء نسخة: {backup_info['filename']} ({result['seconds']:.2f}s)")
+
+                # رفع تلقائي إلى Google Drive
+                if gdrive_auto:
+                    try:
+                        _scheduled_gdrive_upload(tenant_slug, db_path, backup_info)
+                    except Exception as ge:
+                        print(f"[Backup Scheduler] خطأ في رفع Google Drive: {ge}")
+
+            # تسجيل التشغيل (حتى عند الفشل - لا نكرر المحاولة كل دقيقة)
+            ensure_db_tables(db_path)
+            conn = sqlite3.connect(db_path)
+            record_backup_run(conn, ok=result['ok'], filename=result['backup']['filename'] if result['ok'] else None)
+            conn.commit()
+            conn.close()
+
+            # حذف النسخ القديمة
+            _cleanup_old_backups(tenant_slug if tenant_slug else None, keep_days)
+        except Exception as te:
+            print(f"[Backup Scheduler] خطأ للمستأجر: {te}")
+
+def backup_scheduler_loop():
+    """حلقة المجدول - تعمل في خيط منفصل"""
+    backup_scheduler.run()
 
-        # الانتظار 60 ثانية قبل الفحص التالي
-        time.sleep(60)
+@app.route('/api/super-admin/backup-scheduler/stats', methods=['GET'])
+def super_admin_backup_scheduler_stats():
+    """حالة مجدول النسخ في هذه العملية (عدد المستأجرين المجدولين وأقرب موعد)"""
+    return jsonify({'success': True, 'pid': os.getpid(), 'stats': backup_scheduler.stats()})
 
 def _cleanup_old_backups(tenant_slug, keep_days):
     """حذف النسخ الاحتياطية الأقدم من عدد الأيام المحدد"""
     backup_dir = get_backup_dir(tenant_slug)
     cutoff = time.time() - (keep_days * 86400)
 
+    removed_snapshot = False
     for f in os.listdir(backup_dir):
-        if f.endswith('.db'):
+        # جلسات رفع Google Drive لم تكتمل وانتهت صلاحيتها عند Drive
+        if f.startswith('.gdrive-') and os.path.getmtime(os.path.join(backup_dir, f)) < time.time() - GDRIVE_SESSION_MAX_AGE:
+            os.remove(os.path.join(backup_dir, f))
+            continue
+        if f.endswith(BACKUP_SUFFIXES) and not f.startswith('.'):
             fpath = os.path.join(backup_dir, f)
             if os.path.getmtime(fpath) < cutoff:
                 os.remove(fpath)
+                removed_snapshot = removed_snapshot or backup_store.is_snapshot(f)
                 print(f"[Backup Cleanup] تم حذف نسخة قديمة: {f}")
 
+    # الأجزاء التي لم تعد أي لقطة تشير إليها
+    if removed_snapshot:
+        files, freed = backup_store.collect_garbage(backup_dir)
+        if files:
+            print(f"[Backup Cleanup] تم تحرير {files} جزء ({freed // 1024} KB)")
+
 # ===== شاشة الأدمن - لوحة مراقبة الشركة =====
 
 @app.route('/api/admin-dashboard/invoices-summary', methods=['GET'])
@@ -7187,13 +9251,13 @@ def admin_dashboard_invoices_summary():
             SELECT
                 b.id as branch_id,
                 b.name as branch_name,
-                COUNT(i.id) as total_invoices,
-                COALESCE(SUM(i.total), 0) as total_sales,
-                COUNT(CASE WHEN i.cancelled = 1 THEN 1 END) as cancelled_invoices,
-                COUNT(CASE WHEN DATE(i.created_at) = DATE('now') THEN 1 END) as today_invoices,
-                COALESCE(SUM(CASE WHEN DATE(i.created_at) = DATE('now') THEN i.total ELSE 0 END), 0) as today_sales
+                COALESCE(SUM(r.invoice_count), 0) as total_invoices,
+                COALESCE(SUM(r.total), 0) as total_sales,
+                COALESCE(SUM(CASE WHEN r.cancelled = 1 THEN r.invoice_count END), 0) as cancelled_invoices,
+                COALESCE(SUM(CASE WHEN r.day = DATE('now') THEN r.invoice_count END), 0) as today_invoices,
+                COALESCE(SUM(CASE WHEN r.day = DATE('now') THEN r.total ELSE 0 END), 0) as today_sales
             FROM branches b
-            LEFT JOIN invoices i ON i.branch_id = b.id
+            LEFT JOIN daily_sales_rollup r ON r.branch_id = b.id
             WHERE b.is_active = 1
             GROUP BY b.id, b.name
             ORDER BY b.id
@@ -7203,12 +9267,12 @@ def admin_dashboard_invoices_summary():
         # إجمالي عام
         cursor.execute('''
             SELECT
-                COUNT(id) as total_invoices,
+                COALESCE(SUM(invoice_count), 0) as total_invoices,
                 COALESCE(SUM(total), 0) as total_sales,
-                COUNT(CASE WHEN cancelled = 1 THEN 1 END) as cancelled_invoices,
-                COUNT(CASE WHEN DATE(created_at) = DATE('now') THEN 1 END) as today_invoices,
-                COALESCE(SUM(CASE WHEN DATE(created_at) = DATE('now') THEN total ELSE 0 END), 0) as today_sales
-            FROM invoices
+                COALESCE(SUM(CASE WHEN cancelled = 1 THEN invoice_count END), 0) as cancelled_invoices,
+                COALESCE(SUM(CASE WHEN day = DATE('now') THEN invoice_count END), 0) as today_invoices,
+                COALESCE(SUM(CASE WHEN day = DATE('now') THEN total ELSE 0 END), 0) as today_sales
+            FROM daily_sales_rollup
         ''')
         overall = dict(cursor.fetchone())
 
@@ -7224,6 +9288,7 @@ def admin_dashboard_invoices_summary():
 
 
 @app.route('/api/admin-dashboard/stock-summary', methods=['GET'])
+@etag_from_change_version()
 def admin_dashboard_stock_summary():
     """ملخص المخزون لكل منتج في كل فرع"""
     try:
@@ -7295,39 +9360,6 @@ def admin_dashboard_stock_summary():
 
 # ===== XBRL / IFRS =====
 
-def ensure_xbrl_tables(cursor):
-    """إنشاء جداول XBRL إذا لم تكن موجودة"""
-    try:
-        cursor.execute('''CREATE TABLE IF NOT EXISTS xbrl_company_info (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            company_name_ar TEXT,
-            company_name_en TEXT,
-            commercial_registration TEXT,
-            tax_number TEXT,
-            reporting_currency TEXT DEFAULT 'SAR',
-            industry_sector TEXT,
-            country TEXT DEFAULT 'SA',
-            fiscal_year_end TEXT DEFAULT '12-31',
-            legal_form TEXT,
-            contact_email TEXT,
-            contact_phone TEXT,
-            address TEXT,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS xbrl_reports (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            report_type TEXT NOT NULL,
-            period_start TEXT NOT NULL,
-            period_end TEXT NOT NULL,
-            report_data TEXT,
-            xbrl_xml TEXT,
-            created_by INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            notes TEXT
-        )''')
-    except Exception as e:
-        print(f"[XBRL] ensure_xbrl_tables: {e}")
-
 @app.route('/api/xbrl/company-info', methods=['GET'])
 @require_feature('xbrl')
 def get_xbrl_company_info():
@@ -7335,8 +9367,6 @@ def get_xbrl_company_info():
     try:
         conn = get_db()
         cursor = conn.cursor()
-        ensure_xbrl_tables(cursor)
-        conn.commit()
         cursor.execute('SELECT * FROM xbrl_company_info ORDER BY id DESC LIMIT 1')
         row = cursor.fetchone()
         conn.close()
@@ -7354,8 +9384,6 @@ def save_xbrl_company_info():
         data = request.json
         conn = get_db()
         cursor = conn.cursor()
-        ensure_xbrl_tables(cursor)
-        conn.commit()
         cursor.execute('SELECT id FROM xbrl_company_info ORDER BY id DESC LIMIT 1')
         existing = cursor.fetchone()
         if existing:
@@ -7403,14 +9431,8 @@ def get_xbrl_financial_data():
         conn = get_db()
         cursor = conn.cursor()
 
-        date_filter = ''
-        date_params = []
-        if start_date:
-            date_filter += ' AND date(created_at) >= ?'
-            date_params.append(start_date)
-        if end_date:
-            date_filter += ' AND date(created_at) <= ?'
-            date_params.append(end_date)
+        date_filter, date_params = sql_date_range('created_at', start_date, end_date)
+        rollup_filter, _ = sql_date_range('day', start_date, end_date)
 
         branch_filter = ''
         branch_params = []
@@ -7423,19 +9445,19 @@ def get_xbrl_financial_data():
 
         # === الإيرادات (Revenue) - IFRS 15 ===
         cursor.execute(f'''SELECT
-            COUNT(*) as invoice_count,
+            COALESCE(SUM(invoice_count), 0) as invoice_count,
             COALESCE(SUM(total), 0) as total_revenue,
             COALESCE(SUM(subtotal), 0) as gross_revenue,
             COALESCE(SUM(discount), 0) as total_discounts,
             COALESCE(SUM(delivery_fee), 0) as delivery_revenue,
             COALESCE(SUM(coupon_discount), 0) as coupon_discounts,
             COALESCE(SUM(loyalty_discount), 0) as loyalty_discounts
-            FROM invoices WHERE cancelled = 0 {date_filter} {branch_filter}''',
+            FROM daily_sales_rollup WHERE cancelled = 0 {rollup_filter} {branch_filter}''',
             date_params + branch_params)
         revenue = dict_from_row(cursor.fetchone())
 
         # === تكلفة البضاعة المباعة (COGS) ===
-        cogs_date_filter = date_filter.replace('created_at', 'i.created_at')
+        cogs_date_filter, _ = sql_date_range('i.created_at', start_date, end_date)
         cogs_branch_filter = branch_filter.replace('branch_name', 'i.branch_name')
         cursor.execute(f'''SELECT
             COALESCE(SUM(ii.quantity * COALESCE(inv.cost, 0)), 0) as total_cogs
@@ -7448,14 +9470,7 @@ def get_xbrl_financial_data():
         total_cogs = cogs_data['total_cogs'] or 0
 
         # === المصروفات التشغيلية (Operating Expenses) ===
-        exp_date_filter = ''
-        exp_params = []
-        if start_date:
-            exp_date_filter += ' AND date(expense_date) >= ?'
-            exp_params.append(start_date)
-        if end_date:
-            exp_date_filter += ' AND date(expense_date) <= ?'
-            exp_params.append(end_date)
+        exp_date_filter, exp_params = sql_date_range('expense_date', start_date, end_date)
         exp_branch_filter = ''
         if branch_id:
             exp_branch_filter = ' AND branch_id = ?'
@@ -7475,14 +9490,7 @@ def get_xbrl_financial_data():
             total_expenses += r['type_total']
 
         # رواتب (من salary_details)
-        salary_params = []
-        salary_date_filter = ''
-        if start_date:
-            salary_date_filter += ' AND date(e.expense_date) >= ?'
-            salary_params.append(start_date)
-        if end_date:
-            salary_date_filter += ' AND date(e.expense_date) <= ?'
-            salary_params.append(end_date)
+        salary_date_filter, salary_params = sql_date_range('e.expense_date', start_date, end_date)
         cursor.execute(f'''SELECT COALESCE(SUM(sd.monthly_salary), 0) as total_salaries
             FROM salary_details sd
             JOIN expenses e ON sd.expense_id = e.id
@@ -7520,17 +9528,17 @@ def get_xbrl_financial_data():
         total_refunds = returns_data.get('total_refunds', 0) or 0
 
         # === المبيعات حسب طريقة الدفع ===
-        cursor.execute(f'''SELECT payment_method,
-            COUNT(*) as count, COALESCE(SUM(total), 0) as total
-            FROM invoices WHERE cancelled = 0 {date_filter} {branch_filter}
+        cursor.execute(f'''SELECT NULLIF(payment_method, '') as payment_method,
+            SUM(invoice_count) as count, COALESCE(SUM(total), 0) as total
+            FROM daily_sales_rollup WHERE cancelled = 0 {rollup_filter} {branch_filter}
             GROUP BY payment_method''', date_params + branch_params)
         payment_rows = cursor.fetchall()
         payments = [dict_from_row(r) for r in payment_rows]
 
         # === المبيعات حسب الفرع ===
-        cursor.execute(f'''SELECT branch_name,
-            COUNT(*) as count, COALESCE(SUM(total), 0) as total
-            FROM invoices WHERE cancelled = 0 {date_filter} {branch_filter}
+        cursor.execute(f'''SELECT NULLIF(branch_name, '') as branch_name,
+            SUM(invoice_count) as count, COALESCE(SUM(total), 0) as total
+            FROM daily_sales_rollup WHERE cancelled = 0 {rollup_filter} {branch_filter}
             GROUP BY branch_name''', date_params + branch_params)
         branch_rows = cursor.fetchall()
         branches_data = [dict_from_row(r) for r in branch_rows]
@@ -8114,8 +10122,6 @@ def generate_xbrl():
         # حفظ التقرير
         conn = get_db()
         cursor = conn.cursor()
-        ensure_xbrl_tables(cursor)
-        conn.commit()
         report_data_json = json.dumps({
             'revenue': total_revenue,
             'cost_of_sales': cost_of_sales,
@@ -8204,8 +10210,6 @@ def list_xbrl_reports():
     try:
         conn = get_db()
         cursor = conn.cursor()
-        ensure_xbrl_tables(cursor)
-        conn.commit()
         cursor.execute('SELECT id, report_type, period_start, period_end, created_at, notes FROM xbrl_reports ORDER BY created_at DESC LIMIT 50')
         rows = cursor.fetchall()
         conn.close()
@@ -8221,8 +10225,6 @@ def get_xbrl_report(report_id):
     try:
         conn = get_db()
         cursor = conn.cursor()
-        ensure_xbrl_tables(cursor)
-        conn.commit()
         cursor.execute('SELECT * FROM xbrl_reports WHERE id = ?', (report_id,))
         row = cursor.fetchone()
         conn.close()
@@ -8296,6 +10298,7 @@ def update_shift(shift_id):
         ))
         conn.commit()
         conn.close()
+        name_cache.invalidate(get_tenant_db_path(get_tenant_slug()), 'shifts')
         return jsonify({'success': True})
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
@@ -8312,6 +10315,7 @@ def delete_shift(shift_id):
         cursor.execute('DELETE FROM shifts WHERE id = ?', (shift_id,))
         conn.commit()
         conn.close()
+        name_cache.invalidate(get_tenant_db_path(get_tenant_slug()), 'shifts')
         return jsonify({'success': True})
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
@@ -8402,45 +10406,46 @@ def edit_invoice(invoice_id):
         cursor.execute('SELECT * FROM invoice_items WHERE invoice_id = ?', (invoice_id,))
         old_items = [dict_from_row(row) for row in cursor.fetchall()]
 
-        # إرجاع المخزون القديم
-        for item in old_items:
-            bs_id = item.get('branch_stock_id')
-            if bs_id:
-                cursor.execute('''
-                    UPDATE branch_stock
-                    SET stock = stock + ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (item.get('quantity', 0), bs_id))
+        with stock_movement_reason(cursor, 'invoice_edit', invoice_id):
+            # إرجاع المخزون القديم
+            for item in old_items:
+                bs_id = item.get('branch_stock_id')
+                if bs_id:
+                    cursor.execute('''
+                        UPDATE branch_stock
+                        SET stock = stock + ?, updated_at = CURRENT_TIMESTAMP
+                        WHERE id = ?
+                    ''', (item.get('quantity', 0), bs_id))
 
-        # حذف العناصر القديمة
-        cursor.execute('DELETE FROM invoice_items WHERE invoice_id = ?', (invoice_id,))
+            # حذف العناصر القديمة
+            cursor.execute('DELETE FROM invoice_items WHERE invoice_id = ?', (invoice_id,))
 
-        # إدراج العناصر الجديدة وخصم المخزون
-        new_items = data.get('items', [])
-        for item in new_items:
-            branch_stock_id = item.get('branch_stock_id') or item.get('product_id')
-            cursor.execute('''
-                INSERT INTO invoice_items
-                (invoice_id, product_id, product_name, quantity, price, total, branch_stock_id, variant_id, variant_name)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                invoice_id,
-                item.get('product_id'),
-                item.get('product_name'),
-                item.get('quantity'),
-                item.get('price'),
-                item.get('total'),
-                branch_stock_id,
-                item.get('variant_id'),
-                item.get('variant_name')
-            ))
-            # خصم المخزون الجديد
-            if branch_stock_id:
+            # إدراج العناصر الجديدة وخصم المخزون
+            new_items = data.get('items', [])
+            for item in new_items:
+                branch_stock_id = item.get('branch_stock_id') or item.get('product_id')
                 cursor.execute('''
-                    UPDATE branch_stock
-                    SET stock = stock - ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (item.get('quantity', 0), branch_stock_id))
+                    INSERT INTO invoice_items
+                    (invoice_id, product_id, product_name, quantity, price, total, branch_stock_id, variant_id, variant_name)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    invoice_id,
+                    item.get('product_id'),
+                    item.get('product_name'),
+                    item.get('quantity'),
+                    item.get('price'),
+                    item.get('total'),
+                    branch_stock_id,
+                    item.get('variant_id'),
+                    item.get('variant_name')
+                ))
+                # خصم المخزون الجديد
+                if branch_stock_id:
+                    cursor.execute('''
+                        UPDATE branch_stock
+                        SET stock = stock - ?, updated_at = CURRENT_TIMESTAMP
+                        WHERE id = ?
+                    ''', (item.get('quantity', 0), branch_stock_id))
 
         # تحديث بيانات الفاتورة
         cursor.execute('''
@@ -8534,12 +10539,12 @@ def admin_dashboard_shift_performance():
             # إجمالي المبيعات
             cursor.execute('''
                 SELECT
-                    COUNT(i.id) as total_invoices,
-                    COALESCE(SUM(i.total), 0) as total_sales,
-                    COUNT(CASE WHEN DATE(i.created_at) = DATE('now') THEN 1 END) as today_invoices,
-                    COALESCE(SUM(CASE WHEN DATE(i.created_at) = DATE('now') THEN i.total ELSE 0 END), 0) as today_sales
-                FROM invoices i
-                WHERE i.shift_id = ? AND i.cancelled = 0
+                    COALESCE(SUM(r.invoice_count), 0) as total_invoices,
+                    COALESCE(SUM(r.total), 0) as total_sales,
+                    COALESCE(SUM(CASE WHEN r.day = DATE('now') THEN r.invoice_count END), 0) as today_invoices,
+                    COALESCE(SUM(CASE WHEN r.day = DATE('now') THEN r.total ELSE 0 END), 0) as today_sales
+                FROM daily_sales_rollup r
+                WHERE r.shift_id = ? AND r.cancelled = 0
             ''', (shift['id'],))
             stats = dict(cursor.fetchone())
 
@@ -8613,10 +10618,10 @@ def get_stock_transfers():
         cursor.execute(query, params)
         transfers = [dict_from_row(row) for row in cursor.fetchall()]
 
-        # جلب عناصر كل طلب
+        # عناصر كل الطلبات باستعلام واحد
+        items = fetch_children(cursor, 'stock_transfer_items', 'transfer_id', [t['id'] for t in transfers])
         for t in transfers:
-            cursor.execute('SELECT * FROM stock_transfer_items WHERE transfer_id = ?', (t['id'],))
-            t['items'] = [dict_from_row(r) for r in cursor.fetchall()]
+            t['items'] = items.get(t['id'], [])
 
         conn.close()
         return jsonify({'success': True, 'transfers': transfers})
@@ -8655,15 +10660,8 @@ def create_stock_transfer():
         tenant_slug = get_tenant_slug()
         if tenant_slug:
             try:
-                m_conn = get_master_db()
-                m_cursor = m_conn.cursor()
-                m_cursor.execute('SELECT mode FROM tenants WHERE slug = ?', (tenant_slug,))
-                t_row = m_cursor.fetchone()
-                m_conn.close()
-                if t_row:
-                    t_mode = t_row['mode'] if 'mode' in t_row.keys() else 'online'
-                    if t_mode == 'offline':
-                        return jsonify({'success': False, 'error': 'نقل المخزون غير متاح في وضع أوفلاين.'}), 403
+                if tenant_mode(tenant_slug) == 'offline':
+                    return jsonify({'success': False, 'error': 'نقل المخزون غير متاح في وضع أوفلاين.'}), 403
             except Exception:
                 pass
 
@@ -8764,15 +10762,16 @@ def approve_stock_transfer(transfer_id):
         cursor.execute('SELECT * FROM stock_transfer_items WHERE transfer_id = ?', (transfer_id,))
         items = [dict_from_row(r) for r in cursor.fetchall()]
 
-        for item in items:
-            qty = item.get('quantity_approved') or item.get('quantity_requested', 0)
-            if qty > 0 and item.get('inventory_id'):
-                cursor.execute('''
-                    UPDATE branch_stock SET stock = stock - ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE inventory_id = ? AND branch_id = ?
-                    AND (variant_id = ? OR (variant_id IS NULL AND ? IS NULL))
-                ''', (qty, item['inventory_id'], transfer['from_branch_id'],
-                      item.get('variant_id'), item.get('variant_id')))
+        with stock_movement_reason(cursor, 'transfer_out', transfer_id):
+            for item in items:
+                qty = item.get('quantity_approved') or item.get('quantity_requested', 0)
+                if qty > 0 and item.get('inventory_id'):
+                    cursor.execute('''
+                        UPDATE branch_stock SET stock = stock - ?, updated_at = CURRENT_TIMESTAMP
+                        WHERE inventory_id = ? AND branch_id = ?
+                        AND (variant_id = ? OR (variant_id IS NULL AND ? IS NULL))
+                    ''', (qty, item['inventory_id'], transfer['from_branch_id'],
+                          item.get('variant_id'), item.get('variant_id')))
 
         cursor.execute('''
             UPDATE stock_transfers
@@ -8902,28 +10901,29 @@ def receive_stock_transfer(transfer_id):
 
         # إضافة المخزون للفرع المستلم
         to_branch_id = transfer['to_branch_id']
-        for item in items:
-            qty = item.get('quantity_received') or item.get('quantity_approved') or item.get('quantity_requested', 0)
-            if qty > 0 and item.get('inventory_id'):
-                # تحقق من وجود سجل branch_stock
-                cursor.execute('''
-                    SELECT id, stock FROM branch_stock
-                    WHERE inventory_id = ? AND branch_id = ?
-                    AND (variant_id = ? OR (variant_id IS NULL AND ? IS NULL))
-                ''', (item['inventory_id'], to_branch_id,
-                      item.get('variant_id'), item.get('variant_id')))
-                existing = cursor.fetchone()
-
-                if existing:
-                    cursor.execute('''
-                        UPDATE branch_stock SET stock = stock + ?, updated_at = CURRENT_TIMESTAMP
-                        WHERE id = ?
-                    ''', (qty, existing['id']))
-                else:
+        with stock_movement_reason(cursor, 'transfer_in', transfer_id):
+            for item in items:
+                qty = item.get('quantity_received') or item.get('quantity_approved') or item.get('quantity_requested', 0)
+                if qty > 0 and item.get('inventory_id'):
+                    # تحقق من وجود سجل branch_stock
                     cursor.execute('''
-                        INSERT INTO branch_stock (inventory_id, branch_id, variant_id, stock)
-                        VALUES (?, ?, ?, ?)
-                    ''', (item['inventory_id'], to_branch_id, item.get('variant_id'), qty))
+                        SELECT id, stock FROM branch_stock
+                        WHERE inventory_id = ? AND branch_id = ?
+                        AND (variant_id = ? OR (variant_id IS NULL AND ? IS NULL))
+                    ''', (item['inventory_id'], to_branch_id,
+                          item.get('variant_id'), item.get('variant_id')))
+                    existing = cursor.fetchone()
+
+                    if existing:
+                        cursor.execute('''
+                            UPDATE branch_stock SET stock = stock + ?, updated_at = CURRENT_TIMESTAMP
+                            WHERE id = ?
+                        ''', (qty, existing['id']))
+                    else:
+                        cursor.execute('''
+                            INSERT INTO branch_stock (inventory_id, branch_id, variant_id, stock)
+                            VALUES (?, ?, ?, ?)
+                        ''', (item['inventory_id'], to_branch_id, item.get('variant_id'), qty))
 
         cursor.execute('''
             UPDATE stock_transfers
@@ -8984,9 +10984,9 @@ def get_subscription_plans():
         cursor.execute('SELECT * FROM subscription_plans ORDER BY price ASC')
         plans = [dict_from_row(row) for row in cursor.fetchall()]
         # جلب منتجات كل خطة
+        items = fetch_children(cursor, 'subscription_plan_items', 'plan_id', [plan['id'] for plan in plans])
         for plan in plans:
-            cursor.execute('SELECT * FROM subscription_plan_items WHERE plan_id = ?', (plan['id'],))
-            plan['items'] = [dict_from_row(r) for r in cursor.fetchall()]
+            plan['items'] = items.get(plan['id'], [])
         conn.close()
         return jsonify({'success': True, 'plans': plans})
     except Exception as e:
@@ -9133,25 +11133,18 @@ def get_customer_subscriptions():
         cursor.execute(query, params)
         subs = [dict_from_row(row) for row in cursor.fetchall()]
 
-        # جلب منتجات الخطة والاستلامات لكل اشتراك
+        # منتجات الخطط ومجموع الاستلامات لكل منتج - استعلام واحد لكل منهما بدل اثنين لكل اشتراك
+        plan_items = fetch_children(cursor, 'subscription_plan_items', 'plan_id', [sub.get('plan_id') for sub in subs])
+        redeemed = fetch_children(cursor, 'subscription_redemptions', 'subscription_id', [sub['id'] for sub in subs],
+                                  columns='product_id, variant_id, SUM(quantity) as total_redeemed',
+                                  order_by=None, group_by='product_id, variant_id')
         for sub in subs:
-            if sub.get('plan_id'):
-                cursor.execute('SELECT * FROM subscription_plan_items WHERE plan_id = ?', (sub['plan_id'],))
-                sub['plan_items'] = [dict_from_row(r) for r in cursor.fetchall()]
-            else:
-                sub['plan_items'] = []
-            # مجموع الاستلامات لكل منتج
-            cursor.execute('''
-                SELECT product_id, variant_id, SUM(quantity) as total_redeemed
-                FROM subscription_redemptions WHERE subscription_id = ?
-                GROUP BY product_id, variant_id
-            ''', (sub['id'],))
-            redeemed_map = {}
-            for r in cursor.fetchall():
-                rd = dict_from_row(r)
-                key = f"{rd['product_id']}_{rd['variant_id'] or 0}"
-                redeemed_map[key] = rd['total_redeemed']
-            sub['redeemed_map'] = redeemed_map
+            # نسخة لكل اشتراك: الخطة نفسها قد تتكرر في عدة اشتراكات
+            sub['plan_items'] = [dict(item) for item in plan_items.get(sub.get('plan_id'), [])]
+            sub['redeemed_map'] = {
+                f"{rd['product_id']}_{rd['variant_id'] or 0}": rd['total_redeemed']
+                for rd in redeemed.get(sub['id'], [])
+            }
 
         conn.close()
         return jsonify({'success': True, 'subscriptions': subs})
@@ -9427,12 +11420,14 @@ def create_subscription_redemption():
             ''', (subscription_id, sub['customer_id'], product_id, item.get('product_name'),
                   variant_id, item.get('variant_name'), qty,
                   data.get('redeemed_by'), data.get('redeemed_by_name')))
+            redemption_id = cursor.lastrowid
 
             # خصم من مخزون الفرع
-            cursor.execute('''
-                UPDATE branch_stock SET stock = stock - ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (qty, bs['id']))
+            with stock_movement_reason(cursor, 'redemption', redemption_id):
+                cursor.execute('''
+                    UPDATE branch_stock SET stock = stock - ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (qty, bs['id']))
 
             redeemed_items.append({'product_name': item.get('product_name'), 'quantity': qty})
 
@@ -9460,6 +11455,58 @@ def get_subscription_redemptions(subscription_id):
 
 # ===== Sync API - للتزامن بين التطبيق المحلي والسيرفر =====
 
+SYNC_UPLOAD_CHUNK = 500  # حد عدد المعاملات في استعلامات IN
+
+def _sql_chunks(values, size=SYNC_UPLOAD_CHUNK):
+    """تقسيم القيم إلى دفعات لاستعلامات IN (...)"""
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+def _sync_existing_values(cursor, table, column, values):
+    """القيم الموجودة مسبقاً من مجموعة قيم (استعلام IN واحد لكل دفعة)"""
+    found = set()
+    for chunk in _sql_chunks(values):
+        cursor.execute(f'SELECT {column} FROM {table} WHERE {column} IN ({",".join("?" * len(chunk))})', chunk)
+        found.update(str(row[0]) for row in cursor.fetchall())
+    return found
+
+def _sync_params(values):
+    """تجهيز صف للإدراج الجماعي - قيمة غير قابلة للتخزين ترفض السجل وحده قبل executemany"""
+    for value in values:
+        if isinstance(value, (dict, list)):
+            raise ValueError(f'unsupported value type: {type(value).__name__}')
+        if isinstance(value, int) and not -2**63 <= value < 2**63:
+            raise ValueError(f'integer out of range: {value}')
+    return tuple(values)
+
+def _sync_batch(cursor, records, insert, errors, label):
+    """إدراج السجلات دفعة واحدة داخل SAVEPOINT؛ إذا فشلت الدفعة (قيد أو نوع لم يكشفه التحقق المسبق)
+    تُعاد سجلاً سجلاً فيُرفض السجل الخاطئ وحده ويُذكر في errors كما في الحلقة القديمة.
+    يُرجع السجلات التي أُدرجت"""
+    if not records:
+        return []
+    cursor.execute('SAVEPOINT sync_batch')
+    try:
+        insert(records)
+        cursor.execute('RELEASE sync_batch')
+        return records
+    except (sqlite3.Error, ValueError, TypeError, OverflowError):
+        cursor.execute('ROLLBACK TO sync_batch')
+        cursor.execute('RELEASE sync_batch')
+    inserted = []
+    for record in records:
+        cursor.execute('SAVEPOINT sync_record')
+        try:
+            insert([record])
+            cursor.execute('RELEASE sync_record')
+            inserted.append(record)
+        except (sqlite3.Error, ValueError, TypeError, OverflowError) as e:
+            cursor.execute('ROLLBACK TO sync_record')
+            cursor.execute('RELEASE sync_record')
+            errors.append(f'{label(record)}: {e}')
+    return inserted
+
 @app.route('/api/sync/upload', methods=['POST'])
 def sync_upload():
     """رفع البيانات المحلية (فواتير، عملاء) إلى السيرفر"""
@@ -9467,67 +11514,74 @@ def sync_upload():
         data = request.json
         conn = get_db()
         cursor = conn.cursor()
+        # معاملة صريحة حتى لا يُثبت RELEASE لنقاط الحفظ في _sync_batch شيئاً قبل النهاية
+        if not conn.in_transaction:
+            cursor.execute('BEGIN')
         results = {'invoices_synced': 0, 'customers_synced': 0, 'errors': [], 'negative_stock': []}
 
-        # 1. مزامنة العملاء الجدد
-        for customer in data.get('customers', []):
+        # 1. مزامنة العملاء الجدد (استعلام واحد للأرقام الموجودة ثم إدراج جماعي)
+        customers = data.get('customers', [])
+        known_phones = _sync_existing_values(
+            cursor, 'customers', 'phone', {str(c.get('phone')) for c in customers if c.get('phone')})
+        customer_rows = []  # (name, params)
+        for customer in customers:
             try:
+                phone = customer.get('phone')
                 # تحقق من عدم وجود العميل بنفس الهاتف
-                if customer.get('phone'):
-                    cursor.execute('SELECT id FROM customers WHERE phone = ?', (customer['phone'],))
-                    existing = cursor.fetchone()
-                    if existing:
-                        results['customers_synced'] += 1
-                        continue
-                cursor.execute('''
-                    INSERT INTO customers (name, phone, email, address, notes)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (
+                if phone and str(phone) in known_phones:
+                    results['customers_synced'] += 1
+                    continue
+                # customers.name NOT NULL: يُرفض هنا بدلاً من إفشال الدفعة كلها
+                if customer.get('name', '') is None:
+                    raise ValueError('name is required')
+                customer_rows.append((customer.get('name', ''), _sync_params((
                     customer.get('name', ''),
                     customer.get('phone', ''),
                     customer.get('email', ''),
                     customer.get('address', ''),
                     customer.get('notes', '')
-                ))
-                results['customers_synced'] += 1
+                ))))
+                if phone:
+                    known_phones.add(str(phone))
             except Exception as e:
                 results['errors'].append(f"Customer {customer.get('name','')}: {str(e)}")
 
+        def insert_customers(rows):
+            cursor.executemany('''
+                INSERT INTO customers (name, phone, email, address, notes)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [params for _, params in rows])
+
+        results['customers_synced'] += len(_sync_batch(
+            cursor, customer_rows, insert_customers, results['errors'], lambda row: f'Customer {row[0]}'))
+
         # 2. مزامنة الفواتير (مرتبة حسب الوقت - الأقدم أولاً)
         invoices_sorted = sorted(data.get('invoices', []), key=lambda x: x.get('created_at', ''))
+        known_numbers = _sync_existing_values(
+            cursor, 'invoices', 'invoice_number',
+            {str(inv.get('invoice_number')) for inv in invoices_sorted if inv.get('invoice_number')})
+        cursor.execute('SELECT id, name FROM branches')
+        branch_names = {str(row['id']): row['name'] for row in cursor.fetchall()}
+        cursor.execute('SELECT id, name FROM shifts')
+        shift_names = {str(row['id']): row['name'] for row in cursor.fetchall()}
+
+        pending = []  # (invoice_number, invoice_params, [item_params], [(branch_stock_id, quantity, product_name)])
         for invoice in invoices_sorted:
             try:
-                # تحقق من عدم وجود الفاتورة
+                # تحقق من عدم وجود الفاتورة (في القاعدة أو مكررة داخل نفس الدفعة)
                 inv_num = invoice.get('invoice_number', '')
-                if inv_num:
-                    cursor.execute('SELECT id FROM invoices WHERE invoice_number = ?', (inv_num,))
-                    if cursor.fetchone():
-                        results['invoices_synced'] += 1
-                        continue
+                if inv_num and str(inv_num) in known_numbers:
+                    results['invoices_synced'] += 1
+                    continue
 
                 branch_id = invoice.get('branch_id', 1)
-                cursor.execute('SELECT name FROM branches WHERE id = ?', (branch_id,))
-                branch = cursor.fetchone()
-                branch_name = branch['name'] if branch else ''
-
                 shift_id = invoice.get('shift_id')
-                shift_name = ''
-                if shift_id:
-                    cursor.execute('SELECT name FROM shifts WHERE id = ?', (shift_id,))
-                    s = cursor.fetchone()
-                    shift_name = s['name'] if s else ''
-
-                cursor.execute('''
-                    INSERT INTO invoices
-                    (invoice_number, customer_id, customer_name, customer_phone, customer_address,
-                     subtotal, discount, total, payment_method, employee_name, notes,
-                     transaction_number, branch_id, branch_name, delivery_fee,
-                     coupon_discount, coupon_code, loyalty_discount,
-                     loyalty_points_earned, loyalty_points_redeemed,
-                     table_id, table_name, shift_id, shift_name, created_at)
-                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-                ''', (
-                    inv_num,
+                # عمليات الدفع تُحفظ في transaction_number كما في create_invoice
+                payments = invoice.get('payments', [])
+                transaction_number = (json.dumps(payments, ensure_ascii=False) if payments
+                                      else invoice.get('transaction_number', ''))
+                invoice_params = _sync_params((
+                    str(inv_num) if inv_num else inv_num,
                     invoice.get('customer_id'),
                     invoice.get('customer_name', ''),
                     invoice.get('customer_phone', ''),
@@ -9538,9 +11592,9 @@ def sync_upload():
                     invoice.get('payment_method', 'cash'),
                     invoice.get('employee_name', ''),
                     invoice.get('notes', ''),
-                    invoice.get('transaction_number', ''),
+                    transaction_number,
                     branch_id,
-                    branch_name,
+                    branch_names.get(str(branch_id), ''),
                     invoice.get('delivery_fee', 0),
                     invoice.get('coupon_discount', 0),
                     invoice.get('coupon_code', ''),
@@ -9550,20 +11604,15 @@ def sync_upload():
                     invoice.get('table_id'),
                     invoice.get('table_name', ''),
                     shift_id,
-                    shift_name,
+                    shift_names.get(str(shift_id), '') if shift_id else '',
                     invoice.get('created_at', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
                 ))
-                new_invoice_id = cursor.lastrowid
 
-                # إدراج عناصر الفاتورة
+                item_params = []
+                stock_moves = []
                 for item in invoice.get('items', []):
                     branch_stock_id = item.get('branch_stock_id') or item.get('product_id')
-                    cursor.execute('''
-                        INSERT INTO invoice_items
-                        (invoice_id, product_id, product_name, quantity, price, total, branch_stock_id, variant_id, variant_name)
-                        VALUES (?,?,?,?,?,?,?,?,?)
-                    ''', (
-                        new_invoice_id,
+                    item_params.append(_sync_params((
                         item.get('product_id'),
                         item.get('product_name'),
                         item.get('quantity'),
@@ -9572,31 +11621,87 @@ def sync_upload():
                         branch_stock_id,
                         item.get('variant_id'),
                         item.get('variant_name')
-                    ))
-                    # تحديث المخزون + كشف المخزون السلبي
+                    )))
                     if branch_stock_id:
-                        cursor.execute('''
-                            UPDATE branch_stock SET stock = stock - ?, updated_at = CURRENT_TIMESTAMP
-                            WHERE id = ?
-                        ''', (item.get('quantity', 0), branch_stock_id))
-                        cursor.execute('SELECT bs.stock, (SELECT name FROM inventory WHERE id = bs.inventory_id) as product_name FROM branch_stock bs WHERE bs.id = ?', (branch_stock_id,))
-                        stock_row = cursor.fetchone()
-                        if stock_row and stock_row['stock'] < 0:
-                            already = any(ns['branch_stock_id'] == branch_stock_id for ns in results['negative_stock'])
-                            if not already:
-                                results['negative_stock'].append({'branch_stock_id': branch_stock_id, 'product_name': stock_row['product_name'] or item.get('product_name', ''), 'stock': stock_row['stock']})
-
-                # حفظ عمليات الدفع
-                payments = invoice.get('payments', [])
-                if payments:
-                    cursor.execute('''
-                        UPDATE invoices SET payment_details = ? WHERE id = ?
-                    ''', (json.dumps(payments, ensure_ascii=False), new_invoice_id))
+                        try:
+                            stock_moves.append((int(branch_stock_id), float(item.get('quantity') or 0),
+                                                item.get('product_name', '')))
+                        except (TypeError, ValueError):
+                            raise ValueError(f"invalid branch_stock_id/quantity for {item.get('product_name', '')}")
 
-                results['invoices_synced'] += 1
+                pending.append((inv_num, invoice_params, item_params, stock_moves))
+                if inv_num:
+                    known_numbers.add(str(inv_num))
             except Exception as e:
                 results['errors'].append(f"Invoice {invoice.get('invoice_number','')}: {str(e)}")
 
+        # إدراج الفواتير دفعة واحدة ثم جلب المعرفات برقم الفاتورة
+        insert_invoice_sql = '''
+            INSERT INTO invoices
+            (invoice_number, customer_id, customer_name, customer_phone, customer_address,
+             subtotal, discount, total, payment_method, employee_name, notes,
+             transaction_number, branch_id, branch_name, delivery_fee,
+             coupon_discount, coupon_code, loyalty_discount,
+             loyalty_points_earned, loyalty_points_redeemed,
+             table_id, table_name, shift_id, shift_name, created_at)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        '''
+
+        def insert_invoices(records):
+            cursor.executemany(insert_invoice_sql, [p[1] for p in records if p[0]])
+            invoice_ids = {}
+            numbers = [str(p[0]) for p in records if p[0]]
+            for chunk in _sql_chunks(numbers):
+                cursor.execute(f'''SELECT id, invoice_number FROM invoices
+                    WHERE invoice_number IN ({','.join('?' * len(chunk))})''', chunk)
+                invoice_ids.update((row['invoice_number'], row['id']) for row in cursor.fetchall())
+
+            item_rows = []
+            for inv_num, invoice_params, item_params, stock_moves in records:
+                if inv_num:
+                    new_invoice_id = invoice_ids[str(inv_num)]
+                else:
+                    # فاتورة بدون رقم: لا يمكن ربطها إلا بـ lastrowid
+                    cursor.execute(insert_invoice_sql, invoice_params)
+                    new_invoice_id = cursor.lastrowid
+                item_rows.extend((new_invoice_id,) + params for params in item_params)
+
+            cursor.executemany('''
+                INSERT INTO invoice_items
+                (invoice_id, product_id, product_name, quantity, price, total, branch_stock_id, variant_id, variant_name)
+                VALUES (?,?,?,?,?,?,?,?,?)
+            ''', item_rows)
+
+        # الفاتورة المرفوضة لا تُدرج بنودها ولا تُخصم من المخزون
+        inserted = _sync_batch(cursor, pending, insert_invoices, results['errors'],
+                               lambda record: f'Invoice {record[0]}')
+        stock_deltas = {}
+        stock_names = {}
+        for _, _, _, stock_moves in inserted:
+            for branch_stock_id, quantity, product_name in stock_moves:
+                stock_deltas[branch_stock_id] = stock_deltas.get(branch_stock_id, 0) + quantity
+                stock_names.setdefault(branch_stock_id, product_name)
+        results['invoices_synced'] += len(inserted)
+
+        # تحديث المخزون مرة واحدة لكل branch_stock + كشف المخزون السلبي
+        with stock_movement_reason(cursor, 'sync_sale'):
+            cursor.executemany('''
+                UPDATE branch_stock SET stock = stock - ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', [(int(qty) if qty.is_integer() else qty, bs_id) for bs_id, qty in stock_deltas.items()])
+        for chunk in _sql_chunks(stock_deltas):
+            cursor.execute(f'''
+                SELECT bs.id, bs.stock, i.name as product_name
+                FROM branch_stock bs LEFT JOIN inventory i ON i.id = bs.inventory_id
+                WHERE bs.id IN ({','.join('?' * len(chunk))}) AND bs.stock < 0
+            ''', chunk)
+            for row in cursor.fetchall():
+                results['negative_stock'].append({
+                    'branch_stock_id': row['id'],
+                    'product_name': row['product_name'] or stock_names.get(row['id'], ''),
+                    'stock': row['stock']
+                })
+
         conn.commit()
         conn.close()
         return jsonify({
@@ -9609,6 +11714,173 @@ def sync_upload():
         return jsonify({'success': False, 'error': 'حدث خطأ في النظام'}), 500
 
 
+# ===== تنزيل المزامنة (JSON أو NDJSON متدفق) =====
+# ?format=ndjson يبث سطراً لكل صفحة بدل بناء كل البيانات في قاموس واحد
+# الصفحات بترقيم keyset (id > after_id) - ?table=&after_id= يستأنف مزامنة منقطعة من آخر صفحة مكتملة
+
+SYNC_PAGE_SIZE = int(os.environ.get('POS_SYNC_PAGE_SIZE', '500'))
+SYNC_MAX_PAGE_SIZE = 5000
+
+def _sync_section(name, sql, params=(), key=None, field='id', optional=False):
+    """قسم في تنزيل المزامنة - key عمود ترقيم keyset (None = صفحة واحدة)
+    sql يجب أن ينتهي بشرط WHERE ليُلحق به key > ?"""
+    return {'name': name, 'sql': sql, 'params': tuple(params), 'key': key, 'field': field, 'optional': optional}
+
+def _sync_section_pages(cursor, section, after_id=0, page_size=SYNC_PAGE_SIZE):
+    """صفحات القسم كـ (rows, after_id) - optional: جدول غير موجود = قسم فارغ"""
+    try:
+        if not section['key']:
+            cursor.execute(section['sql'], section['params'])
+            yield [dict(row) for row in cursor.fetchall()], None
+            return
+        while True:
+            cursor.execute(f"{section['sql']} AND {section['key']} > ? ORDER BY {section['key']} LIMIT ?",
+                           section['params'] + (after_id, page_size))
+            rows = [dict(row) for row in cursor.fetchall()]
+            if not rows:
+                return
+            after_id = rows[-1][section['field']]
+            yield rows, after_id
+            if len(rows) < page_size:
+                return
+    except sqlite3.OperationalError:
+        if not section['optional']:
+            raise
+
+def _sync_collect(cursor, sections):
+    """تجميع الأقسام في قاموس واحد (وضع JSON القديم)"""
+    result = {}
+    for section in sections:
+        rows = []
+        for page, _ in _sync_section_pages(cursor, section):
+            rows.extend(page)
+        result[section['name']] = rows
+    if 'settings' in result:
+        result['settings'] = {row['key']: row['value'] for row in result['settings']}
+    if 'categories' in result:
+        result['categories'] = [row['category'] for row in result['categories']]
+    return result
+
+def _ndjson(record):
+    return json.dumps(record, ensure_ascii=False, default=str) + '\n'
+
+def sync_ndjson_response(sections, meta):
+    """بث أقسام المزامنة كـ NDJSON
+    الأسطر: meta، ثم page {table, first, rows, after_id} و table_end {table, count} لكل جدول، ثم end
+    first=true يعني أن على العميل تفريغ الجدول المحلي قبل الحفظ (إلا في delta حيث تُطبّق upserts و deleted فقط)"""
+    names = [section['name'] for section in sections]
+    resume_table = request.args.get('table') or None
+    after_id = request.args.get('after_id', 0, type=int)
+    page_size = min(max(request.args.get('limit', SYNC_PAGE_SIZE, type=int), 1), SYNC_MAX_PAGE_SIZE)
+    if resume_table and resume_table not in names:
+        return jsonify({'success': False, 'error': 'جدول غير معروف'}), 400
+    start = names.index(resume_table) if resume_table else 0
+
+    def generate():
+        conn = get_db()
+        try:
+            cursor = conn.cursor()
+            # لقطة واحدة متسقة طوال البث (WAL لا يحجب الكتابة)
+            cursor.execute('BEGIN')
+            yield _ndjson({'type': 'meta', 'page_size': page_size, **meta})
+            for index in range(start, len(sections)):
+                section = sections[index]
+                start_after = after_id if (resume_table and index == start) else 0
+                pages = count = 0
+                for rows, last_id in _sync_section_pages(cursor, section, start_after, page_size):
+                    yield _ndjson({'type': 'page', 'table': section['name'], 'first': pages == 0 and start_after == 0,
+                                   'rows': rows, 'after_id': last_id})
+                    pages += 1
+                    count += len(rows)
+                if pages == 0 and start_after == 0:
+                    yield _ndjson({'type': 'page', 'table': section['name'], 'first': True, 'rows': [], 'after_id': None})
+                yield _ndjson({'type': 'table_end', 'table': section['name'], 'count': count})
+            yield _ndjson({'type': 'end'})
+        except Exception as e:
+            print(f"API error [{request.path}]: {e}")
+            yield _ndjson({'type': 'error', 'error': 'حدث خطأ في النظام'})
+        finally:
+            conn.close()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
+SYNC_PRODUCTS_SQL = '''
+    SELECT bs.id, bs.inventory_id, bs.variant_id, bs.stock,
+           COALESCE(pv.price, i.price) as price, COALESCE(pv.cost, i.cost) as cost,
+           i.name as product_name, pv.variant_name, COALESCE(pv.barcode, i.barcode) as barcode, i.category
+    FROM branch_stock bs
+    JOIN inventory i ON bs.inventory_id = i.id
+    LEFT JOIN product_variants pv ON pv.id = bs.variant_id
+    WHERE bs.branch_id = ?
+'''
+
+SYNC_SETTINGS_SQL = 'SELECT key, value FROM settings WHERE ' + ' AND '.join(
+    f"key NOT LIKE '{prefix}%'" for prefix in SENSITIVE_SETTING_PREFIXES)
+
+SYNC_CATEGORIES_SQL = 'SELECT DISTINCT category FROM products WHERE category IS NOT NULL AND category != ""'
+
+def _changed_ids(table, op='upsert'):
+    """استعلام فرعي لمعرفات الصفوف المتغيرة في change_log بعد إصدار (معامل واحد)"""
+    return f"SELECT row_id FROM change_log WHERE table_name = '{table}' AND op = '{op}' AND version > ?"
+
+def _any_change(*tables):
+    """شرط EXISTS لأي تغيير في الجداول بعد إصدار (معامل واحد)"""
+    names = ', '.join(f"'{t}'" for t in tables)
+    return f'EXISTS (SELECT 1 FROM change_log WHERE table_name IN ({names}) AND version > ?)'
+
+def get_change_version(cursor):
+    """آخر إصدار في change_log (0 إذا لم يكن الجدول موجوداً)"""
+    try:
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM change_log')
+        return cursor.fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+
+def _sync_product_sections(cursor, branch_id, since='', since_version=None):
+    """قسم المنتجات: branch_stock للفرع، أو جدول products القديم إذا لم يوجد مخزون فروع"""
+    cursor.execute('SELECT 1 FROM branch_stock WHERE branch_id = ? LIMIT 1', (branch_id,))
+    legacy = cursor.fetchone() is None
+    if since_version is not None:
+        v = since_version
+        if legacy:
+            return _sync_section('products', f"SELECT * FROM products WHERE id IN ({_changed_ids('products')})", (v,), key='id')
+        # تغيّر branch_stock أو المنتج أو المتغير يعيد إرسال صف المنتج في الفرع
+        return _sync_section('products', SYNC_PRODUCTS_SQL + f'''
+            AND (bs.id IN ({_changed_ids('branch_stock')})
+                 OR bs.inventory_id IN ({_changed_ids('inventory')})
+                 OR bs.variant_id IN ({_changed_ids('product_variants')}))
+        ''', (branch_id, v, v, v), key='bs.id')
+    if since:
+        return _sync_section('products', '''
+            SELECT bs.*, i.name as product_name, i.barcode, i.category, i.price, i.cost
+            FROM branch_stock bs
+            JOIN inventory i ON bs.inventory_id = i.id
+            WHERE bs.branch_id = ? AND (bs.updated_at > ? OR i.updated_at > ?)
+        ''', (branch_id, since, since), key='bs.id')
+    if legacy:
+        return _sync_section('products', 'SELECT * FROM products WHERE 1=1', key='id')
+    return _sync_section('products', SYNC_PRODUCTS_SQL, (branch_id,), key='bs.id')
+
+def _sync_delta_sections(cursor, branch_id, since_version):
+    """أقسام المزامنة التفاضلية من change_log: الصفوف المتغيرة + tombstones للمحذوف"""
+    v = since_version
+    return [
+        _sync_product_sections(cursor, branch_id, since_version=v),
+        _sync_section('customers', f"SELECT * FROM customers WHERE id IN ({_changed_ids('customers')})", (v,), key='id'),
+        # الإعدادات والفئات صغيرة: تُرسل كاملة فقط إذا تغيّر شيء
+        _sync_section('settings', f"{SYNC_SETTINGS_SQL} AND {_any_change('settings')}", (v,)),
+        _sync_section('branches', f"SELECT * FROM branches WHERE id IN ({_changed_ids('branches')})", (v,), key='id'),
+        _sync_section('categories', f"{SYNC_CATEGORIES_SQL} AND {_any_change('products')}", (v,)),
+        # الكوبونات المعطلة تُرسل أيضاً ليحذفها العميل
+        _sync_section('coupons', f"SELECT * FROM coupons WHERE id IN ({_changed_ids('coupons')})", (v,), key='id'),
+        _sync_section('deleted', '''
+            SELECT version, CASE table_name WHEN 'branch_stock' THEN 'products' ELSE table_name END as table_name,
+                   row_id as id
+            FROM change_log WHERE op = 'delete' AND version > ?
+        ''', (v,), key='version', field='version'),
+    ]
+
 @app.route('/api/sync/download', methods=['GET'])
 def sync_download():
     """تحميل كل البيانات من السيرفر للتطبيق المحلي"""
@@ -9616,67 +11888,44 @@ def sync_download():
         conn = get_db()
         cursor = conn.cursor()
         branch_id = request.args.get('branch_id', 1, type=int)
-        since = request.args.get('since', '')  # ISO timestamp للتحديث التدريجي
+        since = request.args.get('since', '')  # ISO timestamp (قديم - يُفضّل since_version)
+        since_version = request.args.get('since_version', type=int)  # مزامنة تفاضلية من change_log
 
-        result = {}
+        # الإصدار يُقرأ قبل البيانات: أي تغيير لاحق يصل في المزامنة التالية
+        version = get_change_version(cursor)
+        if since_version is not None and since_version > version:
+            # القاعدة استُعيدت من نسخة أقدم - يلزم تحميل كامل
+            conn.close()
+            return jsonify({'success': False, 'reset_required': True, 'version': version,
+                            'error': 'يلزم تحميل كامل للبيانات'}), 409
 
-        # 1. المنتجات (من branch_stock)
-        if since:
-            cursor.execute('''
-                SELECT bs.*, i.name as product_name, i.barcode, i.category, i.image,
-                       i.description, i.unit
-                FROM branch_stock bs
-                JOIN inventory i ON bs.inventory_id = i.id
-                WHERE bs.branch_id = ? AND (bs.updated_at > ? OR i.updated_at > ?)
-            ''', (branch_id, since, since))
-        else:
-            cursor.execute('''
-                SELECT bs.*, i.name as product_name, i.barcode, i.category, i.image,
-                       i.description, i.unit
-                FROM branch_stock bs
-                JOIN inventory i ON bs.inventory_id = i.id
-                WHERE bs.branch_id = ?
-            ''', (branch_id,))
-        products = [dict(row) for row in cursor.fetchall()]
-
-        # fallback: إذا لم يكن هناك branch_stock، نستخدم products مباشرة
-        if not products and not since:
-            cursor.execute('SELECT * FROM products')
-            products = [dict(row) for row in cursor.fetchall()]
-
-        result['products'] = products
-
-        # 2. العملاء
-        if since:
-            cursor.execute('SELECT * FROM customers WHERE updated_at > ?', (since,))
+        if since_version is not None:
+            sections = _sync_delta_sections(cursor, branch_id, since_version)
         else:
-            cursor.execute('SELECT * FROM customers')
-        result['customers'] = [dict(row) for row in cursor.fetchall()]
-
-        # 3. الإعدادات
-        cursor.execute('SELECT * FROM settings')
-        settings = {}
-        for row in cursor.fetchall():
-            settings[row['key']] = row['value']
-        result['settings'] = settings
-
-        # 4. الفروع
-        cursor.execute('SELECT * FROM branches')
-        result['branches'] = [dict(row) for row in cursor.fetchall()]
-
-        # 5. الفئات (من المنتجات)
-        cursor.execute('SELECT DISTINCT category FROM products WHERE category IS NOT NULL AND category != ""')
-        result['categories'] = [row['category'] for row in cursor.fetchall()]
-
-        # 6. الكوبونات النشطة
-        cursor.execute('SELECT * FROM coupons WHERE is_active = 1')
-        result['coupons'] = [dict(row) for row in cursor.fetchall()]
+            sections = [_sync_product_sections(cursor, branch_id, since)]
+            if since:
+                sections.append(_sync_section('customers', 'SELECT * FROM customers WHERE updated_at > ?', (since,), key='id'))
+            else:
+                sections.append(_sync_section('customers', 'SELECT * FROM customers WHERE 1=1', key='id'))
+            sections += [
+                _sync_section('settings', SYNC_SETTINGS_SQL),
+                _sync_section('branches', 'SELECT * FROM branches WHERE 1=1', key='id'),
+                _sync_section('categories', SYNC_CATEGORIES_SQL),
+                _sync_section('coupons', 'SELECT * FROM coupons WHERE is_active = 1', key='id'),
+            ]
+        synced_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        meta = {'synced_at': synced_at, 'version': version, 'delta': since_version is not None}
+
+        if request.args.get('format') == 'ndjson':
+            conn.close()
+            return sync_ndjson_response(sections, {**meta, 'since': since})
 
+        result = _sync_collect(cursor, sections)
         conn.close()
         return jsonify({
             'success': True,
             'data': result,
-            'synced_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            **meta
         })
     except Exception as e:
         print(f"API error [{request.path}]: {e}")
@@ -9704,10 +11953,14 @@ def sync_status():
         row = cursor.fetchone()
         last_invoice = row['last_invoice'] if row else None
 
+        # إصدار change_log - العميل يقارنه بآخر إصدار لديه لمعرفة إن كان هناك ما يُزامن
+        version = get_change_version(cursor)
+
         conn.close()
         return jsonify({
             'success': True,
             'server_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'version': version,
             'stats': {
                 'products': products_count,
                 'customers': customers_count,
@@ -9721,91 +11974,44 @@ def sync_status():
 
 
 @app.route('/api/sync/full-download', methods=['GET'])
+@etag_from_change_version(bypass_args=('include_users',))
 def sync_full_download():
     """تحميل كامل لجميع بيانات المتجر (للتثبيت الأولي أو إعادة التزامن الكامل)"""
     try:
         conn = get_db()
         cursor = conn.cursor()
         branch_id = request.args.get('branch_id', 1, type=int)
-        result = {}
-
-        # المنتجات
-        cursor.execute('''
-            SELECT bs.id, bs.inventory_id, bs.stock, bs.price, bs.cost,
-                   i.name as product_name, i.barcode, i.category, i.image, i.unit
-            FROM branch_stock bs
-            JOIN inventory i ON bs.inventory_id = i.id
-            WHERE bs.branch_id = ?
-        ''', (branch_id,))
-        products = [dict(row) for row in cursor.fetchall()]
-        if not products:
-            cursor.execute('SELECT * FROM products')
-            products = [dict(row) for row in cursor.fetchall()]
-        result['products'] = products
-
-        # العملاء
-        cursor.execute('SELECT * FROM customers')
-        result['customers'] = [dict(row) for row in cursor.fetchall()]
-
-        # الإعدادات
-        cursor.execute('SELECT * FROM settings')
-        settings = {}
-        for row in cursor.fetchall():
-            settings[row['key']] = row['value']
-        result['settings'] = settings
-
-        # الفروع
-        try:
-            cursor.execute('SELECT * FROM branches')
-            result['branches'] = [dict(row) for row in cursor.fetchall()]
-        except:
-            result['branches'] = []
-
-        # الفئات
-        cursor.execute('SELECT DISTINCT category FROM products WHERE category IS NOT NULL AND category != ""')
-        result['categories'] = [row['category'] for row in cursor.fetchall()]
-
-        # الكوبونات
-        try:
-            cursor.execute('SELECT * FROM coupons WHERE is_active = 1')
-            result['coupons'] = [dict(row) for row in cursor.fetchall()]
-        except:
-            result['coupons'] = []
-
-        # المتغيرات (variants)
-        try:
-            cursor.execute('SELECT * FROM product_variants')
-            result['variants'] = [dict(row) for row in cursor.fetchall()]
-        except:
-            result['variants'] = []
-
+        version = get_change_version(cursor)  # نقطة البداية لـ since_version
+
+        sections = [
+            _sync_product_sections(cursor, branch_id),
+            _sync_section('customers', 'SELECT * FROM customers WHERE 1=1', key='id'),
+            _sync_section('settings', SYNC_SETTINGS_SQL),
+            _sync_section('branches', 'SELECT * FROM branches WHERE 1=1', key='id', optional=True),
+            _sync_section('categories', SYNC_CATEGORIES_SQL),
+            _sync_section('coupons', 'SELECT * FROM coupons WHERE is_active = 1', key='id', optional=True),
+            _sync_section('variants', 'SELECT * FROM product_variants WHERE 1=1', key='id', optional=True),
+        ]
         # المستخدمون (للمزامنة المحلية فقط)
         if request.args.get('include_users', '0') == '1':
-            try:
-                cursor.execute('SELECT * FROM users WHERE is_active = 1')
-                result['users'] = [dict(row) for row in cursor.fetchall()]
-            except:
-                result['users'] = []
-
-        # المخزون (inventory)
-        try:
-            cursor.execute('SELECT * FROM inventory')
-            result['inventory'] = [dict(row) for row in cursor.fetchall()]
-        except:
-            result['inventory'] = []
+            sections.append(_sync_section('users', 'SELECT * FROM users WHERE is_active = 1', key='id', optional=True))
+        sections += [
+            _sync_section('inventory', 'SELECT * FROM inventory WHERE 1=1', key='id', optional=True),
+            _sync_section('branch_stock', 'SELECT * FROM branch_stock WHERE branch_id = ?', (branch_id,), key='id', optional=True),
+        ]
+        synced_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-        # مخزون الفروع (branch_stock)
-        try:
-            cursor.execute('SELECT * FROM branch_stock WHERE branch_id = ?', (branch_id,))
-            result['branch_stock'] = [dict(row) for row in cursor.fetchall()]
-        except:
-            result['branch_stock'] = []
+        if request.args.get('format') == 'ndjson':
+            conn.close()
+            return sync_ndjson_response(sections, {'synced_at': synced_at, 'version': version, 'full_sync': True})
 
+        result = _sync_collect(cursor, sections)
         conn.close()
         return jsonify({
             'success': True,
             'data': result,
-            'synced_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'synced_at': synced_at,
+            'version': version,
             'full_sync': True
         })
     except Exception as e:
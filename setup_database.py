@@ -522,9 +522,12 @@ def create_database():
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoices_number ON invoices(invoice_number)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoices_date ON invoices(created_at)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoice_items_invoice ON invoice_items(invoice_id)')
+    # فهارس التقارير المركبة (invoices + branch/cancelled/shift) في migrations/006_report_indexes.sql
+    # لأن قواعد البيانات القديمة قد لا تحتوي أعمدة cancelled و shift_id
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_branch_stock_inventory ON branch_stock(inventory_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_branch_stock_branch ON branch_stock(branch_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_customers_phone ON customers(phone)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_variants_inventory ON product_variants(inventory_id)')
     print("الفهارس")
 
     # حفظ التغييرات
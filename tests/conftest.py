@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures for the server tests.
+
+server.py resolves its databases from DB_PATH and the backups directory
+relative to the working directory at import time, so the whole session
+runs in a throwaway directory with its own master/tenant databases.
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='pos-tests-')
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'database', 'pos.db')
+os.chdir(WORKDIR)
+sys.path.insert(0, ROOT)
+
+import server  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+TENANT = 'test'
+
+
+@pytest.fixture(scope='session')
+def srv():
+    return server
+
+
+@pytest.fixture(scope='session')
+def client():
+    return server.app.test_client()
+
+
+def create_tenant(srv, slug):
+    """Register a tenant in master.db and create its database with an admin user, upgraded through the gate."""
+    master = sqlite3.connect(srv.MASTER_DB_PATH)
+    master.execute('INSERT OR IGNORE INTO tenants (name, slug, owner_name, db_path, is_active) VALUES (?, ?, ?, ?, 1)',
+                   (f'Store {slug}', slug, 'Test Owner', srv.get_tenant_db_path(slug)))
+    master.commit()
+    master.close()
+    srv.create_tenant_database(slug)
+    db_path = srv.get_tenant_db_path(slug)
+    srv.ensure_db_tables(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute('INSERT OR IGNORE INTO users (username, password, full_name, role, invoice_prefix, is_active, branch_id) '
+                 'VALUES (?, ?, ?, ?, ?, 1, 1)',
+                 ('testadmin', generate_password_hash('testpass123', method='pbkdf2:sha256', salt_length=16),
+                  'Test Admin', 'admin', 'TST'))
+    conn.commit()
+    conn.close()
+    return db_path
+
+
+@pytest.fixture(scope='session')
+def tenant_db(srv):
+    """Tenant database with an admin user, upgraded through the schema gate."""
+    return create_tenant(srv, TENANT)
+
+
+def login(client, tenant=TENANT):
+    r = client.post('/api/login', data=json.dumps({'username': 'testadmin', 'password': 'testpass123'}),
+                    content_type='application/json', headers={'X-Tenant-ID': tenant})
+    assert r.status_code == 200, r.get_json()
+    return {'Authorization': f"Bearer {r.get_json()['token']}", 'X-Tenant-ID': tenant}
+
+
+@pytest.fixture(scope='session')
+def auth(client, tenant_db):
+    return login(client)
+
+
+@pytest.fixture
+def traced_statements(srv, monkeypatch):
+    """trace() records every statement run on connections from get_db() inside the block."""
+    statements = []
+    traced = []
+    original = srv.get_db
+
+    def traced_get_db(*args, **kwargs):
+        conn = original(*args, **kwargs)
+        conn.set_trace_callback(statements.append)
+        traced.append(conn)
+        return conn
+
+    @contextmanager
+    def trace():
+        statements.clear()
+        monkeypatch.setattr(srv, 'get_db', traced_get_db)
+        try:
+            yield statements
+        finally:
+            monkeypatch.setattr(srv, 'get_db', original)
+            # pooled connections outlive the request: stop tracing them
+            for conn in traced:
+                conn.set_trace_callback(None)
+
+    return trace
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Scheduled backups record their runs in backup_runs, not settings.
+
+A settings write fires the change_log triggers, which would bump the
+settings stamp (and every sync ETag) once per night.
+"""
+
+import sqlite3
+
+from conftest import create_tenant
+
+SLUG = 'backup-schedule'
+
+
+def settings_stamp(srv, db_path):
+    conn = sqlite3.connect(db_path)
+    stamp = conn.execute(srv.SETTINGS_STAMP_SQL).fetchone()
+    version = conn.execute('SELECT COALESCE(MAX(version), 0) FROM change_log').fetchone()[0]
+    conn.close()
+    return stamp, version
+
+
+def test_scheduled_run_leaves_settings_stamp(srv, monkeypatch):
+    db_path = create_tenant(srv, SLUG)
+    assert srv.read_backup_schedule(db_path)['last_run'] is None
+    monkeypatch.setattr(srv, 'BULK_WORKERS', 1)
+    before = settings_stamp(srv, db_path)
+
+    srv._run_scheduled_backups({SLUG: (SLUG, db_path, 30, False)})
+
+    assert settings_stamp(srv, db_path) == before
+    conn = sqlite3.connect(db_path)
+    runs = conn.execute('SELECT ok, filename FROM backup_runs').fetchall()
+    leftover = conn.execute("SELECT COUNT(*) FROM settings WHERE key = 'backup_last_run'").fetchone()[0]
+    conn.close()
+    assert len(runs) == 1 and runs[0][0] == 1 and runs[0][1]
+    assert leftover == 0
+    assert srv.read_backup_schedule(db_path)['last_run'] is not None
+
+
+def test_migration_moves_backup_last_run(srv):
+    db_path = create_tenant(srv, SLUG + '-old')
+    conn = sqlite3.connect(db_path)
+    # as a database upgraded before migration 014 left it
+    conn.execute('DROP TABLE backup_runs')
+    conn.execute('DELETE FROM db_migrations WHERE version = 14')
+    conn.execute("INSERT INTO settings (key, value) VALUES ('backup_last_run', '2026-10-01T03:00:00')")
+    conn.commit()
+    conn.close()
+
+    srv.ensure_db_tables(db_path, force=True)
+
+    conn = sqlite3.connect(db_path)
+    ran_at = [row[0] for row in conn.execute('SELECT ran_at FROM backup_runs')]
+    leftover = conn.execute("SELECT COUNT(*) FROM settings WHERE key = 'backup_last_run'").fetchone()[0]
+    conn.close()
+    assert ran_at == ['2026-10-01T03:00:00'] and leftover == 0
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""collect_garbage() only deletes chunks when every manifest could be read."""
+
+import os
+import sqlite3
+
+import pytest
+
+from database import backup_store
+
+
+def _chunk_files(backup_dir):
+    chunks_dir = os.path.join(backup_dir, backup_store.CHUNKS_DIRNAME)
+    return {name for _root, _dirs, files in os.walk(chunks_dir) for name in files}
+
+
+@pytest.fixture
+def store(tmp_path):
+    """Two snapshots of a database that changed completely in between."""
+    db_path = str(tmp_path / 'live.db')
+    backup_dir = str(tmp_path / 'backups')
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE t (v TEXT)')
+    conn.executemany('INSERT INTO t VALUES (?)', ((os.urandom(200).hex(),) for _ in range(500)))
+    conn.commit()
+    first = backup_store.create_snapshot(db_path, backup_dir, chunk_size=4096)['filename']
+    conn.execute('UPDATE t SET v = ?', (os.urandom(200).hex(),))
+    conn.commit()
+    conn.close()
+    second = backup_store.create_snapshot(db_path, backup_dir, chunk_size=4096)['filename']
+    return backup_dir, first, second
+
+
+def test_collects_unreferenced_chunks(store):
+    backup_dir, first, second = store
+    before = _chunk_files(backup_dir)
+    backup_store.delete_snapshot(backup_dir, first)
+    files, freed = backup_store.collect_garbage(backup_dir, grace_seconds=0)
+    assert files > 0 and freed > 0
+    assert len(_chunk_files(backup_dir)) == len(before) - files
+    assert backup_store.verify_snapshot(backup_dir, second)
+
+
+@pytest.mark.parametrize('content', [b'{not json', b'{"format": 99, "chunks": []}'])
+def test_unreadable_manifest_aborts_gc(store, content):
+    backup_dir, first, second = store
+    before = _chunk_files(backup_dir)
+    backup_store.delete_snapshot(backup_dir, first)
+    with open(os.path.join(backup_dir, second), 'wb') as f:
+        f.write(content)
+
+    assert backup_store.collect_garbage(backup_dir, grace_seconds=0) == (0, 0)
+    assert _chunk_files(backup_dir) == before
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""List endpoints load child rows with fetch_children(): the statement count must not grow with the parents."""
+
+import sqlite3
+
+import pytest
+
+from conftest import create_tenant
+
+URLS = [
+    '/api/stock-transfers',
+    '/api/expenses?start_date=2026-01-01&end_date=2026-01-31',
+    '/api/customer-subscriptions',
+    '/api/subscription-plans',
+]
+
+
+def seed(db_path, count, offset):
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    for n in range(offset, offset + count):
+        cur.execute("INSERT INTO subscription_plans (name, price) VALUES (?, 10)", (f'Plan {n}',))
+        plan_id = cur.lastrowid
+        cur.executemany('INSERT INTO subscription_plan_items (plan_id, product_id, product_name, quantity) '
+                        'VALUES (?, ?, ?, 2)', [(plan_id, k, f'P{k}') for k in (1, 2)])
+        cur.execute('INSERT INTO stock_transfers (transfer_number, from_branch_id, to_branch_id) VALUES (?, 1, 2)',
+                    (f'TR-{n}',))
+        cur.executemany('INSERT INTO stock_transfer_items (transfer_id, product_name, quantity_requested) '
+                        'VALUES (?, ?, 1)', [(cur.lastrowid, f'x{k}') for k in range(2)])
+        cur.execute("INSERT INTO expenses (expense_type, amount, expense_date) VALUES ('رواتب', 5, '2026-01-02')")
+        cur.executemany('INSERT INTO salary_details (expense_id, employee_name) VALUES (?, ?)',
+                        [(cur.lastrowid, f'E{k}') for k in range(2)])
+        cur.execute("INSERT INTO customer_subscriptions (customer_id, plan_id, subscription_code, start_date, end_date) "
+                    "VALUES (1, ?, ?, '2026-01-01', '2026-02-01')", (plan_id, f'S-{n}'))
+        cur.execute('INSERT INTO subscription_redemptions (subscription_id, customer_id, product_id, quantity) '
+                    'VALUES (?, 1, 1, 1)', (cur.lastrowid,))
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def tenant(srv, request):
+    """A fresh tenant per endpoint, so "few" really is a few parents."""
+    slug = f'child-loaders-{request.node.callspec.indices["url"]}'
+    db_path = create_tenant(srv, slug)
+    token = srv.generate_auth_token({'id': 1, 'username': 'testadmin', 'role': 'admin'}, slug)
+    return db_path, {'Authorization': f'Bearer {token}', 'X-Tenant-ID': slug}
+
+
+def count_statements(client, headers, traced_statements, url):
+    with traced_statements() as statements:
+        r = client.get(url, headers=headers)
+    assert r.status_code == 200, r.get_json()
+    return len(statements), r.get_json()
+
+
+@pytest.mark.parametrize('url', URLS)
+def test_statement_count_is_constant(client, tenant, traced_statements, url):
+    db_path, headers = tenant
+    seed(db_path, 3, 0)
+    few, _ = count_statements(client, headers, traced_statements, url)
+    seed(db_path, 60, 1000)
+    many, body = count_statements(client, headers, traced_statements, url)
+
+    assert many == few, f'{url}: {few} statements for a few parents, {many} for many'
+    # the children still arrive on every parent
+    parents = next(v for k, v in body.items() if isinstance(v, list))
+    assert len(parents) >= 63
+    child_key = {'/api/stock-transfers': 'items', '/api/subscription-plans': 'items',
+                 '/api/customer-subscriptions': 'plan_items'}.get(url.split('?')[0], 'salary_details')
+    assert all(len(parent[child_key]) == 2 for parent in parents)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""POST /api/invoices: stock decrements, the stock ledger and the warnings built from the new balances.
+
+The same branch_stock_id can arrive twice in one cart, once as a string
+and once as an int. Both lines must land in a single decrement, with or
+without RETURNING.
+"""
+
+import json
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture(params=[True, False], ids=['returning', 'no-returning'])
+def returning(srv, monkeypatch, request):
+    monkeypatch.setattr(srv, 'SQLITE_HAS_RETURNING', request.param)
+    return request.param
+
+
+def add_stock(db_path, stock, name=None):
+    """A branch_stock row; without a name its inventory row is missing, so the cart's product_name is used."""
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    inventory_id = 999999
+    if name:
+        cur.execute('INSERT INTO inventory (name, price) VALUES (?, 2)', (name,))
+        inventory_id = cur.lastrowid
+    cur.execute('INSERT INTO branch_stock (inventory_id, branch_id, stock) VALUES (?, 1, ?)', (inventory_id, stock))
+    conn.commit()
+    conn.close()
+    return cur.lastrowid
+
+
+def post_invoice(client, auth, number, items):
+    payments = [{'method': 'نقداً', 'amount': 6}, {'method': 'بطاقة', 'amount': 2, 'reference': 'R-1'}]
+    r = client.post('/api/invoices', headers=auth, json={
+        'invoice_number': number, 'branch_id': 1, 'subtotal': 8, 'total': 8, 'payments': payments,
+        'items': [dict(item, price=2, total=2 * item['quantity']) for item in items],
+    })
+    body = r.get_json()
+    assert r.status_code == 200 and body['success'], body
+    return body, payments
+
+
+def sale_movements(db_path, invoice_id):
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT branch_stock_id, delta, stock_after FROM stock_movements "
+                        "WHERE reason = 'sale' AND ref_id = ? ORDER BY branch_stock_id", (invoice_id,)).fetchall()
+    conn.close()
+    return rows
+
+
+def test_repeated_id_is_one_decrement(client, auth, tenant_db, returning):
+    bs_id = add_stock(tenant_db, 3)
+    body, payments = post_invoice(client, auth, f'CHK-ONE-{returning}', [
+        {'branch_stock_id': str(bs_id), 'product_name': 'Loose Widget', 'quantity': 2},
+        {'branch_stock_id': bs_id, 'product_name': 'Loose Widget', 'quantity': 2},
+    ])
+
+    conn = sqlite3.connect(tenant_db)
+    stock = conn.execute('SELECT stock FROM branch_stock WHERE id = ?', (bs_id,)).fetchone()[0]
+    transaction_number, = conn.execute('SELECT transaction_number FROM invoices WHERE id = ?',
+                                       (body['id'],)).fetchone()
+    items = conn.execute('SELECT COUNT(*) FROM invoice_items WHERE invoice_id = ?', (body['id'],)).fetchone()[0]
+    conn.close()
+    assert stock == -1 and items == 2
+    assert json.loads(transaction_number) == payments
+    assert sale_movements(tenant_db, body['id']) == [(bs_id, -4, -1)]
+    # the product has no inventory row: the name comes from the cart, keyed by the int id
+    assert body['low_stock_warnings'] == [{'product_name': 'Loose Widget', 'stock': -1}]
+    assert body['negative_stock_warnings'] == [{'product_name': 'Loose Widget', 'stock': -1}]
+
+
+def test_several_ids(client, auth, tenant_db, returning):
+    loose = add_stock(tenant_db, 1)
+    named = add_stock(tenant_db, 10, name='Checkout Widget')
+    plenty = add_stock(tenant_db, 100, name='Plenty Widget')
+    body, _ = post_invoice(client, auth, f'CHK-MANY-{returning}', [
+        {'branch_stock_id': str(loose), 'product_name': 'Loose Widget', 'quantity': 3},
+        {'branch_stock_id': str(named), 'product_name': 'Cart Name', 'quantity': 4},
+        {'branch_stock_id': named, 'product_name': 'Cart Name', 'quantity': 2},
+        {'branch_stock_id': str(plenty), 'product_name': 'Plenty Widget', 'quantity': 1},
+    ])
+
+    assert sale_movements(tenant_db, body['id']) == [(loose, -3, -2), (named, -6, 4), (plenty, -1, 99)]
+    warnings = sorted(body['low_stock_warnings'], key=lambda w: w['stock'])
+    assert warnings == [{'product_name': 'Loose Widget', 'stock': -2},
+                        {'product_name': 'Checkout Widget', 'stock': 4}]
+    assert body['negative_stock_warnings'] == [{'product_name': 'Loose Widget', 'stock': -2}]
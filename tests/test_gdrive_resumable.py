@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""gdrive_resumable_upload() against a local stand-in for the Drive resumable protocol."""
+
+import json
+import os
+import re
+import threading
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+CHUNK = 4096
+
+
+class FakeDrive:
+    """Resumable upload sessions. faults is consumed one entry per data chunk:
+    'partial' keeps only half of the chunk, an int answers with that status, None accepts it."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.faults = []
+        self.sessions_started = 0
+        self.chunk_starts = []
+
+    def handler(self):
+        drive = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, headers=None, body=b''):
+                self.send_response(status)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                drive.sessions_started += 1
+                session_id = str(drive.sessions_started)
+                drive.sessions[session_id] = {'data': b'', 'total': int(self.headers['X-Upload-Content-Length'])}
+                host, port = self.server.server_address
+                self._reply(200, {'Location': f'http://{host}:{port}/session/{session_id}'})
+
+            def do_PUT(self):
+                data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                session = drive.sessions.get(self.path.rsplit('/', 1)[-1])
+                if session is None:
+                    return self._reply(404)
+                match = re.match(r'bytes (\d+)-\d+/\d+', self.headers['Content-Range'])
+                if match:
+                    start = int(match.group(1))
+                    drive.chunk_starts.append(start)
+                    fault = drive.faults.pop(0) if drive.faults else None
+                    if isinstance(fault, int):
+                        return self._reply(fault)
+                    if fault == 'partial':
+                        data = data[:len(data) // 2]
+                    if start == len(session['data']):
+                        session['data'] += data
+                if len(session['data']) == session['total']:
+                    return self._reply(200, {'Content-Type': 'application/json'},
+                                       json.dumps({'id': 'file-1', 'name': 'backup.db'}).encode())
+                headers = {'Range': f"bytes=0-{len(session['data']) - 1}"} if session['data'] else {}
+                self._reply(308, headers)
+
+        return Handler
+
+
+@pytest.fixture
+def drive(srv, monkeypatch):
+    fake = FakeDrive()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), fake.handler())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    monkeypatch.setattr(srv, 'GOOGLE_DRIVE_UPLOAD_URL', f'http://{host}:{port}/upload')
+    monkeypatch.setattr(srv, 'GDRIVE_CHUNK_SIZE', CHUNK)
+    fake.delays = []
+    monkeypatch.setattr(srv.time, 'sleep', fake.delays.append)
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def backup_file(tmp_path):
+    path = tmp_path / 'backup.db'
+    path.write_bytes(os.urandom(CHUNK * 2 + 1000))
+    return str(path)
+
+
+def test_resumes_partial_chunk_and_retries_server_errors(srv, drive, backup_file, tmp_path):
+    session_path = str(tmp_path / 'upload.session.json')
+    drive.faults = ['partial', 503]
+
+    result = srv.gdrive_resumable_upload('token', backup_file, 'backup.db', session_path=session_path,
+                                         fingerprint='fp')
+
+    assert result == {'id': 'file-1', 'name': 'backup.db'}
+    with open(backup_file, 'rb') as f:
+        assert drive.sessions['1']['data'] == f.read()
+    # Half of chunk 0 arrived, so the next chunk starts at the Range Drive reported;
+    # the 503 is retried from the offset Drive reports afterwards
+    assert drive.chunk_starts == [0, CHUNK // 2, CHUNK // 2, CHUNK // 2 + CHUNK]
+    assert len(drive.delays) == 1
+    assert srv.GDRIVE_RETRY_BASE <= drive.delays[0] < srv.GDRIVE_RETRY_BASE * 1.25
+    assert drive.sessions_started == 1
+    assert not os.path.exists(session_path)
+
+
+def test_backoff_grows_and_gives_up(srv, drive, backup_file, monkeypatch):
+    monkeypatch.setattr(srv, 'GDRIVE_MAX_RETRIES', 3)
+    drive.faults = [503] * 4
+
+    with pytest.raises(urllib.error.HTTPError) as excinfo:
+        srv.gdrive_resumable_upload('token', backup_file, 'backup.db')
+
+    assert excinfo.value.code == 503
+    assert len(drive.delays) == 3
+    base = srv.GDRIVE_RETRY_BASE
+    for attempt, delay in enumerate(drive.delays):
+        assert base * 2 ** attempt <= delay < base * 2 ** attempt * 1.25
+
+
+def test_saved_session_is_reused_after_a_failed_run(srv, drive, backup_file, tmp_path, monkeypatch):
+    session_path = str(tmp_path / 'upload.session.json')
+    monkeypatch.setattr(srv, 'GDRIVE_MAX_RETRIES', 0)
+    drive.faults = [None, 503]
+
+    with pytest.raises(urllib.error.HTTPError):
+        srv.gdrive_resumable_upload('token', backup_file, 'backup.db', session_path=session_path, fingerprint='fp')
+    with open(session_path, encoding='utf-8') as f:
+        assert json.load(f)['url'].endswith('/session/1')
+
+    drive.chunk_starts.clear()
+    result = srv.gdrive_resumable_upload('token', backup_file, 'backup.db', session_path=session_path,
+                                         fingerprint='fp')
+
+    assert result['id'] == 'file-1'
+    assert drive.sessions_started == 1
+    assert drive.chunk_starts[0] == CHUNK
+    with open(backup_file, 'rb') as f:
+        assert drive.sessions['1']['data'] == f.read()
+    assert not os.path.exists(session_path)
+
+
+def test_other_content_starts_a_new_session(srv, drive, backup_file, tmp_path, monkeypatch):
+    session_path = str(tmp_path / 'upload.session.json')
+    monkeypatch.setattr(srv, 'GDRIVE_MAX_RETRIES', 0)
+    drive.faults = [None, 503]
+    with pytest.raises(urllib.error.HTTPError):
+        srv.gdrive_resumable_upload('token', backup_file, 'backup.db', session_path=session_path, fingerprint='old')
+
+    srv.gdrive_resumable_upload('token', backup_file, 'backup.db', session_path=session_path, fingerprint='new')
+
+    assert drive.sessions_started == 2
+    assert not os.path.exists(session_path)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""ProcessCache: TTL/freshness checks and the stats() shape the cache-stats endpoints return."""
+
+
+def test_ttl_and_freshness(srv, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(srv.time, 'monotonic', lambda: clock[0])
+    cache = srv.ProcessCache(ttl=10)
+    assert cache.lookup('a') is None
+    cache.store('a', 1)
+    assert cache.lookup('a') == 1
+    assert cache.lookup('a', fresh=lambda value: value == 2) is None
+    clock[0] += 10
+    assert cache.lookup('a') is None
+
+    assert cache.stats() == {'hits': 1, 'misses': 3, 'invalidations': 0, 'entries': 1,
+                             'hit_ratio': 0.25, 'ttl': 10}
+
+
+def test_invalidate(srv):
+    cache = srv.ProcessCache()
+    for key in ('a', 'b', 'c'):
+        cache.store(key, key.upper())
+    cache.invalidate('a')
+    cache.invalidate_where(lambda key, value: value == 'B')
+    assert cache.lookup('c') == 'C'
+    assert cache.lookup('a') is None and cache.lookup('b') is None
+    cache.invalidate()
+    stats = cache.stats()
+    assert stats['entries'] == 0 and stats['invalidations'] == 3
+    assert 'ttl' not in stats
+
+
+def test_cache_stats_keys(srv):
+    assert {'hits', 'misses', 'invalidations', 'hit_ratio', 'tenants', 'ttl'} <= set(srv.tenant_registry.stats())
+    assert {'hits', 'misses', 'invalidations', 'hit_ratio', 'tenants', 'ttl', 'errors'} <= set(srv.feature_cache.stats())
+    assert {'hits', 'misses', 'invalidations', 'hit_ratio', 'databases'} <= set(srv.settings_cache.stats())
+    assert {'hits', 'misses', 'invalidations', 'hit_ratio', 'tables', 'ttl'} <= set(srv.name_cache.stats())
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Report date filters (sql_date_range) must be served by the invoices indexes."""
+
+import re
+import sqlite3
+
+import pytest
+
+RANGE = 'start_date=2026-01-01&end_date=2026-01-31'
+REPORT_URLS = [
+    f'/api/reports/sales?{RANGE}&branch_id=1',
+    f'/api/invoices?{RANGE}',
+    f'/api/reports/sales-by-product?{RANGE}',
+    f'/api/reports/profit-loss?{RANGE}',
+]
+SQL_KEYWORDS = {'WHERE', 'ON', 'ORDER', 'GROUP', 'LEFT', 'JOIN', 'INNER', 'LIMIT', 'SET'}
+
+
+def invoices_aliases(sql):
+    aliases = {'invoices'}
+    for alias in re.findall(r'\bFROM\s+invoices\s+(?:AS\s+)?(\w+)|\bJOIN\s+invoices\s+(?:AS\s+)?(\w+)', sql, re.I):
+        aliases.update(a for a in alias if a and a.upper() not in SQL_KEYWORDS)
+    return aliases
+
+
+@pytest.mark.parametrize('url', REPORT_URLS)
+def test_report_uses_invoice_indexes(client, auth, tenant_db, traced_statements, url):
+    with traced_statements() as statements:
+        r = client.get(url, headers=auth)
+    assert r.status_code == 200, r.get_json()
+
+    queries = [sql for sql in statements
+               if sql.lstrip().upper().startswith('SELECT') and re.search(r'\b(FROM|JOIN)\s+invoices\b', sql, re.I)]
+    assert queries, f'{url} ran no invoices query'
+
+    conn = sqlite3.connect(tenant_db)
+    try:
+        for sql in queries:
+            plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+            aliases = invoices_aliases(sql)
+            scans = [line for line in plan if line.split()[:2] and line.split()[0] == 'SCAN'
+                     and line.split()[1] in aliases]
+            assert not scans, (sql, plan)
+            assert any(re.search(r'USING (COVERING )?INDEX idx_invoices_', line) for line in plan), (sql, plan)
+    finally:
+        conn.close()
+
+
+def test_sql_date_range_is_half_open(srv):
+    sql, params = srv.sql_date_range('created_at', '2026-01-01', '2026-01-31')
+    assert sql == ' AND created_at >= ? AND created_at < ?'
+    assert params == ['2026-01-01', '2026-02-01']
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Restoring a backup taken before the current schema upgrades the file on disk.
+
+Other workers already hold the path in _initialized_dbs and will not re-read
+user_version, so the restore itself must leave a current schema behind.
+"""
+
+import io
+import sqlite3
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from conftest import create_tenant, login
+
+SLUG = 'restore-test'
+
+
+@pytest.fixture(scope='module')
+def restored(srv, client):
+    db_path = create_tenant(srv, SLUG)
+    headers = login(client, SLUG)
+
+    # A database as create_tenant_database() leaves it: base tables only, user_version 0
+    srv.create_tenant_database('restore-source')
+    source_path = srv.get_tenant_db_path('restore-source')
+    source = sqlite3.connect(source_path)
+    source.execute("INSERT INTO users (username, password, full_name, role, is_active, branch_id) "
+                   "VALUES ('restored-admin', ?, 'Restored Admin', 'admin', 1, 1)",
+                   (generate_password_hash('restored-pass', method='pbkdf2:sha256', salt_length=16),))
+    source.commit()
+    source.close()
+    with open(source_path, 'rb') as f:
+        backup = f.read()
+    assert srv.read_schema_version(source_path) != srv.SCHEMA_VERSION
+
+    r = client.post('/api/backup/restore', headers=headers, content_type='multipart/form-data',
+                    data={'file': (io.BytesIO(backup), 'old.db')})
+    assert r.status_code == 200, r.get_json()
+    # Second worker: its gate was passed before the restore and is never reset
+    srv._initialized_dbs.add(db_path)
+    return db_path, headers
+
+
+def test_restore_stamps_current_schema(srv, restored):
+    db_path, _ = restored
+    assert srv.read_schema_version(db_path) == srv.SCHEMA_VERSION
+    conn = sqlite3.connect(db_path)
+    names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')")}
+    conn.close()
+    assert {'change_log', 'stock_movements', 'stock_movements_bs_au', 'daily_sales_rollup'} <= names
+
+
+def test_handlers_work_after_restore(client, restored):
+    db_path, headers = restored
+    r = client.post('/api/inventory', headers=headers, json={'name': 'Restored Widget', 'price': 3, 'cost': 1})
+    assert r.status_code == 200, r.get_json()
+
+    r = client.get('/api/products?search=Restored', headers=headers)
+    assert r.status_code == 200, r.get_json()
+
+    r = client.get('/api/reports/sales?start_date=2026-01-01&end_date=2026-01-31', headers=headers)
+    assert r.status_code == 200, r.get_json()
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO branch_stock (inventory_id, branch_id, stock) VALUES (1, 1, 5)")
+    conn.execute('UPDATE branch_stock SET stock = 2 WHERE id = last_insert_rowid()')
+    conn.commit()
+    deltas = [row[0] for row in conn.execute('SELECT delta FROM stock_movements ORDER BY id')]
+    conn.close()
+    assert deltas[-2:] == [5, -3]
+
+
+def test_request_time_columns_after_restore(client, restored):
+    """login, cancel_invoice and XBRL rely on migration 011 instead of running DDL themselves."""
+    db_path, _ = restored
+    r = client.post('/api/login', json={'username': 'restored-admin', 'password': 'restored-pass'},
+                    headers={'X-Tenant-ID': SLUG})
+    assert r.status_code == 200, r.get_json()
+    headers = {'Authorization': f"Bearer {r.get_json()['token']}", 'X-Tenant-ID': SLUG}
+
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    cur.execute("INSERT INTO inventory (name, price) VALUES ('Cancel Widget', 4)")
+    cur.execute('INSERT INTO branch_stock (inventory_id, branch_id, stock) VALUES (?, 1, 10)', (cur.lastrowid,))
+    branch_stock_id = cur.lastrowid
+    cur.execute("INSERT INTO invoices (invoice_number, total, branch_id) VALUES ('RESTORED-1', 8, 1)")
+    invoice_id = cur.lastrowid
+    cur.execute('''INSERT INTO invoice_items (invoice_id, product_name, quantity, price, total, branch_stock_id)
+                   VALUES (?, 'Cancel Widget', 2, 4, 8, ?)''', (invoice_id, branch_stock_id))
+    conn.commit()
+
+    r = client.put(f'/api/invoices/{invoice_id}/cancel', headers=headers,
+                   json={'reason': 'restore test', 'return_stock': True})
+    assert r.status_code == 200, r.get_json()
+    cancelled, stock = conn.execute('''SELECT i.cancelled, bs.stock FROM invoices i, branch_stock bs
+                                       WHERE i.id = ? AND bs.id = ?''', (invoice_id, branch_stock_id)).fetchone()
+    conn.close()
+    assert cancelled == 1 and stock == 12
+
+    r = client.post('/api/xbrl/company-info', headers=headers, json={'company_name_en': 'Restored Co'})
+    assert r.status_code == 200, r.get_json()
+    r = client.get('/api/xbrl/reports', headers=headers)
+    assert r.status_code == 200, r.get_json()
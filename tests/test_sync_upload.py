@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""A bad record in /api/sync/upload is reported and skipped; the rest of the batch is synced."""
+
+import json
+import sqlite3
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def stock_row(tenant_db):
+    conn = sqlite3.connect(tenant_db)
+    cur = conn.cursor()
+    cur.execute("INSERT INTO inventory (name, price) VALUES ('Sync Widget', 5)")
+    cur.execute('INSERT INTO branch_stock (inventory_id, branch_id, stock) VALUES (?, 1, 100)', (cur.lastrowid,))
+    branch_stock_id = cur.lastrowid
+    conn.commit()
+    conn.close()
+    return branch_stock_id
+
+
+def _invoice(number, branch_stock_id, quantity=1, **extra):
+    invoice = {'invoice_number': number, 'total': 5 * quantity, 'branch_id': 1,
+               'created_at': '2026-03-01 10:00:00',
+               'items': [{'product_id': branch_stock_id, 'branch_stock_id': branch_stock_id,
+                          'product_name': 'Sync Widget', 'quantity': quantity, 'price': 5, 'total': 5 * quantity}]}
+    invoice.update(extra)
+    return invoice
+
+
+def _upload(client, auth, payload):
+    r = client.post('/api/sync/upload', data=json.dumps(payload), content_type='application/json', headers=auth)
+    assert r.status_code == 200, r.get_json()
+    return r.get_json()['results']
+
+
+def _stock(db_path, branch_stock_id):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('SELECT stock FROM branch_stock WHERE id = ?', (branch_stock_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_invalid_records_are_skipped(client, auth, tenant_db, stock_row):
+    prefix = uuid.uuid4().hex[:8]
+    bad_item = _invoice(f'{prefix}-bad-item', stock_row)
+    bad_item['items'][0]['branch_stock_id'] = 'abc'
+    results = _upload(client, auth, {
+        'customers': [{'name': f'Good {prefix}', 'phone': f'{prefix}1'},
+                      {'name': None, 'phone': f'{prefix}2'}],
+        'invoices': [_invoice(f'{prefix}-1', stock_row, 2),
+                     bad_item,
+                     _invoice(f'{prefix}-big', stock_row, customer_id=2**70),
+                     _invoice(f'{prefix}-2', stock_row, 3)],
+    })
+
+    assert results['customers_synced'] == 1
+    assert results['invoices_synced'] == 2
+    assert len(results['errors']) == 3
+    assert _stock(tenant_db, stock_row) == 95
+
+
+def test_database_rejection_falls_back_to_per_record(client, auth, tenant_db, stock_row):
+    """A constraint the pre-validation cannot see fails the batch, then only its own record."""
+    prefix = uuid.uuid4().hex[:8]
+    conn = sqlite3.connect(tenant_db)
+    conn.execute('''CREATE TRIGGER test_reject_invoice BEFORE INSERT ON invoices WHEN NEW.notes = 'reject'
+                    BEGIN SELECT RAISE(ABORT, 'rejected by test'); END''')
+    conn.commit()
+    try:
+        results = _upload(client, auth, {'invoices': [
+            _invoice(f'{prefix}-1', stock_row, 1),
+            _invoice(f'{prefix}-2', stock_row, 4, notes='reject'),
+            _invoice(f'{prefix}-3', stock_row, 2),
+        ]})
+    finally:
+        conn.execute('DROP TRIGGER test_reject_invoice')
+        conn.commit()
+
+    assert results['invoices_synced'] == 2
+    assert results['errors'] == [f'Invoice {prefix}-2: rejected by test']
+    assert _stock(tenant_db, stock_row) == 97
+    numbers = {row[0] for row in conn.execute(
+        'SELECT invoice_number FROM invoices WHERE invoice_number LIKE ?', (f'{prefix}-%',))}
+    items = conn.execute('''SELECT COUNT(*) FROM invoice_items ii JOIN invoices i ON i.id = ii.invoice_id
+                            WHERE i.invoice_number LIKE ?''', (f'{prefix}-%',)).fetchone()[0]
+    conn.close()
+    assert numbers == {f'{prefix}-1', f'{prefix}-3'}
+    assert items == 2